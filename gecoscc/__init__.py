@@ -90,6 +90,8 @@ def route_config(config):
     config.add_route('settings_save', '/settings/save/', factory=SuperUserFactory)
     config.add_route('reports', '/reports/', factory=ReadOnlyOrManageFactory)
     config.add_route('report_file', '/report', factory=ReadOnlyOrManageFactory)
+    config.add_route('report_job', '/report/job/', factory=ReadOnlyOrManageFactory)
+    config.add_route('report_download', '/report/download/{artifact_id}/', factory=ReadOnlyOrManageFactory)
     config.add_route('computer_logs', '/computer/logs/{node_id}/{filename}', factory=LoggedFactory)
     config.add_route('download_computer_logs', '/download/computer/logs/{node_id}/{filename}', factory=LoggedFactory)
     config.add_route('delete_computer_logs', '/delete/computer/logs/{node_id}/{filename}', factory=ManageFactory)
@@ -155,6 +157,10 @@ def database_config(config):
 
     config.add_request_method(get_db, 'db', reify=True)
 
+def update_indexes(config):
+    config.registry.settings['mongodb'].update_indexes()
+
+
 def check_server_list(config):
     settings = config.registry.settings
     server_name = read_setting_from_env(settings, 'server_name', None)
@@ -289,6 +295,11 @@ def main(global_config, **settings):
     p.start()
     p.join()
 
+    # The indexes are created once for each version of their definitions
+    p = Process(target=update_indexes, args=(config, ))
+    p.start()
+    p.join()
+
     config.add_translation_dirs('gecoscc:locale/')
 
     jinja2_config(config)
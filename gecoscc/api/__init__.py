@@ -14,10 +14,14 @@ from __future__ import division
 from builtins import str
 from past.utils import old_div
 from builtins import object
+from six import string_types
+import base64
 import cgi
+import datetime
 import os
+import pymongo
 
-from bson import ObjectId
+from bson import ObjectId, json_util
 from copy import deepcopy
 
 from pymongo.errors import DuplicateKeyError
@@ -28,6 +32,7 @@ from gecoscc.models import Node
 from gecoscc.permissions import (can_access_to_this_path, nodes_path_filter,
                                  is_gecos_master_or_403,
                                  master_policy_no_updated_or_403)
+from gecoscc.serializers import get_schema_fields, get_serializer
 from gecoscc.socks import invalidate_change, invalidate_delete
 from gecoscc.tasks import (object_created, object_changed, object_deleted, 
                            object_moved, object_refresh_policies)
@@ -36,20 +41,93 @@ from gecoscc.utils import (get_computer_of_user, get_filter_nodes_parents_ou,
                            visibility_object_related, visibility_group,
                            RESOURCES_EMITTERS_TYPES, 
                            get_object_related_list_count,
-                           is_domain, get_domain, is_root)
+                           is_emitters_index_built, is_domain, get_domain, is_root, get_ancestors,
+                           get_policy, get_policy_by_slug)
 
 import gettext
 import logging
 logger = logging.getLogger(__name__)
 
+def encode_cursor(values, total):
+    '''
+    Opaque token of the cursor pagination, with the values of the sort fields
+    of the last object of a page and the total of objects.
+    '''
+    data = json_util.dumps({'values': values, 'total': total})
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+# Types of the values of the sort fields in the cursor tokens. Any other value
+# (i.e. a document with query operators) is rejected.
+CURSOR_VALUE_TYPES = string_types + (bool, int, float, ObjectId,
+                                     datetime.datetime)
+
+
+def decode_cursor(token):
+    '''
+    Values of the sort fields and total of a cursor token. A ValueError is
+    raised when the values are not None, scalars, ObjectIds or dates.
+    '''
+    data = json_util.loads(
+        base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    values = data['values']
+    if not isinstance(values, list) or not all(
+            value is None or isinstance(value, CURSOR_VALUE_TYPES)
+            for value in values):
+        raise ValueError('Invalid cursor values')
+    return values, int(data['total'])
+
+
+def get_sort_value(obj, field):
+    for key in field.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def get_after_filter(sort, values):
+    '''
+    Filter of the objects sorted after the given values of the sort fields.
+    MongoDB sorts the null (or missing) values before any other value.
+    '''
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = dict((previous_field, previous_value) for
+                      (previous_field, _direction), previous_value in
+                      zip(sort[:i], values[:i]))
+        value = values[i]
+        if direction == pymongo.ASCENDING:
+            if value is None:
+                branch[field] = {'$ne': None}
+            else:
+                branch[field] = {'$gt': value}
+        elif value is None:
+            # Nothing is sorted before a null value
+            continue
+        else:
+            branch['$or'] = [{field: {'$lt': value}}, {field: None}]
+        branches.append(branch)
+    if not branches:
+        return {'_id': {'$in': []}}
+    return {'$or': branches}
+
+
 SAFE_METHODS = ('GET', 'OPTIONS', 'HEAD',)
 UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE', )
 SCHEMA_METHODS = ('POST', 'PUT', )
 
 
+# Fields of the nodes that are only returned with each node, not in the lists
+NODE_DETAIL_FIELDS = ('policies', 'inheritance')
+
+
 class BaseAPI(object):
 
     order_field = '_id'
+    # Fields of the objects of the collections (None: all the fields of the
+    # schema_collection items)
+    collection_fields = None
 
     def __init__(self, request, context=None):
         self.request = request
@@ -63,7 +141,8 @@ class BaseAPI(object):
         return self.schema_detail().serialize(item)
 
     def parse_collection(self, collection):
-        return self.schema_collection().serialize(collection)
+        return get_serializer(self.schema_collection,
+                              self.collection_fields)(collection)
 
     def get_collection(self, collection=None):
         if collection is None:
@@ -178,31 +257,133 @@ class ResourcePaginatedReadOnly(BaseAPI):
     def get_oid_filter(self, oid):
         return {self.key: ObjectId(oid)}
 
+    def get_sort(self, tie_break=False):
+        '''
+        The order of the collection as a list of (field, direction). The
+        cursor pagination needs the "_id" to break the ties.
+        '''
+        if isinstance(self.order_field, string_types):
+            sort = [(self.order_field, pymongo.ASCENDING)]
+        else:
+            sort = list(self.order_field)
+        if tie_break and '_id' not in [field for field, _direction in sort]:
+            sort.append(('_id', pymongo.ASCENDING))
+        return sort
+
+    def get_mongo_query(self):
+        objects_filter = self.get_objects_filter()
+        if self.mongo_filter:
+            objects_filter.append(self.mongo_filter)
+
+        if objects_filter:
+            return {
+                '$and': objects_filter,
+            }
+        return {}
+
+    def get_projection(self, sort):
+        '''
+        Only the fields of the collection (and the sort fields, needed by the
+        cursor pagination) are read from MongoDB. None when the schema needs
+        all the fields.
+        '''
+        fields = self.collection_fields
+        if fields is None:
+            fields = get_schema_fields(self.schema_collection)
+        if fields is None:
+            return None
+        projection = dict((field, True) for field in fields)
+        for field, _direction in sort:
+            projection[field] = True
+        return projection
+
+    def count_objects(self, mongo_query):
+        return self.collection.count_documents(mongo_query)
+
+    def find_objects(self, mongo_query, extraargs):
+        return self.collection.find(mongo_query, **extraargs)
+
     def collection_get(self):
         page = int(self.request.GET.get('page', 1))
         pagesize = int(self.request.GET.get('pagesize', self.default_pagesize))
         if pagesize <= 0 or page <= 0:
             raise HTTPBadRequest()
+        if 'after' in self.request.GET:
+            return self.collection_get_after(page, pagesize)
         extraargs = {
+            'sort': self.get_sort(),
             'skip': (page - 1) * pagesize,
             'limit': pagesize,
         }
+        projection = self.get_projection(extraargs['sort'])
+        if projection is not None:
+            extraargs['projection'] = projection
 
-        objects_filter = self.get_objects_filter()
-        if self.mongo_filter:
-            objects_filter.append(self.mongo_filter)
+        mongo_query = self.get_mongo_query()
 
-        if objects_filter:
-            mongo_query = {
-                '$and': objects_filter,
-            }
+        nodes_count = self.count_objects(mongo_query)
+
+        objects = self.find_objects(mongo_query, extraargs)
+        objects = self.get_distinct_filter(objects)
+        pages = int(old_div(nodes_count, pagesize))
+        if nodes_count % pagesize > 0:
+            pages += 1
+        parsed_objects = self.parse_collection(list(objects))
+        return {
+            'pagesize': pagesize,
+            'pages': pages,
+            'page': page,
+            self.collection_name: parsed_objects,
+            'total': nodes_count,
+        }
+
+    def collection_get_after(self, page, pagesize):
+        '''
+        Cursor pagination (opt-in with the "after" parameter, empty for the
+        first page): each page starts after the last object of the previous
+        one, whose token is returned in "after", so the cost of a page does
+        not depend on its depth. The total is only counted for the first
+        page, and it travels in the token.
+        '''
+        sort = self.get_sort(tie_break=True)
+        mongo_query = self.get_mongo_query()
+
+        token = self.request.GET.get('after')
+        if token:
+            try:
+                values, nodes_count = decode_cursor(token)
+            except (ValueError, TypeError, KeyError):
+                raise HTTPBadRequest()
+            if len(values) != len(sort):
+                raise HTTPBadRequest()
+            after_filter = get_after_filter(sort, values)
+            if mongo_query:
+                mongo_query = {'$and': [mongo_query, after_filter]}
+            else:
+                mongo_query = after_filter
         else:
-            mongo_query = {}
+            nodes_count = self.count_objects(mongo_query)
 
-        nodes_count = self.collection.count_documents(mongo_query)
+        extraargs = {
+            'sort': sort,
+            'skip': 0,
+            'limit': pagesize + 1,
+        }
+        projection = self.get_projection(sort)
+        if projection is not None:
+            extraargs['projection'] = projection
+        cursor = self.find_objects(mongo_query, extraargs)
+        objects = self.get_distinct_filter(cursor)
+        after = None
+        # The lists of distinct values are not paginated
+        if objects is cursor:
+            objects = list(objects)
+            if len(objects) > pagesize:
+                objects = objects[:pagesize]
+                after = encode_cursor(
+                    [get_sort_value(objects[-1], field) for field, _direction
+                     in sort], nodes_count)
 
-        objects = self.collection.find(mongo_query, **extraargs).sort(self.order_field)
-        objects = self.get_distinct_filter(objects)
         pages = int(old_div(nodes_count, pagesize))
         if nodes_count % pagesize > 0:
             pages += 1
@@ -213,6 +394,7 @@ class ResourcePaginatedReadOnly(BaseAPI):
             'page': page,
             self.collection_name: parsed_objects,
             'total': nodes_count,
+            'after': after,
         }
 
     def get(self):
@@ -236,8 +418,14 @@ class ResourcePaginatedReadOnly(BaseAPI):
         return node
         
     def is_assigned(self, related_object):
+        db = self.request.db
+        if is_emitters_index_built(db):
+            emitter_index = db.emitters_index.find_one(
+                {'_id': related_object['_id']}, {'nodes': True})
+            if emitter_index is not None:
+                return bool(emitter_index['nodes'])
         node_with_related_object_count = get_object_related_list_count(
-            self.request.db, related_object)
+            db, related_object)
         return bool(node_with_related_object_count)
 
 
@@ -266,7 +454,7 @@ class ResourcePaginated(ResourcePaginatedReadOnly):
             policies = obj['policies']
             for policy in policies:
                 # Get the policy
-                policyobj = self.request.db.policies.find_one({"_id": ObjectId(str(policy))})
+                policyobj = get_policy(self.request.db, policy)
                 if policyobj is None:
                     logger.warning("Unknown policy: %s" % (str(policy)))
                 else:
@@ -328,6 +516,9 @@ class ResourcePaginated(ResourcePaginatedReadOnly):
         if obj is None:
             return
 
+        if issubclass(self.schema_detail, Node):
+            obj['ancestors'] = get_ancestors(obj['path'])
+
         try:
             obj_id = self.collection.insert_one(obj).inserted_id
         except DuplicateKeyError as e:
@@ -402,7 +593,9 @@ class ResourcePaginated(ResourcePaginatedReadOnly):
             del obj['inheritance']
             
         real_obj.update(obj)
-        
+        if issubclass(self.schema_detail, Node):
+            real_obj['ancestors'] = get_ancestors(real_obj['path'])
+
         try:
             self.collection.replace_one(obj_filter, real_obj)
         except DuplicateKeyError as e:
@@ -664,7 +857,7 @@ class PassiveResourcePaginated(TreeLeafResourcePaginated):
                     return True
                 return False
 
-            policy_id = self.request.db.policies.find_one({'slug': slug}).get(
+            policy_id = get_policy_by_slug(self.request.db, slug).get(
                 '_id')
             nodes_related_with_obj = self.request.db.nodes.count_documents(
                 {"policies.%s.object_related_list" % str(policy_id): {
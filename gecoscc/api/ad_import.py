@@ -39,7 +39,7 @@ from gecoscc.models import (OU_ORDER, OrganisationalUnit, Group, User,
 from gecoscc.permissions import http_basic_login_required, can_access_to_this_path
 from gecoscc.utils import (get_chef_api, reserve_node_or_raise,
                            save_node_and_free, is_domain, is_visible_group,
-                           get_filter_this_domain,
+                           get_filter_this_domain, get_ancestors,
                            MASTER_DEFAULT)
 logger = logging.getLogger(__name__)
 
@@ -544,6 +544,7 @@ class ADImport(BaseAPI):
         return domain
 
     def _saveMongoObject(self, mongoObject):
+        mongoObject['ancestors'] = get_ancestors(mongoObject.get('path'))
         if '_id' not in list(mongoObject.keys()):
             # Insert object
             return self.collection.insert(mongoObject)
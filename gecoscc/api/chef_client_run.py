@@ -10,13 +10,17 @@
 #
 
 from builtins import str
+from bson import ObjectId
 from cornice.resource import resource
 
+from chef import Node as ChefNode
 from pyramid.threadlocal import get_current_registry
 
 from gecoscc.api import BaseAPI
 from gecoscc.models import Computer, Computers
-from gecoscc.utils import get_chef_api, is_node_busy_and_reserve_it
+from gecoscc.utils import (get_chef_api, is_node_busy_and_reserve_it,
+                           is_lease_reservation_backend, reserve_node_lease,
+                           save_computer_log_file, delete_computer_log_files)
 
 import json
 import time
@@ -37,6 +41,9 @@ class ChefClientRunResource(BaseAPI):
     def put(self):
         """
         Reserve the Chef node before running the Chef client
+
+        The answer never waits for the node: when it is busy the client is
+        asked to retry after "retry_after" seconds.
         """
                 
         # Check the parameters
@@ -56,25 +63,55 @@ class ChefClientRunResource(BaseAPI):
         logger.info("/chef-client/run/: Reserve chef node %s" % (str(node_id)))
 
         # Saving last agent run time 
-        self.request.db.nodes.update_one({'node_chef_id': node_id},
+        result = self.request.db.nodes.update_one({'node_chef_id': node_id},
             {'$set': {'last_agent_run_time': int(time.time())}})
         
         # Reserve the node
         settings = get_current_registry().settings
+        if is_lease_reservation_backend(settings):
+            return self.reserve_node_lease(node_id, result.matched_count > 0,
+                                           settings)
+
         api = get_chef_api(settings, self.request.user)
-        node, is_busy = is_node_busy_and_reserve_it(node_id, api, 'client', attempts=3)
+        node, is_busy = is_node_busy_and_reserve_it(node_id, api, 'client')
         if not node.attributes.to_dict():
             return {'ok': False,
                     'message': 'The node does not exists (in chef)'}
         if is_busy:
-            return {'ok': False,
-                    'message': 'The node is busy'}
+            return self.busy_response(settings)
         return {'ok': True}
 
+    def reserve_node_lease(self, node_id, is_computer, settings):
+        """
+        Reserve the node with a lease in MongoDB. The Chef server is only
+        asked when the node is not a computer of the database.
+
+        The token of the lease is returned, so the client can send it to
+        /chef/status/ to release only its own reservation.
+        """
+        if not is_computer:
+            api = get_chef_api(settings, self.request.user)
+            if not ChefNode(node_id, api).exists:
+                return {'ok': False,
+                        'message': 'The node does not exists (in chef)'}
+
+        token = str(ObjectId())
+        seconds_block_is_busy = int(settings.get('chef.seconds_block_is_busy'))
+        if not reserve_node_lease(node_id, 'client', seconds_block_is_busy,
+                                  token):
+            return self.busy_response(settings)
+        return {'ok': True,
+                'lease': token}
+
+    def busy_response(self, settings):
+        return {'ok': False,
+                'message': 'The node is busy',
+                'retry_after': int(settings.get('chef.seconds_sleep_is_busy'))}
+
 
     def post(self):
         """
-        Imports log files into mongoDB node
+        Imports log files of a node into the computer logs store
         """
 
         # Check the parameters
@@ -83,7 +120,8 @@ class ChefClientRunResource(BaseAPI):
             return {'ok': False,
                     'message': 'Please set a node id (node_id)'}
             
-        computer = self.collection.find_one({"node_chef_id": node_id, "type": "computer"})
+        computer = self.collection.find_one({"node_chef_id": node_id, "type": "computer"},
+                                            {"logs.files.file_id": True})
         if not computer:
             return {'ok': False,
                     'message': 'Can\' find a computer with this node id'}
@@ -122,22 +160,24 @@ class ChefClientRunResource(BaseAPI):
             return {'ok': False,
                     'message': 'Please set a files section in logs data'}
 
-        # Remove dot from filenames
-        computer['logs'] = {}
-        computer['logs']['date'] = logs_data['date']
-        computer['logs']['files'] = []
+        # The contents are stored out of the node, which only keeps
+        # the references to the files (filenames may contain dots)
+        files = []
         for filename in logs_data['files']:
-            filedata = {}
-            filedata['filename'] = filename
-            filedata['content'] = logs_data['files'][filename]
-            filedata['size'] = len(logs_data['files'][filename])
-            
-            computer['logs']['files'].append(filedata)
-            
+            files.append(save_computer_log_file(
+                self.request.db, computer['_id'], filename,
+                logs_data['files'][filename]))
+
         # Save logs data
-        self.collection.replace_one(
-            {"node_chef_id": node_id, "type": "computer"}, computer)
-        
+        self.collection.update_one(
+            {'_id': computer['_id']},
+            {'$set': {'logs': {'date': logs_data['date'],
+                               'files': files}}})
+
+        # Remove the previous log files
+        delete_computer_log_files(self.request.db,
+                                  computer.get('logs', {}).get('files', []))
+
         return {'ok': True,
                     'message': 'Log data saved'}
         
@@ -10,10 +10,14 @@
 #
 
 from cornice.resource import resource
+from pyramid.httpexceptions import HTTPForbidden
 
 from gecoscc.api import BaseAPI
 from gecoscc.models import Job
+from gecoscc.permissions import http_basic_login_required
 from gecoscc.tasks import chef_status_sync
+from gecoscc.utils import (is_lease_reservation_backend, free_node_lease,
+                           queue_chef_status_sync, get_chef_status_queue_depth)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -43,6 +47,29 @@ class ChefStatusResource(BaseAPI):
             return {'ok': False,
                     'message': 'The admin user %s does not exists' % username}
 
-        chef_status_sync.delay(node_id, self.request.user)
+        # The chef client run has finished, so its reservation is released
+        # (only the reservation of this run if the client sends its lease)
+        if is_lease_reservation_backend(self.request.registry.settings):
+            free_node_lease(node_id, 'client',
+                            self.request.POST.get('lease') or None)
 
-        return {'ok': True}
\ No newline at end of file
+        # All the callbacks of a node received before its sync starts are
+        # coalesced in a single task
+        if queue_chef_status_sync(self.request.db, node_id):
+            chef_status_sync.delay(node_id, self.request.user)
+        else:
+            logger.debug("/chef/status/: Sync of node %s already queued" % node_id)
+
+        return {'ok': True}
+
+    def get(self):
+        """
+        Number of chef status syncs pending and running (only for superusers,
+        the callbacks of the chef clients are not authenticated)
+        """
+        http_basic_login_required(self.request)
+        if not self.request.user.get('is_superuser'):
+            raise HTTPForbidden()
+        depth = get_chef_status_queue_depth(self.request.db)
+        depth['ok'] = True
+        return depth
\ No newline at end of file
@@ -24,11 +24,13 @@ from cornice.resource import resource
 from chef import Node as ChefNode
 from chef import ChefError
 from chef.exceptions import ChefServerError
-from gecoscc.utils import get_chef_api, get_inheritance_tree_policies_list
+from gecoscc.utils import (get_chef_api, get_inheritance_tree_policies_list,
+    delete_computer_log_files, save_ohai_snapshot)
 
-from gecoscc.api import TreeLeafResourcePaginated
+from gecoscc.api import TreeLeafResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import Computer, Computers
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 from gecoscc.utils import to_deep_dict
 from gecoscc.i18n import gettext as _
 
@@ -36,14 +38,13 @@ from pyramid.threadlocal import get_current_request
 
 import locale
 import datetime
+import json
 import re
 import traceback
 
 import logging
 logger = logging.getLogger(__name__)
 
-DEBUG_MODE_ENABLE_ATTR_PATH = 'gecos_ws_mgmt.single_node.debug_mode_res.enable_debug'
-
 @resource(collection_path='/api/computers/',
           path='/api/computers/{oid}/',
           description='Computers resource',
@@ -52,6 +53,8 @@ class ComputerResource(TreeLeafResourcePaginated):
 
     schema_collection = Computers
     schema_detail = Computer
+    collection_fields = get_schema_fields(Computers,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'computer'
 
     mongo_filter = {
@@ -68,159 +71,176 @@ class ComputerResource(TreeLeafResourcePaginated):
         
         logger.info("/api/computers/: node_chef_id: %s" % (str(result.get('node_chef_id', None))))
 
-        try:
-            api = get_chef_api(self.request.registry.settings, self.request.user)
-            computer_node = ChefNode(result['node_chef_id'], api)
-            ohai = to_deep_dict(computer_node.attributes)
-            nodeid = result.get('_id',None)
-            usernames = [i['username'] for i in ohai.get('ohai_gecos', {}).get('users', [])]
-            users = list(node_collection.find({
-                "$and": [
-                    { "$or": [{"name": {"$in": usernames}}] }, 
-                    { "type":"user"},
-                    { "computers": {"$elemMatch": {"$eq": ObjectId(nodeid)}}}
-                 ]
-            },{'_id':1,'name':1,'path':1}))
-            # ObjectId to string for JSON serialize
-            [d.update({'_id': str(d['_id'])}) for d in users]
-            
-            # Create a list of users that provides at least one user policy to this computer
-            users_inheritance_pre = list(node_collection.find({
-                "$and": [
-                    { "$or": [{"name": {"$in": usernames}}] }, 
-                    { "type":"user"},
-                    { "computers": {"$elemMatch": {"$eq": ObjectId(nodeid)}}}
-                 ]
-            },{'_id':1,'name':1,'path':1, 'inheritance': 1}))
-            [d.update({'_id': str(d['_id'])}) for d in users_inheritance_pre]
-
-            users_inheritance = []
-            for usr_inh in users_inheritance_pre:
-                if 'inheritance' in usr_inh:
-                    policies_list = get_inheritance_tree_policies_list(usr_inh['inheritance'], [])
-                    if len(policies_list) > 0:
-                        users_inheritance.append(usr_inh)
+        nodeid = result.get('_id',None)
+        # Get the logs info
+        # (without the file contents, that are read from the logs store)
+        computer = node_collection.find_one({"type": "computer", "_id": ObjectId(nodeid)},
+                                            {"logs.date": True,
+                                             "logs.files.filename": True,
+                                             "logs.files.size": True})
+        snapshot = self.request.db.ohai_snapshots.find_one({'_id': ObjectId(nodeid)})
+
+        # The Chef node is only read on demand ("refresh" parameter) or when
+        # the chef client of the computer has not sent its data yet
+        ohai = None
+        if snapshot is None or self.request.GET.get('refresh') == 'true':
+            try:
+                api = get_chef_api(self.request.registry.settings, self.request.user)
+                computer_node = ChefNode(result['node_chef_id'], api)
+                ohai = to_deep_dict(computer_node.attributes)
+                snapshot = save_ohai_snapshot(self.request.db, ObjectId(nodeid),
+                                              computer_node, ohai)
+            except (urllib.error.URLError, ChefError, ChefServerError):
+                logger.error("/api/computers/: error getting data: node_chef_id: %s " % (str(result.get('node_chef_id', None))))
+                logger.error(traceback.format_exc())
+                if snapshot is None:
+                    return result
+
+        if ohai is None:
+            ohai = json.loads(snapshot['ohai'])
+
+        usernames = [i['username'] for i in ohai.get('ohai_gecos', {}).get('users', [])]
+        users = list(node_collection.find({
+            "$and": [
+                { "$or": [{"name": {"$in": usernames}}] }, 
+                { "type":"user"},
+                { "computers": {"$elemMatch": {"$eq": ObjectId(nodeid)}}}
+             ]
+        },{'_id':1,'name':1,'path':1, 'inheritance': 1}))
+        # ObjectId to string for JSON serialize
+        [d.update({'_id': str(d['_id'])}) for d in users]
+
+        # Create a list of users that provides at least one user policy to this computer
+        users_inheritance = []
+        for usr_inh in users:
+            if 'inheritance' in usr_inh:
+                policies_list = get_inheritance_tree_policies_list(usr_inh['inheritance'], [])
+                if len(policies_list) > 0:
+                    users_inheritance.append(dict(usr_inh))
+        # The inheritance is only returned in users_inheritance
+        [d.pop('inheritance', None) for d in users]
+
+        cpu = ohai.get('cpu', {}).get('0', {})
+        dmi = ohai.get('dmi', {})
+
+        # debug_mode flag for logs tab
+        debug_mode = snapshot['debug_mode']
+
+        logs = {}
+        if computer is not None and 'logs' in computer:
+            logs_data = computer['logs']
             
+            date_format = locale.nl_langinfo(locale.D_T_FMT)
+            date = datetime.datetime(*list(map(int, re.split('[^\d]', logs_data['date'])[:-1])))
+            localename = locale.normalize(get_current_request().locale_name+'.UTF-8')
+            logger.debug("/api/computers/: localename: %s" % (str(localename)))
+            locale.setlocale(locale.LC_TIME, localename)
+            logs['date'] = date.strftime(date_format)
+            logger.debug("/api/computers/: date: %s" % (str(logs['date'])))
             
-            cpu = ohai.get('cpu', {}).get('0', {})
-            dmi = ohai.get('dmi', {})
+            logs['files'] = logs_data['files']
+        
+        # Get Help Channel info
+        help_channel_enabled = True
+        helpchannel_data = list(self.request.db.helpchannel.find(
+            {"computer_node_id" : result['node_chef_id']}).sort(
+                [("last_modified", pymongo.DESCENDING)]).limit(6))
+
+        # The users and administrators of all the rows are read at once
+        user_ids = [ObjectId(hcdata['user_node_id'])
+                    for hcdata in helpchannel_data if hcdata['user_node_id']]
+        user_names = dict((user_data['_id'], user_data['name'])
+                          for user_data in node_collection.find(
+                              {"type": "user", "_id": {"$in": user_ids}},
+                              {"name": True}))
+        admin_ids = [ObjectId(hcdata['adminuser_id'])
+                     for hcdata in helpchannel_data if hcdata['adminuser_id']]
+        admin_names = dict((user_data['_id'], user_data['username'])
+                           for user_data in self.request.db.adminusers.find(
+                               {"_id": {"$in": admin_ids}},
+                               {"username": True}))
+
+        helpchannel = {}
+        helpchannel['current'] = None
+        helpchannel['last'] = []
+        c = 0
+        for hcdata in helpchannel_data:
+            # Format date
+            date_format = locale.nl_langinfo(locale.D_T_FMT)
+            logger.info("last_modified: {0}".format( hcdata['last_modified']))
+            last_mod = re.split('[^\d]', str(hcdata['last_modified']))
+            logger.info("last_mod: {0}".format(last_mod))
+
+            date = datetime.datetime(*list(map(int, last_mod[:-2])))
+            localename = locale.normalize(get_current_request().locale_name+'.UTF-8')
+            logger.debug("/api/computers/: localename: %s" % (str(localename)))
+            locale.setlocale(locale.LC_TIME, localename)
+            hcdata['last_modified'] = date.strftime(date_format)
             
-            # debug_mode flag for logs tab
-            debug_mode = False
-            try:
-                debug_mode = computer_node.attributes.get_dotted(DEBUG_MODE_ENABLE_ATTR_PATH)
-            except KeyError:
-                pass
+            if hcdata['user_node_id']:
+                # Format user
+                user_name = user_names.get(ObjectId(hcdata['user_node_id']))
+                if user_name is not None:
+                    hcdata['user'] = user_name
+                else:
+                    logger.error("User not found: {0}".format(hcdata['user_node_id']))
+            else:
+                hcdata['user'] = ''
             
-            # Get logs info
-            logs_data = node_collection.find_one({"type": "computer", "_id": ObjectId(nodeid)}, {"logs": True})
-            logs = {}
-            if logs_data is not None and 'logs' in logs_data:
-                logs_data = logs_data['logs']
+            if hcdata['adminuser_id']:
+                # Format user
+                admin_name = admin_names.get(ObjectId(hcdata['adminuser_id']))
+                if admin_name is not None:
+                    hcdata['admin'] = admin_name
+                else:
+                    logger.error("Admin user not found: {0}".format(hcdata['adminuser_id']))
+            else:
+                hcdata['admin'] = ''
+                
+            # Translate status info
+            hcdata['status'] = _('Unknown status')
+            if hcdata['action'] == 'request':
+                hcdata['status'] = _('User is requesting support')
+            elif hcdata['action'] == 'accepted':
+                hcdata['status'] = _('User is requesting support')
+            elif hcdata['action'] == 'finished user':
+                hcdata['status'] = _('Terminated by user')
+            elif hcdata['action'] == 'finished tech':
+                hcdata['status'] = _('Terminated by technician')
+            elif hcdata['action'] == 'finished error':
+                hcdata['status'] = _('Terminated because of a communication error')
+            elif hcdata['action'] == 'giving support':
+                hcdata['status'] = _('The technician is giving support to the user')
                 
-                date_format = locale.nl_langinfo(locale.D_T_FMT)
-                date = datetime.datetime(*list(map(int, re.split('[^\d]', logs_data['date'])[:-1])))
-                localename = locale.normalize(get_current_request().locale_name+'.UTF-8')
-                logger.debug("/api/computers/: localename: %s" % (str(localename)))
-                locale.setlocale(locale.LC_TIME, localename)
-                logs['date'] = date.strftime(date_format)
-                logger.debug("/api/computers/: date: %s" % (str(logs['date'])))
                 
-                logs['files'] = logs_data['files']
-                for filedata in logs_data['files']:
-                    # Do not send file contents
-                    del filedata['content']
+            hcdata['_id'] = str(hcdata['_id'])                
             
-            # Get Help Channel info
-            help_channel_enabled = True
-            helpchannel_data = self.request.db.helpchannel.find(
-                {"computer_node_id" : result['node_chef_id']}).sort(
-                    [("last_modified", pymongo.DESCENDING)]).limit(6)
-            helpchannel = {}
-            helpchannel['current'] = None
-            helpchannel['last'] = []
-            if helpchannel_data is not None:
-                c = 0
-                for hcdata in helpchannel_data:
-                    # Format date
-                    date_format = locale.nl_langinfo(locale.D_T_FMT)
-                    logger.info("last_modified: {0}".format( hcdata['last_modified']))
-                    last_mod = re.split('[^\d]', str(hcdata['last_modified']))
-                    logger.info("last_mod: {0}".format(last_mod))
-
-                    date = datetime.datetime(*list(map(int, last_mod[:-2])))
-                    localename = locale.normalize(get_current_request().locale_name+'.UTF-8')
-                    logger.debug("/api/computers/: localename: %s" % (str(localename)))
-                    locale.setlocale(locale.LC_TIME, localename)
-                    hcdata['last_modified'] = date.strftime(date_format)
-                    
-                    if hcdata['user_node_id']:
-                        # Format user
-                        user_data = node_collection.find_one({"type": "user", "_id": ObjectId(hcdata['user_node_id'])})
-                        if user_data:
-                            hcdata['user'] = user_data['name']
-                        else:
-                            logger.error("User not found: {0}".format(hcdata['user_node_id']))
-                    else:
-                        hcdata['user'] = ''
-                    
-                    if hcdata['adminuser_id']:
-                        # Format user
-                        user_data = self.request.db.adminusers.find_one({"_id": ObjectId(hcdata['adminuser_id'])})
-                        if user_data:
-                            hcdata['admin'] = user_data['username']
-                        else:
-                            logger.error("Admin user not found: {0}".format(hcdata['adminuser_id']))
-                    else:
-                        hcdata['admin'] = ''
-                        
-                    # Translate status info
-                    hcdata['status'] = _('Unknown status')
-                    if hcdata['action'] == 'request':
-                        hcdata['status'] = _('User is requesting support')
-                    elif hcdata['action'] == 'accepted':
-                        hcdata['status'] = _('User is requesting support')
-                    elif hcdata['action'] == 'finished user':
-                        hcdata['status'] = _('Terminated by user')
-                    elif hcdata['action'] == 'finished tech':
-                        hcdata['status'] = _('Terminated by technician')
-                    elif hcdata['action'] == 'finished error':
-                        hcdata['status'] = _('Terminated because of a communication error')
-                    elif hcdata['action'] == 'giving support':
-                        hcdata['status'] = _('The technician is giving support to the user')
-                        
-                        
-                    hcdata['_id'] = str(hcdata['_id'])                
-                    
-                    if (c==0 and hcdata['action']=='accepted'):
-                        helpchannel['current'] = hcdata
-                    else:
-                        helpchannel['last'].append(hcdata)
-                    
-                    c = c + 1
-           
+            if (c==0 and hcdata['action']=='accepted'):
+                helpchannel['current'] = hcdata
+            else:
+                helpchannel['last'].append(hcdata)
             
-            result.update({'ohai': ohai,
-                           'users': users, # Users related with this computer
-                           'users_inheritance': users_inheritance, # Users related with this computer that provides at least one user policy
-                           'uptime': ohai.get('uptime', ''),
-                           #'gcc_link': ohai.get('gcc_link',True),
-                           'ipaddress': ohai.get('ipaddress', ''),
-                           'cpu': '%s %s' % (cpu.get('vendor_id', ''), cpu.get('model_name', '')),
-                           'product_name': dmi.get('system', {}).get('product_name', ''),
-                           'manufacturer': dmi.get('system', {}).get('manufacturer', ''),
-                           'ram': ohai.get('memory', {}).get('total', ''),
-                           'lsb': ohai.get('lsb', {}),
-                           'kernel': ohai.get('kernel', {}),
-                           'filesystem': ohai.get('filesystem', {}),
-                           'debug_mode': debug_mode,
-                           'logs': logs,
-                           'helpchannel': helpchannel,
-                           'help_channel_enabled': help_channel_enabled
-                           })
-        except (urllib.error.URLError, ChefError, ChefServerError):
-            logger.error("/api/computers/: error getting data: node_chef_id: %s " % (str(result.get('node_chef_id', None))))
-            logger.error(traceback.format_exc())
+            c = c + 1
+       
+        
+        result.update({'ohai': ohai,
+                       'users': users, # Users related with this computer
+                       'users_inheritance': users_inheritance, # Users related with this computer that provides at least one user policy
+                       'uptime': ohai.get('uptime', ''),
+                       #'gcc_link': ohai.get('gcc_link',True),
+                       'ipaddress': ohai.get('ipaddress', ''),
+                       'cpu': '%s %s' % (cpu.get('vendor_id', ''), cpu.get('model_name', '')),
+                       'product_name': dmi.get('system', {}).get('product_name', ''),
+                       'manufacturer': dmi.get('system', {}).get('manufacturer', ''),
+                       'ram': ohai.get('memory', {}).get('total', ''),
+                       'lsb': ohai.get('lsb', {}),
+                       'kernel': ohai.get('kernel', {}),
+                       'filesystem': ohai.get('filesystem', {}),
+                       'debug_mode': debug_mode,
+                       'logs': logs,
+                       'helpchannel': helpchannel,
+                       'help_channel_enabled': help_channel_enabled
+                       })
 
         return result
 
@@ -234,6 +254,12 @@ class ComputerResource(TreeLeafResourcePaginated):
         else:
             # Save object
             return super(ComputerResource, self).put()
+
+    def post_delete(self, obj, old_obj=None):
+        # Remove the log files of the computer from the logs store
+        delete_computer_log_files(self.request.db,
+                                  obj.get('logs', {}).get('files', []))
+        return super(ComputerResource, self).post_delete(obj, old_obj)
         
         
         
@@ -245,6 +271,8 @@ class ComputerSupportResource(TreeLeafResourcePaginated):
 
     schema_collection = Computers
     schema_detail = Computer
+    collection_fields = get_schema_fields(Computers,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'computer'
 
     mongo_filter = {
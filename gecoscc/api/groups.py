@@ -12,9 +12,10 @@
 
 from cornice.resource import resource
 
-from gecoscc.api import TreeLeafResourcePaginated
+from gecoscc.api import TreeLeafResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import Group, Groups
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 from gecoscc.utils import get_filter_nodes_parents_ou, merge_lists
 
 
@@ -26,6 +27,8 @@ class GroupResource(TreeLeafResourcePaginated):
 
     schema_collection = Groups
     schema_detail = Group
+    collection_fields = get_schema_fields(Groups,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'group'
 
     mongo_filter = {
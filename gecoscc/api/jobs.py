@@ -11,6 +11,7 @@
 #
 
 import json
+import re
 import pymongo
 import logging
 
@@ -18,6 +19,7 @@ from cornice.resource import resource
 from bson import ObjectId
 
 from gecoscc.api import ResourcePaginatedReadOnly
+from gecoscc.eventsmanager import get_jobs_archive_name, get_jobs_archive_names
 from gecoscc.models import Job, Jobs
 from gecoscc.permissions import api_login_required
 
@@ -41,9 +43,54 @@ class JobResource(ResourcePaginatedReadOnly):
     def get_oid_filter(self, oid):
         return {self.key: oid}
 
+    def get_archive_names(self):
+        '''
+        The archived jobs are also searched in the jobs archive
+        '''
+        if self.request.GET.get('archived', '') != 'true':
+            return []
+        archive_names = get_jobs_archive_names(self.request.db)
+        parentId = self.request.GET.get('parentId', None)
+        if parentId:
+            # The children are archived with its macrojob
+            archive_names = [name for name in archive_names
+                             if name == get_jobs_archive_name(
+                                 ObjectId(parentId))]
+        return archive_names
+
+    def count_objects(self, mongo_query):
+        count = self.collection.count_documents(mongo_query)
+        for name in self.get_archive_names():
+            count += self.request.db[name].count_documents(mongo_query)
+        return count
+
+    def find_objects(self, mongo_query, extraargs):
+        archive_names = self.get_archive_names()
+        if not archive_names:
+            return super(JobResource, self).find_objects(mongo_query,
+                                                         extraargs)
+        pipeline = [{'$match': mongo_query}]
+        for name in archive_names:
+            pipeline.append({'$unionWith': {
+                'coll': name,
+                'pipeline': [{'$match': mongo_query}]}})
+        pipeline += [
+            {'$sort': dict(extraargs['sort'])},
+            {'$skip': extraargs['skip']},
+            {'$limit': extraargs['limit']},
+        ]
+        if 'projection' in extraargs:
+            pipeline.append({'$project': extraargs['projection']})
+        return self.collection.aggregate(pipeline, allowDiskUse=True)
+
+    def get_search_filter(self, field, value):
+        # Case insensitive prefix search over the lowercase copy of the field
+        return {'search.%s' % field: {
+            '$regex': '^%s' % re.escape(value.lower())}}
+
     def get_objects_filter(self):
         filters = super(JobResource, self).get_objects_filter()
-        
+
         # Only macrojobs
         parentId = self.request.GET.get('parentId', None)
         if parentId:
@@ -53,19 +100,28 @@ class JobResource(ResourcePaginatedReadOnly):
 
         userfilter = self.request.GET.get('userfilter', None)
         if userfilter:
-            filters.append({'administrator_username': {'$regex': userfilter,'$options':'i'}})
+            filters.append(self.get_search_filter('administrator_username',
+                                                  userfilter))
 
         source = self.request.GET.get('source', None)
         if source:
-            filters.append({'objname': {'$regex': source,'$options':'i'}})
+            filters.append(self.get_search_filter('objname', source))
 
         workstation = self.request.GET.get('workstation', None)
         if workstation:
+            workstation_filter = self.get_search_filter('computername',
+                                                        workstation)
             if not parentId:
-                parents = self.request.db.jobs.find({'parent':{'$exists': True, '$ne': None},'computername':  {'$regex': workstation,'$options':'i'}},{'_id':0,'parent':1}).distinct('parent')
+                # Covered by the "search.computername" + "parent" index
+                workstation_filter['parent'] = {'$ne': None}
+                parents = self.request.db.jobs.distinct('parent',
+                                                        workstation_filter)
+                for name in self.get_archive_names():
+                    parents += self.request.db[name].distinct(
+                        'parent', workstation_filter)
                 filters.append({'_id': {'$in': parents}})
             else:
-                filters.append({'computername':  {'$regex': workstation,'$options':'i'}})
+                filters.append(workstation_filter)
 
         seeAll = self.request.GET.get('seeAll', 'false')
         if seeAll == 'false':
@@ -16,6 +16,22 @@ from gecoscc.models import Jobs, Job
 from gecoscc.permissions import api_login_required
 
 
+def count_jobs_by_status(collection, jobs_filter):
+    '''
+    Count the jobs of a filter by status with a single aggregation.
+    '''
+    counters = {'processing': 0, 'finished': 0, 'errors': 0, 'total': 0}
+    result = collection.aggregate([
+        {'$match': jobs_filter},
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+    ])
+    for status in result:
+        if status['_id'] in counters:
+            counters[status['_id']] = status['count']
+        counters['total'] += status['count']
+    return counters
+
+
 @resource(path='/api/jobs-statistics/',
           description='Jobs statistics',
           validators=(api_login_required,))
@@ -33,15 +49,5 @@ class JobStatistics(BaseAPI):
         return {self.key: oid}
 
     def get(self):
-        return {
-            'processing': self.collection.count_documents(
-                {'status': 'processing',
-                 'parent': {'$exists': True, '$ne': None}}),
-            'finished': self.collection.count_documents(
-                {'status': 'finished',
-                 'parent': {'$exists': True, '$ne': None}}),
-            'errors': self.collection.count_documents(
-                {'status': 'errors',
-                 'parent': {'$exists': True, '$ne': None}}),
-            'total': self.collection.count_documents(
-                {'parent': {'$exists': True, '$ne': None}})}
+        return count_jobs_by_status(
+            self.collection, {'parent': {'$exists': True, '$ne': None}})
@@ -12,6 +12,7 @@
 from cornice.resource import resource
 
 from gecoscc.api import BaseAPI
+from gecoscc.api.jobs_statistics import count_jobs_by_status
 from gecoscc.models import Jobs, Job
 from gecoscc.permissions import api_login_required
 
@@ -34,25 +35,9 @@ class MyJobStatistics(BaseAPI):
 
     def get(self):
         administrator_username = self.request.user['username']
-        
+
         # Count micro-jobs and macro-jobs that doesn't have any child
-        base_filter = { 'administrator_username': administrator_username, 'archived':False, 'parent': {'$exists': True, '$ne': None} }
-        
-        processing_filter = base_filter.copy()
-        processing_filter['status'] = 'processing'
-
-        finished_filter = base_filter.copy()
-        finished_filter['status'] = 'finished'
-
-        errors_filter = base_filter.copy()
-        errors_filter['status'] = 'errors'
-
-        nprocessing = self.collection.count_documents(processing_filter)
-        nfinished = self.collection.count_documents(finished_filter)
-        nerrors = self.collection.count_documents(errors_filter)
-        ntotal = self.collection.count_documents(base_filter)
-        
-        return {'processing': nprocessing,
-                'finished': nfinished,
-                'errors': nerrors,
-                'total': ntotal}
+        return count_jobs_by_status(self.collection, {
+            'administrator_username': administrator_username,
+            'archived': False,
+            'parent': {'$exists': True, '$ne': None}})
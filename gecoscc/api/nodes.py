@@ -14,9 +14,10 @@ import pymongo
 
 from cornice.resource import resource
 
-from gecoscc.api import ResourcePaginatedReadOnly
+from gecoscc.api import ResourcePaginatedReadOnly, NODE_DETAIL_FIELDS
 from gecoscc.models import Nodes, Node
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 
 
 def nodes_type_filter(request):
@@ -78,6 +79,8 @@ class NodesResource(ResourcePaginatedReadOnly):
 
     schema_collection = Nodes
     schema_detail = Node
+    collection_fields = get_schema_fields(Nodes,
+                                          exclude=NODE_DETAIL_FIELDS)
 
     mongo_filter = {
     }
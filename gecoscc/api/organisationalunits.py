@@ -11,12 +11,18 @@
 #
 
 from builtins import str
+import logging
+
 from cornice.resource import resource
 
-from gecoscc.api import TreeResourcePaginated
+from gecoscc.api import TreeResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import OrganisationalUnit, OrganisationalUnits
 from gecoscc.permissions import http_basic_login_required
-from gecoscc.utils import is_domain, MASTER_DEFAULT
+from gecoscc.serializers import get_schema_fields
+from gecoscc.utils import (is_domain, get_filter_nodes_belonging_ou,
+                           MASTER_DEFAULT)
+
+logger = logging.getLogger(__name__)
 
 
 @resource(collection_path='/api/ous/',
@@ -27,6 +33,8 @@ class OrganisationalUnitResource(TreeResourcePaginated):
 
     schema_collection = OrganisationalUnits
     schema_detail = OrganisationalUnit
+    collection_fields = get_schema_fields(OrganisationalUnits,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'ou'
 
     mongo_filter = {
@@ -48,13 +56,26 @@ class OrganisationalUnitResource(TreeResourcePaginated):
         Check if the Ou contains any object
         '''
         ou_children = self.collection.count_documents(
-            {'path': {'$regex': '.*' + str(obj['_id']) + '.*'}})
+            {'ancestors': get_filter_nodes_belonging_ou(obj['_id'])})
 
         if ou_children == 0:
             return True
         else:
             return False
 
+    def update_children_path(self, ou_id, old_path, new_path):
+        """ Replace the old path prefix of all the children of an OU """
+        # The new path is calculated by MongoDB in a single update
+        result = self.collection.update_many(
+            {'ancestors': get_filter_nodes_belonging_ou(ou_id)}, [
+                {'$set': {'path': {'$concat': [new_path, {'$substrCP': [
+                    '$path', len(old_path),
+                    {'$subtract': [{'$strLenCP': '$path'}, len(old_path)]}
+                ]}]}}},
+                {'$set': {'ancestors': {'$split': ['$path', ',']}}}
+            ])
+        return result.modified_count
+
     def post_save(self, obj, old_obj=None):
         """ Check if path has changed to refresh children nodes """
         if (self.request.method == 'PUT' and old_obj and
@@ -63,22 +84,10 @@ class OrganisationalUnitResource(TreeResourcePaginated):
             new_path = ','.join([obj.get('path'), str(old_obj[self.key])])
             old_path = ','.join([old_obj.get('path'), str(old_obj[self.key])])
 
-            children = self.collection.find({
-                'path': {
-                    '$regex': '^{0}'.format(old_path)
-                }
-            })
-            for child in children:
-                old_child_path = child['path']
-                new_child_path = str(old_child_path).replace(old_path,
-                                                             new_path)
-                self.collection.update_one({
-                    self.key: child[self.key]
-                }, {
-                    '$set': {
-                        'path': new_child_path
-                    }
-                })
+            updated = self.update_children_path(old_obj[self.key], old_path,
+                                                new_path)
+            logger.info("organisationalunits.py ::: post_save - %d children "
+                        "of the OU %s updated", updated, old_obj[self.key])
         elif self.request.method == 'POST' and is_domain(obj):
             obj['master'] = MASTER_DEFAULT
             obj['master_policies'] = {}
@@ -11,9 +11,10 @@
 
 from cornice.resource import resource
 
-from gecoscc.api import PassiveResourcePaginated
+from gecoscc.api import PassiveResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import Printer, Printers
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 
 
 @resource(collection_path='/api/printers/',
@@ -24,6 +25,8 @@ class PrinterResource(PassiveResourcePaginated):
 
     schema_collection = Printers
     schema_detail = Printer
+    collection_fields = get_schema_fields(Printers,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'printer'
 
     mongo_filter = {
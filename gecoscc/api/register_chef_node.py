@@ -17,12 +17,11 @@ from cornice.resource import resource
 
 from pyramid.threadlocal import get_current_registry
 
-from chef import ChefAPI
 from chef import Node as ChefNode
 from chef import Client as ChefClient
 
 from gecoscc.permissions import http_basic_login_required
-from gecoscc.utils import get_chef_api
+from gecoscc.utils import PooledChefAPI, get_chef_api
 
 
 @resource(path='/register/node/',
@@ -54,7 +53,7 @@ class RegisterChefNode(object):
         chef_ssl_verify = settings.get('chef.ssl.verify')
         if chef_ssl_verify == 'False' or chef_ssl_verify == 'True':
             chef_ssl_verify = bool(chef_ssl_verify)
-        api = ChefAPI(chef_url, chef_client.private_key.encode(), node_id, chef_version, ssl_verify = False)
+        api = PooledChefAPI(chef_url, chef_client.private_key.encode(), node_id, chef_version, ssl_verify = False)
 
  
         # create chef node
@@ -19,7 +19,11 @@ from pyramid.threadlocal import get_current_registry
 from gecoscc.api import BaseAPI
 from gecoscc.models import Node as MongoNode
 from gecoscc.permissions import http_basic_login_required
-from gecoscc.utils import get_chef_api, register_node, apply_policies_to_computer
+from gecoscc.utils import (get_chef_api, register_node, apply_policies_to_computer,
+                           update_emitters_index_of_node,
+                           update_computer_users_index,
+                           invalidate_reports_of_node,
+                           delete_computer_log_files)
 from gecoscc.socks import delete_computer, update_tree, invalidate_change, invalidate_delete 
 from gecoscc.eventsmanager import JobStorage
 
@@ -67,6 +71,9 @@ class RegisterComputerResource(BaseAPI):
                     'message': 'Unable to add gecos path ids and names to chef node'}            
 
         computer = self.collection.find_one({'_id': computer_id})
+        update_emitters_index_of_node(self.request.db, computer)
+        update_computer_users_index(self.request.db, computer_id)
+        invalidate_reports_of_node(self.request.db, computer)
         apply_policies_to_computer(self.collection, computer, self.request.user)
         update_tree(computer['path'])
         return {'ok': True}
@@ -97,12 +104,22 @@ class RegisterComputerResource(BaseAPI):
             logger.info("/register/computer: Removing computer %s relationship from user %s" % (str(computer['_id']), str(user['_id'])))
             self.collection.update_one({'_id': user['_id']},
                 {'$pull': { 'computers': computer['_id'] }})
+            invalidate_reports_of_node(self.request.db,
+                dict(user, computers=[c for c in user['computers']
+                                      if c != computer['_id']]), user)
         
         # Delete the computer node
         node_deleted = self.collection.delete_one({'node_chef_id': node_id,
             'type': 'computer'})
         num_node_deleted = node_deleted.deleted_count
         if num_node_deleted >= 1:
+            update_emitters_index_of_node(self.request.db, computer,
+                                          deleted=True)
+            invalidate_reports_of_node(self.request.db, computer,
+                                       deleted=True)
+            self.request.db.ohai_snapshots.delete_one({'_id': computer['_id']})
+            delete_computer_log_files(self.request.db,
+                                      computer.get('logs', {}).get('files', []))
             # Create a job so the administrator can see the 'detached' action
             job_storage = JobStorage(self.request.db.jobs, self.request.user)
             job_storage.create(obj=computer,
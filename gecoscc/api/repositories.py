@@ -12,9 +12,10 @@
 
 from cornice.resource import resource
 
-from gecoscc.api import PassiveResourcePaginated
+from gecoscc.api import PassiveResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import Repository, Repositories
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 
 
 @resource(collection_path='/api/repositories/',
@@ -25,6 +26,8 @@ class RepositoryResource(PassiveResourcePaginated):
 
     schema_collection = Repositories
     schema_detail = Repository
+    collection_fields = get_schema_fields(Repositories,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'repository'
 
     mongo_filter = {
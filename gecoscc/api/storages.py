@@ -12,9 +12,10 @@
 
 from cornice.resource import resource
 
-from gecoscc.api import PassiveResourcePaginated
+from gecoscc.api import PassiveResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import Storage, Storages
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 
 
 @resource(collection_path='/api/storages/',
@@ -25,6 +26,8 @@ class StorageResource(PassiveResourcePaginated):
 
     schema_collection = Storages
     schema_detail = Storage
+    collection_fields = get_schema_fields(Storages,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'storage'
 
     mongo_filter = {
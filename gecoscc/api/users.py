@@ -14,9 +14,10 @@ from cornice.resource import resource
 
 from bson import ObjectId
 
-from gecoscc.api import TreeLeafResourcePaginated
+from gecoscc.api import TreeLeafResourcePaginated, NODE_DETAIL_FIELDS
 from gecoscc.models import User, Users
 from gecoscc.permissions import api_login_required
+from gecoscc.serializers import get_schema_fields
 from gecoscc.utils import get_inheritance_tree_policies_list
 
 
@@ -28,6 +29,8 @@ class UserResource(TreeLeafResourcePaginated):
 
     schema_collection = Users
     schema_detail = User
+    collection_fields = get_schema_fields(Users,
+                                          exclude=NODE_DETAIL_FIELDS)
     objtype = 'user'
 
     mongo_filter = {
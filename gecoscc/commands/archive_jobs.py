@@ -0,0 +1,58 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from optparse import make_option
+
+from gecoscc.eventsmanager import archive_old_jobs, drop_expired_jobs_archives
+from gecoscc.management import BaseCommand
+
+
+class Command(BaseCommand):
+    description = """
+       Move the archived or finished jobs older than "jobs.archive_age" days
+       to the jobs archive, and drop the archive collections of the jobs
+       created more than "jobs.archive_expiration" months ago.
+
+       The archive_jobs task of Celery beat does the same every day.
+    """
+
+    usage = ("usage: %prog config_uri archive_jobs [--age days] "
+             "[--expiration months]")
+
+    option_list = [
+        make_option(
+            '-a', '--age',
+            dest='age',
+            action='store',
+            type='int',
+            help='Age in days of the moved jobs (default: jobs.archive_age)'
+        ),
+        make_option(
+            '-e', '--expiration',
+            dest='expiration',
+            action='store',
+            type='int',
+            help='Age in months of the dropped archive collections '
+                 '(default: jobs.archive_expiration)'
+        ),
+    ]
+
+    def command(self):
+        age = self.options.age
+        if age is None:
+            age = int(self.settings.get('jobs.archive_age', 0))
+        expiration = self.options.expiration
+        if expiration is None:
+            expiration = int(self.settings.get('jobs.archive_expiration', 0))
+
+        if age > 0:
+            moved = archive_old_jobs(self.db, age)
+            print("%d jobs moved to the archive" % moved)
+        if expiration > 0:
+            for name in drop_expired_jobs_archives(self.db, expiration):
+                print("%s dropped" % name)
@@ -18,13 +18,12 @@ from copy import deepcopy
 from chef.exceptions import ChefServerNotFoundError
 from chef import Node as ChefNode
 from optparse import make_option
-from distutils.version import LooseVersion
 
 from gecoscc.management import BaseCommand
 from gecoscc.utils import (_get_chef_api, toChefUsername, 
                            trace_inheritance, order_groups_by_depth,
                            check_unique_node_name_by_type_at_domain,
-                           is_domain, get_domain, is_root)
+                           is_domain, get_domain, is_root, get_cached_cookbook)
 from gecoscc.rules import get_username_chef_format
 from bson.objectid import ObjectId
 from gecoscc.models import Policy
@@ -100,53 +99,20 @@ class Command(BaseCommand):
             
         return None     
     
-    def get_chef_url(self, url):
-        url = url[url.index('://')+3:]
-        url = url[url.index('/'):]
-            
-        print("url=", url)
-        data = None
-        try:
-            data = self.api[url]
-        except ChefServerNotFoundError:
-            pass              
-        
-        return data
-    
     def get_default_data(self, dotted_keys):
-        # Get gecos_ws_mgmt cookbook version
+        # Get gecos_ws_mgmt cookbook data (last version)
         data = None
         try:
-            data = self.api['/organizations/default/cookbooks/gecos_ws_mgmt']
+            data = get_cached_cookbook(self.api, 'gecos_ws_mgmt')
         except ChefServerNotFoundError:
-            pass              
-        
-        if (data is None) or (not "gecos_ws_mgmt" in data) or (
-            not "versions" in data["gecos_ws_mgmt"]):
-            logger.error('Can\'t get version for gecos_ws_mgmt cookbook!')
-            return None
-            
-        last_version_number = ''
-        last_version_url = ''
-        for ver in data["gecos_ws_mgmt"]["versions"]:
-            if last_version_number == '':
-                last_version_number = ver['version']
-                last_version_url = ver['url']
-            elif  LooseVersion(last_version_number) < LooseVersion(
-                ver['version']):
-                last_version_number = ver['version']
-                last_version_url = ver['url']
-            
-        if last_version_number == '':
-            logger.error('Can\'t find last version number!')
-            return None
-            
-        logger.info("Cookbook version: %s"%(last_version_number))
-        data = self.get_chef_url(last_version_url)
+            pass
+
         if data is None:
             logger.error('Can\'t get data for gecos_ws_mgmt cookbook!')
             return None
 
+        logger.info("Cookbook version: %s"%(data.get('version')))
+
         if not "attributes" in data:
             logger.error('gecos_ws_mgmt cookbook data doesn\'t contain '
                          'attributes!')
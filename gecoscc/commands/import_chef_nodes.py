@@ -58,6 +58,7 @@ class Command(BaseCommand):
         else:
             data.update({'extra': '',
                          'path': 'root',
+                         'ancestors': ['root'],
                          'lock': False,
                          'policies': {},
                          'source': SOURCE_DEFAULT})
@@ -20,7 +20,7 @@ from gecoscc.management import BaseCommand
 from gecoscc.rules import EXCLUDE_GENERIC_ATTRS, is_user_policy
 from gecoscc.utils import (_get_chef_api, get_cookbook,
                            RESOURCES_EMITTERS_TYPES, emiter_police_slug,
-                           toChefUsername)
+                           toChefUsername, invalidate_policies_cache)
 
 
 DEFAULT_TARGETS = ['ou', 'computer', 'group']
@@ -322,6 +322,9 @@ class Command(BaseCommand):
                         
         if not found:
             print("There are no deprecated policies")
+
+        # Running processes must reload the policies
+        invalidate_policies_cache(self.db)
         
 
     def set_packages_url(self, value):
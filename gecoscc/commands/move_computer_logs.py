@@ -0,0 +1,41 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from gecoscc.management import BaseCommand
+from gecoscc.utils import save_computer_log_file
+
+
+class Command(BaseCommand):
+    description = """
+       Move the log files stored inside the computer nodes to the
+       computer logs store.
+    """
+
+    usage = "usage: %prog config_uri move_computer_logs"
+
+    def command(self):
+        db = self.pyramid.db
+
+        computers = db.nodes.find({'type': 'computer',
+                                   'logs.files.content': {'$exists': True}},
+                                  {'logs': True})
+        moved = 0
+        for computer in computers:
+            files = []
+            for filedata in computer['logs'].get('files', []):
+                if 'content' in filedata:
+                    filedata = save_computer_log_file(
+                        db, computer['_id'], filedata['filename'],
+                        filedata['content'])
+                files.append(filedata)
+
+            db.nodes.update_one({'_id': computer['_id']},
+                                {'$set': {'logs.files': files}})
+            moved += 1
+
+        print("%d computers updated" % moved)
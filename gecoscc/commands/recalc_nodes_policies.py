@@ -19,8 +19,7 @@ from bson import ObjectId
 
 from gecoscc.management import BaseCommand
 from gecoscc.utils import get_chef_api, recalc_node_policies, get_filter_this_domain,\
-    get_cookbook
-from jsonschema.validators import validator_for
+    get_cached_cookbook, get_cookbook_validator
 
 
 class Command(BaseCommand):
@@ -98,12 +97,10 @@ class Command(BaseCommand):
         results_error = {}
         results_succes = {}
         # Get the cookbook
-        cookbook = get_cookbook(api, cookbook_name)
-        schema = cookbook['metadata']['attributes']['json_schema']['object']
-        
-        # Validate the cookbook schema
-        validator = validator_for(schema)
-        validator.check_schema(schema)
+        cookbook = get_cached_cookbook(api, cookbook_name)
+
+        # Validate the cookbook schema (only once for all the computers)
+        validator = get_cookbook_validator(cookbook)
         
         for i, comp in enumerate(list(computers)):
             if i % step == 0:
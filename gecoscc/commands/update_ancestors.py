@@ -0,0 +1,43 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from optparse import make_option
+
+from gecoscc.management import BaseCommand
+
+
+class Command(BaseCommand):
+    description = """
+       Calculate the "ancestors" field of the nodes from its "path" field.
+    """
+
+    usage = "usage: %prog config_uri update_ancestors [--all]"
+
+    option_list = [
+        make_option(
+            '-a', '--all',
+            dest='all',
+            action='store_true',
+            default=False,
+            help='Recalculate the field in all the nodes (not only the '
+                 'nodes without it)'
+        ),
+    ]
+
+    def command(self):
+        db = self.pyramid.db
+
+        node_filter = {'path': {'$type': 'string'}}
+        if not self.options.all:
+            node_filter['ancestors'] = {'$exists': False}
+
+        # The split is done by MongoDB, so the nodes are never read
+        result = db.nodes.update_many(node_filter, [
+            {'$set': {'ancestors': {'$split': ['$path', ',']}}}
+        ])
+        print("%d nodes updated" % result.modified_count)
@@ -0,0 +1,23 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from gecoscc.management import BaseCommand
+from gecoscc.utils import build_emitters_index
+
+
+class Command(BaseCommand):
+    description = """
+       Build the index of the nodes and computers related with each printer,
+       storage and repository. The reports walk the nodes until it is built.
+    """
+
+    usage = "usage: %prog config_uri update_emitters_index"
+
+    def command(self):
+        emitters = build_emitters_index(self.pyramid.db)
+        print("%d emitters indexed" % emitters)
@@ -0,0 +1,40 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from optparse import make_option
+
+from gecoscc.db import INDEXES_VERSION
+from gecoscc.management import BaseCommand
+
+
+class Command(BaseCommand):
+    description = """
+       Create the indexes of the database if they were not created with the
+       current version of their definitions.
+
+       This is also done when the application starts, so this command is
+       only needed to create the indexes before a deployment.
+    """
+
+    usage = "usage: %prog config_uri update_indexes [--force]"
+
+    option_list = [
+        make_option(
+            '-f', '--force',
+            dest='force',
+            action='store_true',
+            default=False,
+            help='Create the indexes even if they are up to date'
+        ),
+    ]
+
+    def command(self):
+        if self.settings['mongodb'].update_indexes(self.options.force):
+            print("Indexes created (version %d)" % INDEXES_VERSION)
+        else:
+            print("Indexes up to date (version %d)" % INDEXES_VERSION)
@@ -0,0 +1,31 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from gecoscc.eventsmanager import JOB_SEARCH_FIELDS
+from gecoscc.management import BaseCommand
+
+
+class Command(BaseCommand):
+    description = """
+       Calculate the "search" field of the jobs, with the lowercase copies
+       of the fields searched in the jobs panel.
+    """
+
+    usage = "usage: %prog config_uri update_jobs_search"
+
+    def command(self):
+        db = self.pyramid.db
+
+        # The lowercase copies are calculated by MongoDB, so the jobs are
+        # never read
+        search = dict((field, {'$toLower': '$%s' % field})
+                      for field in JOB_SEARCH_FIELDS)
+        result = db.jobs.update_many({'search': {'$exists': False}}, [
+            {'$set': {'search': search}}
+        ])
+        print("%d jobs updated" % result.modified_count)
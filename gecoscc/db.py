@@ -23,6 +23,10 @@ DEFAULT_MONGODB_URI = 'mongodb://%s:%d/%s' % (DEFAULT_MONGODB_HOST,
                                               DEFAULT_MONGODB_PORT,
                                               DEFAULT_MONGODB_NAME)
 
+# Version of the indexes created by MongoDB.indexes. It must be increased
+# when an index is added or changed, so it is created in the next start up
+INDEXES_VERSION = 2
+
 # Simulates mongodump --excludeCollection option (new in version 3.0)
 # Excludes the specified collections from the mongodump output
 DEFAULT_EXCLUDE_COLLECTIONS = ['updates','backer_cache']
@@ -48,6 +52,7 @@ class MongoDB(object):
         self.factory = connection_factory
         self.factory_args = kwargs
         self.connection = None
+        self.databases = {}
 
         if self.parsed_uri.get("database", None):
             self.database_name = self.parsed_uri["database"]
@@ -65,9 +70,12 @@ class MongoDB(object):
 
     def get_database(self, database_name=None):
         if database_name is None:
-            db = self.get_connection()[self.database_name]
-        else:
-            db = self.get_connection()[database_name]
+            database_name = self.database_name
+        db = self.databases.get(database_name)
+        if db is not None:
+            return db
+
+        db = self.get_connection()[database_name]
         if self.parsed_uri.get("username", None):
             db.authenticate(
                 self.parsed_uri.get("username", None),
@@ -75,9 +83,30 @@ class MongoDB(object):
             )
         # Patch a strange Python 3 error by getting the collection names
         db.collection_names()
-        self.indexes(db)
+        self.databases[database_name] = db
         return db
 
+    def update_indexes(self, force=False):
+        '''
+        Create the indexes if they were not created with the current
+        INDEXES_VERSION. This is done when the application starts and by the
+        "update_indexes" command, never by the requests or the tasks.
+
+        Returns True if the indexes were created.
+        '''
+        db = self.get_database()
+        version = db.data_versions.find_one({'_id': 'indexes'})
+        if (not force and version is not None and
+                version['version'] >= INDEXES_VERSION):
+            return False
+
+        logger.info("Creating indexes (version %d)" % INDEXES_VERSION)
+        self.indexes(db)
+        db.data_versions.update_one({'_id': 'indexes'},
+                                    {'$set': {'version': INDEXES_VERSION}},
+                                    upsert=True)
+        return True
+
     def indexes(self, db):
         db.nodes.create_index([
             ('node_chef_id', pymongo.DESCENDING),
@@ -86,6 +115,10 @@ class MongoDB(object):
             ('path', pymongo.DESCENDING),
             ('type', pymongo.DESCENDING),
         ])
+        db.nodes.create_index([
+            ('ancestors', pymongo.ASCENDING),
+            ('type', pymongo.ASCENDING),
+        ])
         # TODO: this try/except will be removed in review release
         try:
             db.nodes.create_index([
@@ -102,6 +135,55 @@ class MongoDB(object):
         db.jobs.create_index([
             ('userid', pymongo.DESCENDING),
         ])
+        # Jobs panel of an administrator and its statistics
+        db.jobs.create_index([
+            ('administrator_username', pymongo.ASCENDING),
+            ('archived', pymongo.ASCENDING),
+            ('parent', pymongo.ASCENDING),
+            ('status', pymongo.ASCENDING),
+            ('_id', pymongo.DESCENDING),
+        ])
+        # Jobs panel with all the jobs, children of a macrojob and statistics
+        db.jobs.create_index([
+            ('parent', pymongo.ASCENDING),
+            ('status', pymongo.ASCENDING),
+            ('_id', pymongo.DESCENDING),
+        ])
+        # Prefix searches of the jobs panel
+        db.jobs.create_index([
+            ('search.administrator_username', pymongo.ASCENDING),
+            ('parent', pymongo.ASCENDING),
+        ])
+        db.jobs.create_index([
+            ('search.objname', pymongo.ASCENDING),
+            ('parent', pymongo.ASCENDING),
+        ])
+        db.jobs.create_index([
+            ('search.computername', pymongo.ASCENDING),
+            ('parent', pymongo.ASCENDING),
+        ])
+        # Processing jobs of a computer
+        db.jobs.create_index([
+            ('computerid', pymongo.ASCENDING),
+            ('status', pymongo.ASCENDING),
+        ])
+
+        # Users of a computer
+        db.nodes.create_index('computers', sparse=True)
+        # Emitters index (see gecoscc.utils.update_emitters_index_of_node)
+        db.emitters_index.create_index('nodes')
+        db.related_computers_index.create_index('nodes')
+        db.related_computers_index.create_index('computers')
+
+        # Expired reservations of chef nodes are removed by MongoDB
+        db.node_leases.create_index('exp_date', expireAfterSeconds=0)
+
+        db.report_artifacts.create_index([
+            ('report_type', pymongo.ASCENDING),
+            ('format', pymongo.ASCENDING),
+            ('ou_id', pymongo.ASCENDING),
+            ('locale', pymongo.ASCENDING),
+        ])
         
         languages = ['en_US', 'es']
         for lang in languages:
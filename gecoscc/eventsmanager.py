@@ -12,8 +12,12 @@
 
 import logging
 
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 
+import pymongo
+
+from pymongo.errors import BulkWriteError, CollectionInvalid
 from pyramid.threadlocal import get_current_registry
 
 from gecoscc.models import JOB_STATUS
@@ -24,6 +28,25 @@ CHANNELS = {
     'admin': ('admin', ),
 }
 
+# Fields of the jobs searched in the jobs panel
+JOB_SEARCH_FIELDS = ('administrator_username', 'objname', 'computername')
+
+
+# The old jobs are moved to a collection by month of creation
+JOBS_ARCHIVE_PREFIX = 'jobs_archive_'
+JOBS_ARCHIVE_STORAGE = {'wiredTiger': {'configString': 'block_compressor=zstd'}}
+JOBS_ARCHIVE_BATCH_SIZE = 500
+DUPLICATE_KEY_ERROR = 11000
+
+
+def get_job_search_fields(job):
+    '''
+    Lowercase copies of the searched fields of a job, so the searches are
+    prefix matches that can use an index.
+    '''
+    return dict((field, (job.get(field) or '').lower())
+                for field in JOB_SEARCH_FIELDS)
+
 
 class JobStorage(object):
 
@@ -102,9 +125,11 @@ class JobStorage(object):
             'last_update': datetime.utcnow(),
             'archived': False,
             'parent': parent,
-            'childs': childs,
-            'counter': counter
+            'childs': childs
         }
+        # A macrojob without counter is not updated by its children
+        if counter is not None:
+            job['counter'] = counter
         if policy:
             settings = get_current_registry().settings
             languages = settings.get('pyramid.locales')
@@ -115,6 +140,7 @@ class JobStorage(object):
                 job['policyname_%s' % lang] = policy.get('name_%s' % lang)
         if message:
             job['message'] = message
+        job['search'] = get_job_search_fields(job)
         return self.collection.insert_one(job).inserted_id
 
     def update_status(self, jobid, status):
@@ -161,6 +187,135 @@ def get_jobstorage(request):
     return JobStorage(request.db.jobs, user)
 
 
+# Utils of the jobs archive
+
+def get_jobs_archive_name(oid):
+    '''
+    Name of the archive collection of a job (or of the children of a
+    macrojob) from the creation date of its ObjectId.
+    '''
+    return '%s%s' % (JOBS_ARCHIVE_PREFIX, oid.generation_time.strftime('%Y_%m'))
+
+
+def get_jobs_archive_names(db):
+    '''
+    Names of the archive collections, from the newest to the oldest.
+    '''
+    names = db.list_collection_names(
+        filter={'name': {'$regex': '^%s' % JOBS_ARCHIVE_PREFIX}})
+    return sorted(names, reverse=True)
+
+
+def get_jobs_archive(db, name):
+    '''
+    Get an archive collection, creating it compressed if it does not exist.
+    The indexes of the jobs panel are always created, because an execution
+    may have been interrupted after creating the collection.
+    '''
+    try:
+        db.create_collection(name, storageEngine=JOBS_ARCHIVE_STORAGE)
+    except CollectionInvalid:
+        # Already created
+        pass
+
+    archive = db[name]
+    archive.create_index([
+        ('administrator_username', pymongo.ASCENDING),
+        ('parent', pymongo.ASCENDING),
+        ('_id', pymongo.DESCENDING),
+    ])
+    archive.create_index([
+        ('parent', pymongo.ASCENDING),
+        ('_id', pymongo.DESCENDING),
+    ])
+    for field in JOB_SEARCH_FIELDS:
+        archive.create_index([
+            ('search.%s' % field, pymongo.ASCENDING),
+            ('parent', pymongo.ASCENDING),
+        ])
+    return archive
+
+
+def archive_old_jobs(db, age, batch_size=JOBS_ARCHIVE_BATCH_SIZE):
+    '''
+    Move the archived or finished macrojobs whose last update is older than
+    "age" days, with their children, to the archive collections. The jobs
+    are marked as archived, so the finished jobs move from the jobs of the
+    jobs panel to its archived jobs.
+
+    The macrojobs with a child in process are not moved. Returns the number
+    of moved jobs.
+    '''
+    cutoff = datetime.utcnow() - timedelta(days=age)
+    macrojobs_filter = {
+        'parent': None,
+        'status': {'$ne': 'processing'},
+        'last_update': {'$lt': cutoff},
+        '$or': [{'archived': True}, {'status': 'finished'}]
+    }
+
+    moved = 0
+    archives = {}
+    last_id = None
+    while True:
+        if last_id is not None:
+            macrojobs_filter['_id'] = {'$gt': last_id}
+        macrojob_ids = [macrojob['_id'] for macrojob in db.jobs.find(
+            macrojobs_filter, {'_id': True}).sort('_id').limit(batch_size)]
+        if not macrojob_ids:
+            break
+        last_id = macrojob_ids[-1]
+
+        families = defaultdict(list)
+        for job in db.jobs.find({'$or': [{'_id': {'$in': macrojob_ids}},
+                                         {'parent': {'$in': macrojob_ids}}]}):
+            families[job.get('parent') or job['_id']].append(job)
+
+        buckets = defaultdict(list)
+        for macrojob_id, jobs in families.items():
+            if any(job['status'] == 'processing' for job in jobs):
+                continue
+            for job in jobs:
+                job['archived'] = True
+                buckets[get_jobs_archive_name(macrojob_id)].append(job)
+
+        for name, jobs in buckets.items():
+            if name not in archives:
+                archives[name] = get_jobs_archive(db, name)
+            try:
+                archives[name].insert_many(jobs, ordered=False)
+            except BulkWriteError as e:
+                # Jobs already copied by an interrupted execution
+                if any(error['code'] != DUPLICATE_KEY_ERROR
+                       for error in e.details['writeErrors']):
+                    raise
+            result = db.jobs.delete_many(
+                {'_id': {'$in': [job['_id'] for job in jobs]}})
+            moved += result.deleted_count
+
+    logger.info('eventsmanager.py ::: archive_old_jobs - %d jobs moved' %
+                moved)
+    return moved
+
+
+def drop_expired_jobs_archives(db, months):
+    '''
+    Drop the archive collections of the jobs created more than "months"
+    months ago. Returns the names of the dropped collections.
+    '''
+    now = datetime.utcnow()
+    month = now.year * 12 + now.month - 1 - months
+    oldest_name = '%s%04d_%02d' % (JOBS_ARCHIVE_PREFIX, month // 12,
+                                   month % 12 + 1)
+    dropped = [name for name in get_jobs_archive_names(db)
+               if name < oldest_name]
+    for name in dropped:
+        db.drop_collection(name)
+        logger.info('eventsmanager.py ::: drop_expired_jobs_archives - %s' %
+                    name)
+    return dropped
+
+
 class ExpiredSessionEvent(object):
     def __init__(self, request):
         self.request = request
@@ -30,7 +30,7 @@ from gecoscc import messages
 from gecoscc.tasks import script_runner
 from gecoscc.i18n import gettext as _
 from gecoscc.utils import get_chef_api, create_chef_admin_user,\
-    BASE_UPDATE_PATTERN
+    invalidate_reports_cache, BASE_UPDATE_PATTERN
 from gecoscc.socks import maintenance_mode
 import traceback
 
@@ -147,6 +147,7 @@ class AdminUserEditForm(BaseAdminUserForm):
             del admin_user['password']
         self.collection.update_one({'username': self.username},
                                {'$set': admin_user})
+        invalidate_reports_cache(self.request.db, ('permission',))
         if admin_user['username'] != self.username and self.request.session['auth.userid'] == self.username:
             self.request.session['auth.userid'] = admin_user['username']
         self.created_msg(_('User edited successfully'))
@@ -188,6 +189,7 @@ class PermissionsForm(GecosForm):
                 }
             }
         )
+        invalidate_reports_cache(self.request.db, ('permission',))
         self.created_msg(_('User edited successfully'))
 
 
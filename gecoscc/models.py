@@ -1070,7 +1070,11 @@ class Job(colander.MappingSchema):
                                   missing=0)
     op = colander.SchemaNode(colander.String(),
                              validator=colander.OneOf(
-                                 ['created', 'changed', 'deleted']))
+                                 ['created', 'changed', 'deleted', 'report']))
+    # Id of the file of a report generated in background
+    report = colander.SchemaNode(colander.String(),
+                                 default='',
+                                 missing='')
 
     created = colander.SchemaNode(colander.DateTime())
     last_update = colander.SchemaNode(colander.DateTime())
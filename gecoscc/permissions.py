@@ -22,7 +22,8 @@ from pyramid.security import (Allow, Deny, Authenticated, Everyone, ALL_PERMISSI
 
 
 from gecoscc.userdb import UserDoesNotExist
-from gecoscc.utils import is_domain, get_domain, is_local_user, MASTER_DEFAULT, RESOURCES_EMITTERS_TYPES
+from gecoscc.utils import (is_domain, get_domain, is_local_user, get_filter_nodes_belonging_ous,
+                           MASTER_DEFAULT, RESOURCES_EMITTERS_TYPES)
 
 logger = logging.getLogger(__name__)
 
@@ -172,9 +173,7 @@ def nodes_path_filter(request, ou_type='ou_managed'):
         elif path is None and ou_managed_ids:
             filters = [
                 {
-                    'path': {
-                        '$regex': '.*%s.*' % '|'.join(ou_managed_ids)
-                    }
+                    'ancestors': get_filter_nodes_belonging_ous(ou_managed_ids)
                 }, {
                     '_id': {'$in': [ObjectId(ou_managed_id) for ou_managed_id in ou_managed_ids]}
                 }
@@ -194,7 +193,7 @@ def nodes_path_filter(request, ou_type='ou_managed'):
 def user_nodes_filter(request, ou_type='ou_managed'):
     ou_managed_ids = request.user.get(ou_type, [])
     if ou_managed_ids:
-        return {'path': {'$regex': '.*%s.*' % '|'.join(ou_managed_ids)}}
+        return {'ancestors': get_filter_nodes_belonging_ous(ou_managed_ids)}
     elif request.user.get('is_superuser'):
         return {}
     raise HTTPForbidden()
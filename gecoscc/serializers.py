@@ -0,0 +1,257 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+import datetime
+
+import colander
+
+from bson import ObjectId
+
+from gecoscc.models import ObjectIdField
+
+# Compiled serializers and fields, by schema class
+serializers_cache = {}
+fields_cache = {}
+
+
+class UnexpectedValue(Exception):
+    pass
+
+
+def get_schema_fields(schema_class, exclude=()):
+    '''
+    Top-level fields of the items of a sequence schema, so only those fields
+    are read from MongoDB. The "exclude" fields are left out. None when the
+    items keep their unknown fields (all the fields are needed).
+    '''
+    if schema_class not in fields_cache:
+        fields = None
+        schema = schema_class()
+        if isinstance(schema.typ, colander.Sequence):
+            item = schema.children[0]
+            if (isinstance(item.typ, colander.Mapping) and
+                    item.typ.unknown != 'preserve'):
+                fields = [child.name for child in item.children]
+        fields_cache[schema_class] = fields
+    fields = fields_cache[schema_class]
+    if fields is None:
+        return None
+    return [field for field in fields if field not in exclude]
+
+
+def get_serializer(schema_class, fields=None):
+    '''
+    Fast serializer of a schema class. It is compiled the first time. When
+    "fields" is given, the items of the sequence schema only have those
+    fields.
+    '''
+    key = (schema_class, fields if fields is None else tuple(fields))
+    serializer = serializers_cache.get(key)
+    if serializer is None:
+        schema = schema_class()
+        if fields is not None:
+            # The children of a schema class are shared by its instances
+            schema = schema.clone()
+            item = schema.children[0]
+            for child in list(item.children):
+                if child.name not in fields:
+                    del item[child.name]
+        serializer = compile_serializer(schema)
+        serializers_cache[key] = serializer
+    return serializer
+
+
+def compile_serializer(schema):
+    '''
+    Compile a schema into plain functions that return the same result as its
+    serialize method, without the overhead of colander for each value. The
+    values that the compiled functions do not expect (i.e. invalid ones) are
+    serialized again by colander, which returns or raises the same as before.
+
+    The unknown values kept by "preserve" mappings (i.e. the policies of the
+    nodes) are not copied, so the result shares them with the serialized
+    object.
+    '''
+    serialize_fast = _compile_node(schema)
+
+    def serialize(appstruct=colander.null):
+        try:
+            return serialize_fast(appstruct)
+        except UnexpectedValue:
+            return schema.serialize(appstruct)
+
+    return serialize
+
+
+def _compile_node(node):
+    default = node.default
+    if isinstance(default, colander.deferred):
+        default = colander.null
+    serialize_type = _compile_type(node)
+
+    def serialize(appstruct):
+        if appstruct is colander.null:
+            appstruct = default
+        return serialize_type(appstruct)
+
+    return serialize
+
+
+def _compile_type(node):
+    typ = node.typ
+    method = getattr(type(typ), 'serialize', None)
+
+    if method is colander.Mapping.serialize:
+        return _compile_mapping(node)
+    if method is colander.Sequence.serialize:
+        return _compile_sequence(node)
+    if method is colander.String.serialize and not typ.encoding:
+        return _serialize_string
+    if method is colander.Number.serialize:
+        return _compile_number(typ)
+    if method is colander.Boolean.serialize:
+        return _compile_boolean(typ)
+    if method is colander.DateTime.serialize:
+        return _compile_datetime(typ)
+    if method is ObjectIdField.serialize:
+        return _compile_objectid(node)
+
+    # Any other type is serialized by itself
+    def serialize(appstruct):
+        try:
+            return typ.serialize(node, appstruct)
+        except colander.Invalid:
+            # Raised again by colander for the whole schema
+            raise UnexpectedValue()
+    return serialize
+
+
+def _compile_mapping(node):
+    null = colander.null
+    drop = colander.drop
+    children = [(child.name, _compile_node(child), child.default is drop)
+                for child in node.children]
+    names = set(child.name for child in node.children)
+    unknown = node.typ.unknown
+
+    def serialize(appstruct):
+        if appstruct is null:
+            appstruct = {}
+        elif not isinstance(appstruct, dict):
+            raise UnexpectedValue()
+
+        result = {}
+        for name, serialize_child, drop_default in children:
+            value = appstruct.get(name, null)
+            if value is drop or (value is null and drop_default):
+                continue
+            value = serialize_child(value)
+            if value is not drop:
+                result[name] = value
+
+        if unknown != 'ignore':
+            unknown_values = dict((name, value) for name, value in
+                                  appstruct.items() if name not in names)
+            if unknown == 'raise' and unknown_values:
+                raise UnexpectedValue()
+            result.update(unknown_values)
+        return result
+
+    return serialize
+
+
+def _compile_sequence(node):
+    null = colander.null
+    drop = colander.drop
+    serialize_child = _compile_node(node.children[0])
+    drop_default = node.children[0].default is drop
+
+    def serialize(appstruct):
+        if appstruct is null:
+            return null
+        if not isinstance(appstruct, (list, tuple)):
+            raise UnexpectedValue()
+
+        result = []
+        for value in appstruct:
+            if value is drop or (value is null and drop_default):
+                continue
+            value = serialize_child(value)
+            if value is not drop:
+                result.append(value)
+        return result
+
+    return serialize
+
+
+def _serialize_string(appstruct):
+    if appstruct is colander.null:
+        return colander.null
+    if isinstance(appstruct, str):
+        return appstruct
+    return str(appstruct)
+
+
+def _compile_number(typ):
+    num = typ.num
+
+    def serialize(appstruct):
+        if appstruct is colander.null or appstruct is None:
+            return colander.null
+        try:
+            return str(num(appstruct))
+        except Exception:
+            raise UnexpectedValue()
+
+    return serialize
+
+
+def _compile_boolean(typ):
+    true_val = typ.true_val
+    false_val = typ.false_val
+
+    def serialize(appstruct):
+        if appstruct is colander.null:
+            return colander.null
+        return appstruct and true_val or false_val
+
+    return serialize
+
+
+def _compile_datetime(typ):
+    default_tzinfo = typ.default_tzinfo
+    format = typ.format
+
+    def serialize(appstruct):
+        if not appstruct:
+            return colander.null
+        if type(appstruct) is datetime.date:
+            appstruct = datetime.datetime.combine(appstruct, datetime.time())
+        if not isinstance(appstruct, datetime.datetime):
+            raise UnexpectedValue()
+        if appstruct.tzinfo is None:
+            appstruct = appstruct.replace(tzinfo=default_tzinfo)
+        if format:
+            return appstruct.strftime(format)
+        return appstruct.isoformat()
+
+    return serialize
+
+
+def _compile_objectid(node):
+    # The value of an empty id (null or drop, depending on the field)
+    empty = node.typ.serialize(node, colander.null)
+
+    def serialize(appstruct):
+        if not appstruct or appstruct is colander.null:
+            return empty
+        if not isinstance(appstruct, ObjectId):
+            raise UnexpectedValue()
+        return str(appstruct)
+
+    return serialize
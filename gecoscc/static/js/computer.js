@@ -808,7 +808,8 @@ App.module("Computer.Views", function (Views, App, Backbone, Marionette, $, _) {
                 $(this).find("button.close").click();
             });
             $(this.el).fadeOut(function () {
-                that.model.fetch().done(function () {
+                // Read the current data of the workstation from Chef
+                that.model.fetch({ data: { refresh: true } }).done(function () {
                     that.render();
                 }).done(function () {
                     $(that.el).fadeIn();
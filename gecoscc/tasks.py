@@ -22,32 +22,42 @@ import shutil
 import time
 
 from glob import glob
+from urllib.parse import urlencode
 from copy import deepcopy
 from bson import ObjectId
+from gevent.pool import Pool
+from pymongo import UpdateOne
 
 from chef import Node, Client
 from chef.node import NodeAttributes
 
+from celery import chord
 from celery.task import Task, task
 from celery.signals import task_prerun
 from celery.exceptions import Ignore
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError
+from jsonschema.exceptions import ValidationError, best_match
+from pyramid.events import NewRequest
+from pyramid.request import Request
+from pyramid.scripting import prepare
 from pyramid.threadlocal import get_current_registry
+from pyramid.threadlocal import manager as threadlocal_manager
 
 import gettext
 from gecoscc.models import User
 
-from gecoscc.eventsmanager import JobStorage
+from gecoscc.eventsmanager import (JobStorage, archive_old_jobs,
+                                   drop_expired_jobs_archives)
+from gecoscc.i18n import add_localizer
 from gecoscc.rules import get_rules, is_user_policy, get_username_chef_format, object_related_list
 from gecoscc.socks import invalidate_jobs, update_tree, invalidate_change, add_computer_to_user
 
 # Ignore unused import warning on "apply_policies_to_*" functions because 
 # "object_moved" function calls them
 
-from gecoscc.utils import (get_chef_api, get_cookbook,
-                           get_filter_nodes_belonging_ou, get_filter_in_domain,
-                           emiter_police_slug, get_computer_of_user,
+from gecoscc.utils import (get_chef_api, get_cached_cookbook, get_cookbook_validator,
+                           get_filter_nodes_belonging_ous,
+                           get_filter_in_domain, get_ancestors,
+                           emiter_police_slug,
                            delete_dotted, to_deep_dict, reserve_node_or_raise,
                            save_node_and_free, NodeBusyException, NodeNotLinked,
                            apply_policies_to_user, apply_policies_to_computer, apply_policies_to_group, apply_policies_to_ou,
@@ -58,7 +68,13 @@ from gecoscc.utils import (get_chef_api, get_cookbook,
                            order_groups_by_depth, order_ou_by_depth, move_in_inheritance_and_recalculate_policies,
                            recalculate_inherited_field, remove_group_from_inheritance_tree, add_group_to_inheritance_tree,
                            recalculate_inheritance_for_node, get_filter_ous_from_path, recalculate_policies_for_computers,
-                           add_path_attrs_to_node, setPathAttrsToNodeException)
+                           add_path_attrs_to_node, setPathAttrsToNodeException,
+                           get_policy, get_policy_by_slug, dequeue_chef_status_sync,
+                           acquire_chef_status_slot, release_chef_status_slot,
+                           CHEF_STATUS_SYNC_MAX_RETRIES,
+                           get_reports_data_version, invalidate_reports_of_node,
+                           save_ohai_snapshot, update_emitters_index_of_node,
+                           update_computer_users_index, delete_computer_log_files)
 
 
 DELETED_POLICY_ACTION = 'deleted'
@@ -101,102 +117,102 @@ class ChefTask(Task):
         else:
             self.jid = text_type(ObjectId())
 
-    def walking_here(self, obj, related_objects):
+    def get_related_computers_of_users(self, users, related_computers, computer_keys):
         '''
-        Checks if an object is in the object related list else add it to the list
+        Get the related computers of a list of users with a single query.
+        Every computer is annotated with the user (see get_computer_of_user)
         '''
-        if related_objects is not None:
-            if obj not in related_objects:
-                related_objects.append(deepcopy(obj))
-            else:
-                return True
-        return False
-
-    def get_related_computers_of_computer(self, obj, related_computers, related_objects):
-        '''
-        Get the related computers of a computer
-        '''
-        if self.walking_here(obj, related_objects):
+        computer_ids = set()
+        for user in users:
+            computer_ids.update(user.get('computers', []))
+        if not computer_ids:
             return related_computers
-        related_computers.append(obj)
-        return related_computers
 
-    def get_related_computers_of_group(self, obj, related_computers, related_objects):
-        '''
-        Get the related computers of a group
-        '''
-        if self.walking_here(obj, related_objects):
-            return related_computers
-        for node_id in obj['members']:
-            node = self.db.nodes.find_one({'_id': node_id})
-            if node and node not in related_objects:
-                self.get_related_computers(node, related_computers, related_objects)
-        return related_computers
+        computers = {}
+        for computer in self.db.nodes.find({'_id': {'$in': list(computer_ids)}}):
+            computers[computer['_id']] = computer
 
-    def get_related_computers_of_ou(self, ou, related_computers, related_objects):
-        '''
-        Get the related computers of an OU
-        '''
-        if self.walking_here(ou, related_objects):
-            return related_computers
-        computers = self.db.nodes.find({'path': get_filter_nodes_belonging_ou(ou['_id']),
-                                        'type': 'computer'})
-        for computer in computers:
-            self.get_related_computers_of_computer(computer,
-                                                   related_computers,
-                                                   related_objects)
-
-        users = self.db.nodes.find({'path': get_filter_nodes_belonging_ou(ou['_id']),
-                                    'type': 'user'})
         for user in users:
-            self.get_related_computers_of_user(user,
-                                               related_computers,
-                                               related_objects)
-
-        groups = self.db.nodes.find({'path': get_filter_nodes_belonging_ou(ou['_id']),
-                                     'type': 'group'})
-        for group in groups:
-            self.get_related_computers_of_group(group,
-                                                related_computers,
-                                                related_objects)
-
-        return related_computers
-
-    def get_related_computers_of_emiters(self, obj, related_computers, related_objects):
-        '''
-        Get the related computers of emitter objects
-        '''
-        if self.walking_here(obj, related_objects):
-            return related_computers
-        object_related_list = get_object_related_list(self.db, obj)
-        for object_related in object_related_list:
-            self.get_related_computers(object_related, related_computers, related_objects)
+            for computer_id in user.get('computers', []):
+                computer = computers.get(computer_id)
+                # Sudoers
+                if computer is None or user['name'] in computer.get('sudoers', []):
+                    continue
+                key = (computer_id, user['_id'])
+                if key not in computer_keys:
+                    computer_keys.add(key)
+                    related_computers.append(dict(computer, user=user))
         return related_computers
 
-    def get_related_computers_of_user(self, obj, related_computers, related_objects):
-        '''
-        Get the related computer of User
-        '''
-        if self.walking_here(obj, related_objects):
-            return related_computers
-        return get_computer_of_user(self.db.nodes, obj, related_computers)
-
     def get_related_computers(self, obj, related_computers=None, related_objects=None):
         '''
-        Get the related computers with the objs
+        Get the related computers with the objs.
+
+        The nodes graph is walked breadth first: each wave of OUs, groups
+        and emitters is resolved with a few $in queries. related_objects
+        is the set of the visited node ids, so it can be shared by several
+        calls to avoid walking the same nodes twice.
         '''
         if related_objects is None:
-            related_objects = []
+            related_objects = set()
 
         if related_computers is None:
             related_computers = []
 
-        obj_type = obj['type']
+        computer_keys = set((c['_id'], c['user']['_id'] if 'user' in c else None)
+                            for c in related_computers)
+        wave = [obj]
+        while wave:
+            ou_ids = []
+            member_ids = []
+            users = []
+            related_nodes = []
+            for node in wave:
+                if node['_id'] in related_objects:
+                    continue
+                related_objects.add(node['_id'])
+
+                if node['type'] == 'computer':
+                    if (node['_id'], None) not in computer_keys:
+                        computer_keys.add((node['_id'], None))
+                        related_computers.append(node)
+                elif node['type'] == 'user':
+                    users.append(node)
+                elif node['type'] == 'group':
+                    member_ids.extend(node.get('members', []))
+                elif node['type'] == 'ou':
+                    ou_ids.append(node['_id'])
+                elif node['type'] in RESOURCES_EMITTERS_TYPES:
+                    related_nodes.extend(get_object_related_list(self.db, node))
+
+            self.get_related_computers_of_users(users, related_computers,
+                                                computer_keys)
+
+            wave = related_nodes
+            member_ids = [node_id for node_id in member_ids
+                          if node_id not in related_objects]
+            if member_ids:
+                wave.extend(self.db.nodes.find({'_id': {'$in': member_ids}}))
+            if ou_ids:
+                ou_filter = {'ancestors': get_filter_nodes_belonging_ous(ou_ids)}
+                wave.extend(self.db.nodes.find(
+                    dict(ou_filter, type={'$in': ['computer', 'user']})))
+                wave.extend(self.db.nodes.find(
+                    dict(ou_filter, type='group'),
+                    {'_id': 1, 'type': 1, 'members': 1}))
 
-        if obj['type'] in RESOURCES_EMITTERS_TYPES:
-            obj_type = 'emiters'
-        get_realted_computers_of_type = getattr(self, 'get_related_computers_of_%s' % obj_type)
-        return get_realted_computers_of_type(obj, related_computers, related_objects)
+        return related_computers
+
+    def refresh_emitters_index(self, obj, objold=None, deleted=False):
+        '''
+        Update the emitters index after a change in obj. An error in the index
+        is logged but never breaks the task that changed the node.
+        '''
+        try:
+            update_emitters_index_of_node(self.db, obj, objold, deleted)
+        except Exception as e:
+            self.log("error", "tasks.py ::: refresh_emitters_index - {0}".format(e))
+            self.log("error", traceback.format_exc())
 
     def is_updating_policies(self, obj, objold):
         '''
@@ -1361,7 +1377,7 @@ class ChefTask(Task):
                 rule_type = 'policies'
                 self.log('debug', 'task.py:: update_node - policies: {0}'.format(self.get_policies(rule_type, action, obj, objold)))
                 for policy_id, action in self.get_policies(rule_type, action, obj, objold):
-                    policy = self.db.policies.find_one({"_id": ObjectId(policy_id)})
+                    policy = get_policy(self.db, policy_id)
                     if action == DELETED_POLICY_ACTION:
                         rules, obj_ui = self.get_rules_and_object(rule_type, objold, node, policy)
                     else:
@@ -1374,7 +1390,7 @@ class ChefTask(Task):
         elif obj['type'] in RESOURCES_EMITTERS_TYPES:  # printer, storage, repository
             rule_type = 'save'
             if force_update or self.is_updated_node(obj, objold):
-                policy = self.db.policies.find_one({'slug': emiter_police_slug(obj['type'])})
+                policy = get_policy_by_slug(self.db, emiter_police_slug(obj['type']))
                 rules, obj_receptor = self.get_rules_and_object(rule_type, obj, node, policy)
                 node, updated = self.update_node_from_rules(rules, user, computer, obj, obj_receptor, objold, action, node, policy, rule_type, parent_id, job_ids_by_computer)
             return (node, updated)
@@ -1384,13 +1400,21 @@ class ChefTask(Task):
         Useful method, validate the DATABASES
         '''
         try:
-            schema = cookbook['metadata']['attributes']['json_schema']['object']
             instance = to_deep_dict(node.attributes)
             if validator is None:
-                validate(instance, schema)
-                
-            else:
+                # Raise the same error than jsonschema.validate but with the
+                # validator of the cookbook cache
+                validator = get_cookbook_validator(cookbook)
+                error = best_match(validator.iter_errors(instance))
+                if error is not None:
+                    raise error
+
+            elif isinstance(validator, type):
+                schema = cookbook['metadata']['attributes']['json_schema']['object']
                 validator(schema).validate(instance)
+
+            else:
+                validator.validate(instance)
                 
         except ValidationError as e:
             # Bugfix: Validation error "required property"
@@ -1496,6 +1520,195 @@ class ChefTask(Task):
             job['computer'] = computer
         job_storage.create(**job)
 
+    def object_action_computer(self, user, obj, objold, action, computer,
+                               api, cookbook, validator, macrojob_id):
+        '''
+        Reserve the chef node of a computer, apply the action on it and
+        release it. Errors are reported in the jobs of this computer so they
+        never stop the processing of the remaining computers.
+
+        Returns the list of job ids created for the computer and a flag
+        that is True when new jobs must be shown to the administrator.
+        '''
+        settings = get_current_registry().settings
+        job_ids_by_computer = []
+        node = None
+        try:
+            self.log("debug","object_action {0}".format(computer['name']))
+            node_chef_id = computer.get('node_chef_id', None)
+            node = reserve_node_or_raise(node_chef_id, api, 'gcc-tasks-%s-%s' % (obj['_id'], random.random()), 10)
+            if not node.get(settings.get('chef.cookbook_name')):
+                raise NodeNotLinked("Node %s is not linked" % node_chef_id)
+            error_last_saved = computer.get('error_last_saved', False)
+            error_last_chef_client = computer.get('error_last_chef_client', False)
+            force_update = error_last_saved or error_last_chef_client
+            node, updated = self.update_node(user, computer, obj, objold, node, action, macrojob_id, job_ids_by_computer, force_update)
+            if not updated:
+                save_node_and_free(node)
+                return (job_ids_by_computer, False)
+            self.validate_data(node, cookbook, api, validator=validator)
+            save_node_and_free(node)
+            if error_last_saved:
+                self.db.nodes.update_one({'_id': computer['_id']},
+                                     {'$set': {'error_last_saved': False}})
+        except NodeNotLinked as e:
+            self.report_node_not_linked(computer, user, obj, action)
+            save_node_and_free(node, api, refresh=True)
+        except NodeBusyException as e:
+            self.report_node_busy(computer, user, obj, action)
+        except ValidationError as e:
+            if not job_ids_by_computer:
+                self.report_unknown_error(e, user, obj, action, computer)
+            self.report_error(e, job_ids_by_computer, computer, 'Validation error: ')
+            save_node_and_free(node, api, refresh=True)
+        except Exception as e:
+            if not job_ids_by_computer:
+                self.report_unknown_error(e, user, obj, action, computer)
+            self.report_error(e, job_ids_by_computer, computer)
+            try:
+                if node is not None:
+                    save_node_and_free(node, api, refresh=True)
+            except:
+                pass
+        return (job_ids_by_computer, True)
+
+    def object_action_computers(self, user, obj, objold, action, computers,
+                                api, cookbook, validator, macrojob_id):
+        '''
+        Apply the action on every computer, serially or with a pool of
+        greenlets when chef.object_action_concurrency is greater than 1.
+
+        Returns the job ids of the computers (in the same order) and a flag
+        that is True when new jobs must be shown to the administrator.
+        '''
+        settings = get_current_registry().settings
+        concurrency = int(settings.get('chef.object_action_concurrency', 1))
+        threadlocals = threadlocal_manager.get()
+
+        def computer_action(computer):
+            # Pyramid thread locals are greenlet locals after monkey patching
+            threadlocal_manager.push(threadlocals)
+            try:
+                return self.object_action_computer(user, obj, objold, action,
+                    computer, api, cookbook, validator, macrojob_id)
+            finally:
+                threadlocal_manager.pop()
+
+        if concurrency > 1 and len(computers) > 1:
+            # Each greenlet waits on Chef HTTP requests most of the time,
+            # so a bounded pool is enough to overlap the round trips
+            self.log("debug","object_action - concurrency = {0}".format(concurrency))
+            results = Pool(concurrency).imap(computer_action, computers)
+        else:
+            results = map(computer_action, computers)
+
+        job_ids_by_order = []
+        are_new_jobs = False
+        for job_ids_by_computer, new_jobs in results:
+            job_ids_by_order += job_ids_by_computer
+            are_new_jobs = are_new_jobs or new_jobs
+        return (job_ids_by_order, are_new_jobs)
+
+    def finish_macrojob(self, user, macrojob_id, job_ids, are_new_jobs):
+        '''
+        Save the children of a macrojob once all its computers are processed.
+
+        The macrojob has no counter until now, so the chef clients that
+        reported their jobs meanwhile did not update it. The counter and the
+        status are calculated from the children: the counter includes every
+        child that is not finished (as the children with errors or warnings
+        never finish) and their errors or warnings are kept in the macrojob.
+        '''
+        counter = 0
+        job_status = 'processing'
+        for job in self.db.jobs.find({'_id': {'$in': job_ids},
+                                      'status': {'$ne': 'finished'}},
+                                     {'status': True}):
+            counter += 1
+            if job['status'] == 'errors':
+                job_status = 'errors'
+            elif job['status'] == 'warnings' and job_status != 'errors':
+                job_status = 'warnings'
+        if not counter:
+            job_status = 'finished'
+        self.db.jobs.update_one({'_id': macrojob_id},
+                            {'$set': {'status': job_status,
+                                      'childs':  len(job_ids),
+                                      'counter': counter,
+                                      'message': self._("Pending: %d") % counter}})
+
+        if are_new_jobs or job_status == 'finished':
+            invalidate_jobs(self.request, user)
+
+    def update_jobs_status(self, job_status):
+        '''
+        Save the status reported by a chef client for its jobs.
+
+        The jobs are read with a single query and updated with a single bulk
+        write. The parents are updated atomically in MongoDB (another
+        computer may be reporting on the same macrojob at the same time):
+        their counter is decremented by the finished children and the parent
+        is finished when the counter reaches zero.
+
+        Returns True when the chef client reported an error.
+        '''
+        chef_client_error = False
+        job_ids = [ObjectId(job_id) for job_id in job_status]
+        jobs = self.db.jobs.find({'_id': {'$in': job_ids}}, {'parent': True})
+        now = datetime.datetime.utcnow()
+        job_updates = []
+        # parent id -> [finished children, status of the parent]
+        parents = {}
+        for job in jobs:
+            status = job_status[text_type(job['_id'])]
+            # The macrojobs themselves have no parent
+            parent = parents.setdefault(job['parent'], [0, None]) if job.get('parent') else None
+            if status['status'] == 0:
+                job_updates.append(UpdateOne({'_id': job['_id']},
+                                             {'$set': {'status': 'finished',
+                                                       'last_update': now}}))
+                if parent:
+                    parent[0] += 1
+            elif status['status'] == 2:
+                job_updates.append(UpdateOne({'_id': job['_id']},
+                                             {'$set': {'status': 'warnings',
+                                                       'message': status.get('message', 'Warning'),
+                                                       'last_update': now}}))
+                if parent:
+                    parent[1] = 'warnings'
+            else:
+                chef_client_error = True
+                job_updates.append(UpdateOne({'_id': job['_id']},
+                                             {'$set': {'status': 'errors',
+                                                       'message': status.get('message', 'Error'),
+                                                       'last_update': now}}))
+                if parent:
+                    parent[1] = 'errors'
+
+        if job_updates:
+            self.db.jobs.bulk_write(job_updates, ordered=False)
+
+        # "Pending: %d" message calculated by MongoDB with the new counter
+        pending_prefix, _sep, pending_suffix = self._("Pending: %d").partition('%d')
+        parent_updates = []
+        for parent_id, (finished, parent_status) in parents.items():
+            # Older macrojobs may have no counter, and the new ones have none
+            # until finish_macrojob sets it
+            parent_updates.append(UpdateOne({'_id': ObjectId(parent_id),
+                                             'counter': {'$exists': True}}, [
+                {'$set': {'counter': {'$subtract': ['$counter', finished]}}},
+                {'$set': {'status': {'$cond': [{'$eq': ['$counter', 0]},
+                                               'finished',
+                                               parent_status or '$status']},
+                          'message': {'$concat': [pending_prefix,
+                                                  {'$toString': '$counter'},
+                                                  pending_suffix]}}}
+            ]))
+        if parent_updates:
+            self.db.jobs.bulk_write(parent_updates, ordered=False)
+
+        return chef_client_error
+
     def object_action(self, user, obj, objold=None, action=None, computers=None,
                       api=None, cookbook=None, calculate_inheritance=True,
                       validator=None):
@@ -1507,84 +1720,47 @@ class ChefTask(Task):
            
         settings = get_current_registry().settings                                                        
         api = api or get_chef_api(settings, user)
-        cookbook = cookbook or get_cookbook(api,
+        cookbook = cookbook or get_cached_cookbook(api,
                     settings.get('chef.cookbook_name'))
         computers = computers or self.get_related_computers(obj)
                                                                                           
         # MacroJob
-        job_ids_by_order = []
         name = "%s %s" % (obj['type'], action)
         self.log("debug","obj_type_translate {0}".format(obj['type']))
         self.log("debug","action_translate {0}".format(action))
         name_es = self._(action) + " " + self._(obj['type'])
         macrojob_storage = JobStorage(self.db.jobs, user)
+        # The counter is set by finish_macrojob
         macrojob_id = macrojob_storage.create(obj=obj,
                                     op=action,
                                     computer=None,
                                     status='processing',
                                     policy={'name':name,'name_es':name_es},
+                                    counter=None,
                                     administrator_username=user['username'])
         invalidate_jobs(self.request, user)
-        are_new_jobs = False
-        
+
         if computers is None or len(computers) == 0:
             self.log("debug","No computers related with {0} {1}".format(obj['name'], obj['type']))
-            
-        for computer in computers:
-            try:
-                self.log("debug","object_action {0}".format(computer['name']))
-                job_ids_by_computer = []
-                node_chef_id = computer.get('node_chef_id', None)
-                node = reserve_node_or_raise(node_chef_id, api, 'gcc-tasks-%s-%s' % (obj['_id'], random.random()), 10)
-                if not node.get(settings.get('chef.cookbook_name')):
-                    raise NodeNotLinked("Node %s is not linked" % node_chef_id)
-                error_last_saved = computer.get('error_last_saved', False)
-                error_last_chef_client = computer.get('error_last_chef_client', False)
-                force_update = error_last_saved or error_last_chef_client
-                node, updated = self.update_node(user, computer, obj, objold, node, action, macrojob_id, job_ids_by_computer, force_update)
-                if job_ids_by_computer:
-                    job_ids_by_order += job_ids_by_computer
-                if not updated:
-                    save_node_and_free(node)
-                    continue
-                are_new_jobs = True
-                self.validate_data(node, cookbook, api, validator=validator)
-                save_node_and_free(node)
-                if error_last_saved:
-                    self.db.nodes.update_one({'_id': computer['_id']},
-                                         {'$set': {'error_last_saved': False}})
-            except NodeNotLinked as e:
-                self.report_node_not_linked(computer, user, obj, action)
-                are_new_jobs = True
-                save_node_and_free(node, api, refresh=True)
-            except NodeBusyException as e:
-                self.report_node_busy(computer, user, obj, action)
-                are_new_jobs = True
-            except ValidationError as e:
-                if not job_ids_by_computer:
-                    self.report_unknown_error(e, user, obj, action, computer)
-                self.report_error(e, job_ids_by_computer, computer, 'Validation error: ')
-                save_node_and_free(node, api, refresh=True)
-                are_new_jobs = True
-            except Exception as e:
-                if not job_ids_by_computer:
-                    self.report_unknown_error(e, user, obj, action, computer)
-                self.report_error(e, job_ids_by_computer, computer)
-                try:
-                    save_node_and_free(node, api, refresh=True)
-                except:
-                    pass
-                are_new_jobs = True
-        job_status = 'processing' if job_ids_by_order else 'finished'
-        self.db.jobs.update_one({'_id': macrojob_id},
-                            {'$set': {'status': job_status,
-                                      'childs':  len(job_ids_by_order),
-                                      'counter': len(job_ids_by_order),
-                                      'message': self._("Pending: %d") % len(job_ids_by_order)}})
 
-        if are_new_jobs or job_status == 'finished':
-            invalidate_jobs(self.request, user)
-            
+        batch_size = int(settings.get('chef.object_action_batch_size', 0))
+        if batch_size > 0 and len(computers) > batch_size:
+            # Spread the computers among the celery workers. The macrojob
+            # is finished by the chord callback when all batches are done
+            self.log("debug","object_action - batches of {0} computers".format(batch_size))
+            batches = [computers[i:i + batch_size]
+                       for i in range(0, len(computers), batch_size)]
+            chord(object_action_batch.s(user, obj, objold, action, batch,
+                                        macrojob_id, validator=validator)
+                  for batch in batches)(
+                      object_action_finalize.s(user, macrojob_id))
+        else:
+            job_ids_by_order, are_new_jobs = self.object_action_computers(
+                user, obj, objold, action, computers, api, cookbook,
+                validator, macrojob_id)
+            self.finish_macrojob(user, macrojob_id, job_ids_by_order,
+                                 are_new_jobs)
+
         # Trace inheritance
         if not calculate_inheritance:
             return
@@ -1689,7 +1865,7 @@ class ChefTask(Task):
                                 continue            
 
                             for policy_id, policy_action in self.get_policies('policies', 'changed', group, None):
-                                policy = self.db.policies.find_one({"_id": ObjectId(policy_id)})
+                                policy = get_policy(self.db, policy_id)
                                 recalculate_inheritance_for_node(self.logger, self.db, policy_action, group, policy, obj)
 
                     obj['inheritance'] = recalculate_inherited_field(self.logger, self.db, str(obj['_id']))
@@ -1705,17 +1881,20 @@ class ChefTask(Task):
                 rule_type = 'policies'        
                 for policy_id, policy_action in self.get_policies(rule_type, action, obj, objold):
                     self.log("debug","object_action - changing: policy_id = {0} action = {1}".format(policy_id, policy_action))
-                    policy = self.db.policies.find_one({"_id": ObjectId(policy_id)})
+                    policy = get_policy(self.db, policy_id)
                     trace_inheritance(self.logger, self.db, policy_action, obj, policy)        
                 
 
     def object_created(self, user, objnew, computers=None,
                        api=None, cookbook=None, calculate_inheritance=True,
                        validator=None):
-        self.object_action(user, objnew, action='created', computers=computers,
-                           api=api, cookbook=cookbook,
-                           calculate_inheritance=calculate_inheritance,
-                           validator=validator)
+        try:
+            self.object_action(user, objnew, action='created', computers=computers,
+                               api=api, cookbook=cookbook,
+                               calculate_inheritance=calculate_inheritance,
+                               validator=validator)
+        finally:
+            self.refresh_emitters_index(objnew)
 
     def object_refresh_policies(self, user, objnew, computers=None):
         self.object_action(user, objnew, action='recalculate policies', computers=computers)
@@ -1723,19 +1902,26 @@ class ChefTask(Task):
     def object_changed(self, user, objnew, objold, action, computers=None,
                        api=None, cookbook=None, calculate_inheritance=True,
                        validator=None):
-        self.object_action(user, objnew, objold, action, computers=computers,
-                           api=api, cookbook=cookbook,
-                           calculate_inheritance=calculate_inheritance,
-                           validator=validator)
+        try:
+            self.object_action(user, objnew, objold, action, computers=computers,
+                               api=api, cookbook=cookbook,
+                               calculate_inheritance=calculate_inheritance,
+                               validator=validator)
+        finally:
+            self.refresh_emitters_index(objnew, objold)
 
     def object_deleted(self, user, obj, computers=None):
         obj_without_policies = deepcopy(obj)
         obj_without_policies['policies'] = {}
         obj_without_policies['inheritance'] = []
         object_changed = getattr(self, '%s_changed' % obj['type'])
-        object_changed(user, obj_without_policies, obj, action='deleted', computers=computers)
+        try:
+            object_changed(user, obj_without_policies, obj, action='deleted', computers=computers)
+        finally:
+            self.refresh_emitters_index(obj, deleted=True)
 
     def object_moved(self, user, objnew, objold):
+        self.refresh_emitters_index(objnew, objold)
         settings = get_current_registry().settings
         api = get_chef_api(settings, user)
         try:
@@ -1762,6 +1948,7 @@ class ChefTask(Task):
         func(self.db.nodes, objnew, user, api, initialize=True, use_celery=False, policies_collection=self.db.policies)
 
     def object_emiter_deleted(self, user, obj, computers=None):
+        self.refresh_emitters_index(obj, deleted=True)
         name = "%s deleted" % obj['type']
         name_es = self._("deleted") + " " + self._(obj['type'])
         macrojob_storage = JobStorage(self.db.jobs, user)
@@ -1891,8 +2078,9 @@ class ChefTask(Task):
         self.log('debug', 'tasks.py ::: computer_refresh_policies - Recreate user-computer relashionship --------------')
         self.log('debug', 'tasks.py ::: computer_refresh_policies - obj={0}'.format(obj))
         # 1 - Disassociate computer from its users
-        users = self.db.nodes.find({'type': 'user', 'computers': obj['_id']})
-        for u in users:
+        users = dict((u['_id'], u) for u in self.db.nodes.find(
+            {'type': 'user', 'computers': obj['_id']}))
+        for u in users.values():
             self.log('debug', 'tasks.py ::: computer_refresh_policies - remove computer from user: {0}'.format(u['name']))
             self.db.nodes.update_one({
                 '_id': u['_id']
@@ -1933,6 +2121,7 @@ class ChefTask(Task):
                     usr = update_computers_of_user(self.db, usr, api)
         
                     del usr['_id']
+                    usr['ancestors'] = get_ancestors(usr['path'])
                     usr_id = self.db.nodes.insert_one(usr).inserted_id
                     usr = self.db.nodes.find_one({'_id': usr_id})
     
@@ -1969,6 +2158,9 @@ class ChefTask(Task):
             # Set sudoers information
             self.log('debug', 'tasks.py ::: computer_refresh_policies - Update sudoers: {0}'.format(gcc_sudoers))
             self.db.nodes.update_one({'_id': obj['_id']}, {'$set': {'sudoers': list(gcc_sudoers)}})
+            if gcc_sudoers != set(obj.get('sudoers', [])):
+                invalidate_reports_of_node(self.db,
+                    dict(obj, sudoers=list(gcc_sudoers)), obj)
             
             # Clean inheritance information
             self.db.nodes.update_one({'_id': obj['_id']}, { '$unset': { "inheritance": {'$exist': True } }})
@@ -2004,6 +2196,16 @@ class ChefTask(Task):
                     del node.normal[attr]
         
             save_node_and_free(node)
+
+        # The users of the computer and its sudoers may have changed
+        update_computer_users_index(self.db, obj['_id'], list(users))
+
+        # Refresh the reports of the users linked or unlinked to the computer
+        linked_users = dict((u['_id'], u) for u in self.db.nodes.find(
+            {'type': 'user', 'computers': obj['_id']}))
+        for user_id in set(users).symmetric_difference(linked_users):
+            usr = linked_users.get(user_id) or users[user_id]
+            invalidate_reports_of_node(self.db, usr, dict(usr, computers=None))
             
         # 4 - Recalculate policies of the computer
         if obj.get('policies', {}): 
@@ -2100,6 +2302,8 @@ class ChefTask(Task):
         settings = get_current_registry().settings
         self.log_action('deleted BEGIN', 'Computer', obj)
         self.object_deleted(user, obj, computers=computers)
+        self.db.ohai_snapshots.delete_one({'_id': ObjectId(obj['_id'])})
+        delete_computer_log_files(self.db, obj.get('logs', {}).get('files', []))
         node_chef_id = obj.get('node_chef_id', None)
         if node_chef_id:
             api = get_chef_api(settings, user)
@@ -2162,6 +2366,7 @@ class ChefTask(Task):
             nodes_by_type.close()
             
         self.db.nodes.delete_many({'path': ou_path})
+        self.refresh_emitters_index(obj, deleted=True)
         name = "%s deleted" % obj['type']
         name_es = self._("deleted") + " " + self._(obj['type'])
         macrojob_storage = JobStorage(self.db.jobs, user)
@@ -2299,6 +2504,8 @@ def object_created(user, objtype, obj, computers=None, api=None, cookbook=None,
         except Exception as e:
             self.report_unknown_error(e, user, obj, 'created')
             invalidate_jobs(self.request, user)
+        finally:
+            invalidate_reports_of_node(self.db, obj)
     else:
         self.log('error', 'The method {0}_created does not exist'.format(
             objtype))
@@ -2335,11 +2542,36 @@ def object_changed(user, objtype, objnew, objold, action='changed',
         except Exception as e:
             self.report_unknown_error(e, user, objnew, 'changed')
             invalidate_jobs(self.request, user)
+        finally:
+            invalidate_reports_of_node(self.db, objnew, objold)
     else:
         self.log('error', 'The method {0}_changed does not exist'.format(
             objtype))
 
 
+@task(base=ChefTask, acks_late=True)
+def object_action_batch(user, obj, objold, action, computers, macrojob_id,
+                        validator=None):
+    self = object_action_batch
+    settings = get_current_registry().settings
+    api = get_chef_api(settings, user)
+    cookbook = get_cached_cookbook(api, settings.get('chef.cookbook_name'))
+    return self.object_action_computers(user, obj, objold, action, computers,
+                                        api, cookbook, validator, macrojob_id)
+
+
+@task(base=ChefTask)
+def object_action_finalize(results, user, macrojob_id):
+    self = object_action_finalize
+    job_ids = []
+    are_new_jobs = False
+    for job_ids_by_batch, new_jobs in results:
+        job_ids += job_ids_by_batch
+        are_new_jobs = are_new_jobs or new_jobs
+
+    self.finish_macrojob(user, macrojob_id, job_ids, are_new_jobs)
+
+
 @task(base=ChefTask)
 def object_moved(user, objtype, objnew, objold):
     self = object_moved
@@ -2350,6 +2582,8 @@ def object_moved(user, objtype, objnew, objold):
         except Exception as e:
             self.report_unknown_error(e, user, objnew, 'moved')
             invalidate_jobs(self.request, user)
+        finally:
+            invalidate_reports_of_node(self.db, objnew, objold)
     else:
         self.log('error', 'The method {0}_moved does not exist'.format(
             objtype))
@@ -2365,14 +2599,44 @@ def object_deleted(user, objtype, obj, computers=None):
         except Exception as e:
             self.report_unknown_error(e, user, obj, 'deleted')
             invalidate_jobs(self.request, user)
+        finally:
+            invalidate_reports_of_node(self.db, obj, deleted=True)
     else:
         self.log('error', 'The method {0}_deleted does not exist'.format(
             objtype))
 
-@task(base=ChefTask)
+@task(base=ChefTask, max_retries=CHEF_STATUS_SYNC_MAX_RETRIES)
 def chef_status_sync(node_id, auth_user):
     self = chef_status_sync
     settings = get_current_registry().settings
+    concurrency = int(settings.get('chef.status_sync_concurrency', 0))
+    slot_id = None
+    if concurrency:
+        slot_id = acquire_chef_status_slot(self.db, node_id, concurrency)
+        if slot_id is None:
+            if self.request.retries < self.max_retries:
+                # The node stays queued, so its new callbacks are still coalesced
+                self.log("debug", "tasks.py ::: chef_status_sync - No free slot for node {0}".format(node_id))
+                raise self.retry(countdown=int(settings.get('chef.seconds_sleep_is_busy')))
+            # The next callback of the node queues a new sync
+            dequeue_chef_status_sync(self.db, node_id)
+            self.log("warning", "tasks.py ::: chef_status_sync - No free slot for node {0}, sync dropped".format(node_id))
+            return
+
+    # The callbacks received from now on need a new sync of the node
+    dequeue_chef_status_sync(self.db, node_id)
+    try:
+        return sync_chef_status(self, node_id, auth_user)
+    finally:
+        if slot_id is not None:
+            release_chef_status_slot(self.db, slot_id)
+
+
+def sync_chef_status(self, node_id, auth_user):
+    '''
+    Save in MongoDB the changes reported by the chef client of a node
+    '''
+    settings = get_current_registry().settings
     api = get_chef_api(settings, auth_user)   
     node = Node(node_id, api)    
     job_status = node.attributes.get('job_status')
@@ -2389,47 +2653,12 @@ def chef_status_sync(node_id, auth_user):
     self.log("info", "ipaddress: {0}".format(ipaddress))
     self.db.nodes.update_one({'node_chef_id':node_id},
                              {'$set': {'ipaddress':ipaddress}})
-        
+
     reserve_node = False
     if job_status:
         node = reserve_node_or_raise(node_id, api, 'gcc-chef-status-%s' % random.random(), attempts=3)
         reserve_node = True
-        chef_client_error = False
-
-        for job_id, job_status in job_status.to_dict().items():
-            job = self.db.jobs.find_one({'_id': ObjectId(job_id)})
-            if not job:
-                continue
-            # Parent
-            macrojob = self.db.jobs.find_one({'_id': ObjectId(job['parent'])}) if 'parent' in job else None
-            if job_status['status'] == 0:
-                self.db.jobs.update_one({'_id': job['_id']},
-                                    {'$set': {'status': 'finished',
-                                              'last_update': datetime.datetime.utcnow()}})
-                # Decrement number of children in parent
-                if macrojob and 'counter' in macrojob:
-                    macrojob['counter'] -= 1
-            elif job_status['status'] == 2:
-                self.db.jobs.update_one({'_id': job['_id']},
-                                    {'$set': {'status': 'warnings',
-                                              'message': job_status.get('message', 'Warning'),
-                                              'last_update': datetime.datetime.utcnow()}})
-                if macrojob:                                
-                    macrojob['status'] = 'warnings'
-            else:
-                chef_client_error = True
-                self.db.jobs.update_one({'_id': job['_id']},
-                                    {'$set': {'status': 'errors',
-                                              'message': job_status.get('message', 'Error'),
-                                              'last_update': datetime.datetime.utcnow()}})
-                if macrojob:                                
-                    macrojob['status'] = 'errors'
-            # Update parent                                 
-            if macrojob:
-                self.db.jobs.update_one({'_id': macrojob['_id']},                                                                
-                                    {'$set': {'counter': macrojob['counter'],
-                                              'message': self._("Pending: %d") % macrojob['counter'],
-                                              'status': 'finished' if macrojob['counter'] == 0 else macrojob['status']}})
+        chef_client_error = self.update_jobs_status(job_status.to_dict())
         self.db.nodes.update_one({'node_chef_id': node_id}, {'$set': {'error_last_chef_client': chef_client_error}})
         invalidate_jobs(self.request, auth_user)
         node.attributes.set_dotted('job_status', {})
@@ -2442,6 +2671,9 @@ def chef_status_sync(node_id, auth_user):
 
     self.log("debug","tasks.py ::: chef_status_sync - computer = {0}".format(computer))                 
 
+    # Trimmed Ohai attributes for the computer details
+    save_ohai_snapshot(self.db, computer['_id'], node)
+
     chef_node_usernames = set([d['username'] for d in node.attributes.get_dotted(USERS_OHAI)])
     gcc_node_usernames  = set([d['name'] for d in self.db.nodes.find({
                                 'type':'user', 
@@ -2490,16 +2722,20 @@ def chef_status_sync(node_id, auth_user):
                 user = update_computers_of_user(self.db, user, api)
     
                 del user['_id']
+                user['ancestors'] = get_ancestors(user['path'])
                 user_id = self.db.nodes.insert_one(user).inserted_id
                 user = self.db.nodes.find_one({'_id': user_id})
+                invalidate_reports_of_node(self.db, user)
                 reload_clients = True
 
             else:
                 computers = user.get('computers', [])
                 if computer['_id'] not in computers:
+                    olduser = deepcopy(user)
                     computers.append(computer['_id'])
                     self.db.nodes.update_one({'_id': user['_id']},
                         {'$set': {'computers': computers}})
+                    invalidate_reports_of_node(self.db, user, olduser)
                     add_computer_to_user(computer['_id'], user['_id'])
                     invalidate_change(self.request, auth_user)
 
@@ -2540,6 +2776,8 @@ def chef_status_sync(node_id, auth_user):
                 computers.remove(computer['_id'])
                 self.db.nodes.update_one({'_id': user['_id']},
                     {'$set': {'computers': computers}})
+                invalidate_reports_of_node(self.db, user,
+                                           users_remove_policies[-1])
                 invalidate_change(self.request, auth_user)
             
             username = get_username_chef_format(user)
@@ -2576,6 +2814,12 @@ def chef_status_sync(node_id, auth_user):
     # Upgrade sudoers
     self.db.nodes.update_one({'_id': computer['_id']},
         {'$set': {'sudoers': list(gcc_sudoers)}})
+    if gcc_sudoers != set(computer.get('sudoers', [])):
+        invalidate_reports_of_node(self.db,
+            dict(computer, sudoers=list(gcc_sudoers)), computer)
+    # The users of the computer and its sudoers may have changed
+    update_computer_users_index(self.db, computer['_id'],
+                                [user['_id'] for user in users_remove_policies])
     if reload_clients:
         update_tree(computer.get('path', ''))
 
@@ -2657,3 +2901,75 @@ def script_runner(user, sequence, rollback=False):
             {'state': returncode, 'timestamp_end': int(time.time()) }})
 
     logfile.close()
+
+
+@task(base=ChefTask)
+def generate_report(user, report_type, file_ext, ou_id, locale, macrojob_id):
+    ''' Generates a report file in background
+
+    Args:
+      user(object):         user requesting the report
+      report_type(str):     type of report (user, computer, printers, ...)
+      file_ext(str):        format of the report (csv, pdf or html)
+      ou_id(str):           OU of the report (None if it is not of an OU)
+      locale(str):          language of the report
+      macrojob_id(object):  job that shows the progress of the report
+    '''
+    self = generate_report
+    # Avoid a circular import (the report views import this module)
+    from gecoscc.views.report_jobs import save_report_artifact
+
+    self.log("info", "tasks.py ::: generate_report - {0} ({1}) of {2}".format(
+        report_type, file_ext, ou_id))
+
+    # Read before generating the report: a change meanwhile invalidates it
+    version = get_reports_data_version(self.db, report_type, ou_id)
+
+    params = {'type': report_type, 'format': file_ext}
+    if ou_id is not None:
+        params['ou_id'] = ou_id
+    request = Request.blank('/report?' + urlencode(params))
+    env = prepare(request=request, registry=get_current_registry())
+    request.user = user
+    request._LOCALE_ = locale
+    add_localizer(NewRequest(request))
+
+    try:
+        artifact = save_report_artifact(request, report_type, file_ext,
+                                        ou_id, version)
+        job_update = {'status': 'finished',
+                      'report': text_type(artifact['_id']),
+                      'message': self._('Report generated')}
+    except Exception as e:
+        self.log("error", "tasks.py ::: generate_report - {0}".format(e))
+        self.log("error", traceback.format_exc())
+        job_update = {'status': 'errors',
+                      'message': self._('Error generating the report')}
+    finally:
+        env['closer']()
+
+    job_update['last_update'] = datetime.datetime.utcnow()
+    self.db.jobs.update_one({'_id': macrojob_id}, {'$set': job_update})
+    invalidate_jobs(self.request, user)
+
+
+@task(base=ChefTask)
+def archive_jobs():
+    ''' Moves the old jobs to the jobs archive and drops the expired archive
+    collections. It is scheduled daily in the "celerybeat:archive_jobs"
+    section of the configuration.
+    '''
+    self = archive_jobs
+    settings = get_current_registry().settings
+
+    age = int(settings.get('jobs.archive_age', 0))
+    if age > 0:
+        moved = archive_old_jobs(self.db, age)
+        self.log("info", "tasks.py ::: archive_jobs - {0} jobs moved".format(
+            moved))
+
+    expiration = int(settings.get('jobs.archive_expiration', 0))
+    if expiration > 0:
+        for name in drop_expired_jobs_archives(self.db, expiration):
+            self.log("info", "tasks.py ::: archive_jobs - {0} dropped".format(
+                name))
@@ -11,6 +11,7 @@
 #
 
 from six import string_types, text_type
+import datetime
 import json
 import unittest
 import sys
@@ -30,6 +31,7 @@ from paste.deploy import loadapp
 from pyramid import testing
 from pyramid.httpexceptions import HTTPForbidden, HTTPFound
 
+from gecoscc.api import decode_cursor, encode_cursor
 from gecoscc.api.chef_status import USERS_OHAI, ChefStatusResource
 from gecoscc.api.organisationalunits import OrganisationalUnitResource
 from gecoscc.api.computers import ComputerResource, ComputerSupportResource
@@ -53,6 +55,7 @@ from gecoscc.commands.debug_mode_expiration import Command as \
     DebugModeExpirationCommand
     
 from gecoscc.db import get_db
+from gecoscc.eventsmanager import archive_old_jobs, get_jobs_archive_names
 from gecoscc.userdb import get_userdb
 from gecoscc.permissions import LoggedFactory, SuperUserFactory
 from gecoscc.views.portal import home, LoginViews, forbidden_view
@@ -105,6 +108,10 @@ from gevent.libev.corecext import NONE
 from pip._internal.vcs.bazaar import Bazaar
 from gecoscc.utils import update_node
 from gecoscc.views.report_storages import report_storages_html
+from gecoscc.views.report_jobs import (save_report_artifact,
+    get_report_artifact, report_download)
+from gecoscc.utils import get_reports_data_version, invalidate_reports_cache
+from gecoscc.utils import free_node_lease, reserve_node_lease
 from gecoscc.views.server import internal_server_status,\
     internal_server_connections
 import colander
@@ -217,6 +224,7 @@ def _check_if_user_belongs_to_admin_group_mock(request, organization, username):
 
 class ChefApiMock(object):
     def __init__(self):
+        self.url = CHEF_URL
         self.version = '0.11'
         self.platform = False
         
@@ -242,7 +250,12 @@ class ChefApiMock(object):
 
             data['normal'] = json.loads(node_attributes_json)
 
-        if item == '/cookbooks/gecos_ws_mgmt/_latest/':
+        if item == '/cookbooks/gecos_ws_mgmt':
+            # Versions of the cookbook (read by the cookbook cache)
+            data = {'gecos_ws_mgmt': {'versions': [{'version': '1.0.0'}]}}
+
+        if item in ('/cookbooks/gecos_ws_mgmt/_latest/',
+                    '/cookbooks/gecos_ws_mgmt/1.0.0/'):
             data = get_cookbook_mock(None, None)
 
 
@@ -738,6 +751,7 @@ class BaseGecosTestCase(unittest.TestCase):
         c = self.registry.settings['mongodb'].get_connection()
         db_name = self.registry.settings['mongodb'].database_name
         c.drop_database(db_name)
+        self.registry.settings['mongodb'].update_indexes()
 
     def drop_mock_nodes(self):
         '''
@@ -933,7 +947,7 @@ class BaseGecosTestCase(unittest.TestCase):
         self.assertIsInstance(data['pages'], int)
         self.assertIsInstance(data['pagesize'], int)
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def create_basic_structure(self, get_cookbook_method,
         get_cookbook_method_tasks):
@@ -1406,7 +1420,7 @@ class BasicTests(BaseGecosTestCase):
         self.assertEqual(json.loads(response['websockets_enabled']), False)
         self.assertNoErrorJobs()
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def test_02_printers(self, get_cookbook_method, get_cookbook_method_tasks):
         '''
@@ -1443,7 +1457,7 @@ class BasicTests(BaseGecosTestCase):
 
         self.assertNoErrorJobs()
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def test_03_shared_folder(self, get_cookbook_method,
             get_cookbook_method_tasks):
@@ -1479,7 +1493,7 @@ class BasicTests(BaseGecosTestCase):
 
         self.assertNoErrorJobs()
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def test_04_repository(self, get_cookbook_method,
         get_cookbook_method_tasks):
@@ -1515,7 +1529,7 @@ class BasicTests(BaseGecosTestCase):
 
         self.assertNoErrorJobs()
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def test_05_user(self, get_cookbook_method, get_cookbook_method_tasks):
         '''
@@ -1549,7 +1563,7 @@ class BasicTests(BaseGecosTestCase):
 
         self.assertNoErrorJobs()
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def test_06_group(self, get_cookbook_method, get_cookbook_method_tasks):
         '''
@@ -1580,7 +1594,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.tasks.Node')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_07_computer(self, get_chef_api_method, get_cookbook_method,
@@ -1624,7 +1638,7 @@ class BasicTests(BaseGecosTestCase):
 
         self.assertNoErrorJobs()
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     def test_08_OU(self, get_cookbook_method, get_cookbook_method_tasks):
         '''
@@ -1704,7 +1718,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_11_chef_client_run(self, get_chef_api_method,
@@ -1762,7 +1776,29 @@ class BasicTests(BaseGecosTestCase):
         
         # 5 - Check if the response is valid
         self.assertEqual(response['ok'], True)
-        
+
+        # 6 - Reserve the node with a lease in MongoDB
+        settings = self.registry.settings
+        settings['chef.reservation_backend'] = 'mongodb'
+        try:
+            node_api = ChefClientRunResource(request_put)
+            response = node_api.put()
+            self.assertEqual(response['ok'], True)
+            lease = self.get_db().node_leases.find_one({'_id': CHEF_NODE_ID})
+            self.assertEqual(lease['token'], response['lease'])
+
+            # The node is busy while another requestor holds it
+            free_node_lease(CHEF_NODE_ID, 'client', response['lease'])
+            reserve_node_lease(CHEF_NODE_ID, 'gcc', 60)
+            node_api = ChefClientRunResource(request_put)
+            response = node_api.put()
+            self.assertEqual(response['ok'], False)
+            self.assertEqual(response['retry_after'],
+                int(settings['chef.seconds_sleep_is_busy']))
+            free_node_lease(CHEF_NODE_ID)
+        finally:
+            settings['chef.reservation_backend'] = 'chef'
+
         self.assertNoErrorJobs()
 
     @mock.patch('gecoscc.forms.create_chef_admin_user')
@@ -1770,7 +1806,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_12_upload_logs(self, get_chef_api_method,
@@ -1834,6 +1870,15 @@ class BasicTests(BaseGecosTestCase):
         computer = computer_api.get()
 
         self.assertEqual('test.log', computer['logs']['files'][0]['filename'])
+
+        # The Ohai data is saved for the next requests
+        snapshot = db.ohai_snapshots.find_one(
+            {'_id': db.nodes.find_one({'name': 'testing'})['_id']})
+        snapshot_ohai = json.loads(snapshot['ohai'])
+        self.assertEqual(snapshot_ohai.get('ipaddress'),
+                         computer['ohai'].get('ipaddress'))
+        self.assertEqual(snapshot_ohai['ohai_gecos']['users'],
+            computer['ohai'].get('ohai_gecos', {}).get('users', []))
         
         self.assertNoErrorJobs()
         
@@ -1845,7 +1890,8 @@ class BasicTests(BaseGecosTestCase):
             'filename': 'test.log'
         }
         response = computer_logs.get_log_file(context, request)
-        self.assertEqual(response['data']['content'], 'Hello world!')
+        data = json.loads(b''.join(response['data']).decode('utf-8'))
+        self.assertEqual(data['content'], 'Hello world!')
         
         
         # 8 - Download the log file
@@ -1856,7 +1902,8 @@ class BasicTests(BaseGecosTestCase):
             'filename': 'test.log'
         }
         response = computer_logs.download_log_file(context, request)
-        self.assertEqual(response['data']['content'], 'Hello world!')
+        data = json.loads(b''.join(response['data']).decode('utf-8'))
+        self.assertEqual(data['content'], 'Hello world!')
         
         # 9 - Delete the log file
         request = self.get_dummy_request()
@@ -1867,6 +1914,8 @@ class BasicTests(BaseGecosTestCase):
         }
         response = computer_logs.delete_log_file(context, request)
         self.assertEqual(response['ok'], True)
+        db = self.get_db()
+        self.assertEqual(db.computer_logs.files.count_documents({}), 0)
         
 
 
@@ -1875,7 +1924,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_13_update_chef_status(self, get_chef_api_method,
@@ -1988,6 +2037,17 @@ class BasicTests(BaseGecosTestCase):
         node_api = JobResource(request)
         response = node_api.collection_get()
         self.assertEqual(response['total'], 3)
+
+        # Search the jobs by a prefix of its source, in uppercase
+        macrojob = self.get_db().jobs.find_one({'parent': None})
+        data['source'] = macrojob['objname'][:2].upper()
+        request.GET = data
+        node_api = JobResource(request)
+        response = node_api.collection_get()
+        self.assertTrue(response['total'] > 0)
+        for job in response['jobs']:
+            self.assertTrue(job['objname'].lower().startswith(
+                data['source'].lower()))
         
 
     def test_16_jobs_statistics(self):
@@ -2171,7 +2231,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_20_computer_CRUD(self, get_chef_api_method,
@@ -2426,7 +2486,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_28_debug_mode_expiration_command(self, get_chef_api_method,
@@ -2479,7 +2539,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_29_delete_old_policies(self, get_chef_api_method,
@@ -2513,7 +2573,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_30_test_error_generation(self, get_chef_api_method,
@@ -2593,7 +2653,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_31_check_obj_is_related(self, get_chef_api_method,
@@ -2653,7 +2713,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_32_check_is_ou_empty(self, get_chef_api_method,
@@ -2696,7 +2756,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_33_check_update_node(self, get_chef_api_method,
@@ -2749,7 +2809,7 @@ class BasicTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_34_login_view(self, get_chef_api_method,
@@ -2824,6 +2884,89 @@ class BasicTests(BaseGecosTestCase):
             'username': admin_username,
             'action': 'logout'}))
 
+    def test_35_archive_jobs(self):
+        '''
+        Test 35: Execute test_08 to create jobs, move them to the jobs
+        archive and search them in the archived jobs
+        '''
+        if DISABLE_TESTS: return
+
+        self.test_08_OU()
+
+        # 1 - Archive the jobs and make them older than the archive age
+        db = self.get_db()
+        njobs = db.jobs.count_documents({})
+        request = self.get_dummy_request()
+        request.method = 'PUT'
+        ArchiveJobsResource(request).put()
+        db.jobs.update_many({}, {'$set': {
+            'last_update': datetime.datetime.utcnow() -
+            datetime.timedelta(days=91)}})
+
+        # 2 - Move them to the archive
+        self.assertEqual(archive_old_jobs(db, 90), njobs)
+        self.assertEqual(db.jobs.count_documents({}), 0)
+        self.assertTrue(len(get_jobs_archive_names(db)) > 0)
+
+        # 3 - The archived jobs are still found
+        data = {
+            'page': 1,
+            'pagesize': 30,
+            'status': '',
+            'archived': 'true',
+            'parentId': '',
+            'seeAll': 'false',
+            'source': '',
+            'workstation': '',
+            'userfilter': ''
+            }
+        request = self.get_dummy_request()
+        request.method = 'GET'
+        request.errors = Errors()
+        request.path = '/api/jobs/'
+        request.GET = data
+        node_api = JobResource(request)
+        response = node_api.collection_get()
+        self.assertEqual(response['total'], 3)
+
+        for name in get_jobs_archive_names(db):
+            db.drop_collection(name)
+
+    def test_36_cursor_pagination(self):
+        '''
+        Test 36: Read the nodes with the cursor pagination
+        '''
+        if DISABLE_TESTS: return
+
+        # 1 - Read all the nodes in a single page
+        request = self.get_dummy_request()
+        request.method = 'GET'
+        request.errors = Errors()
+        request.path = '/api/nodes/'
+        request.GET = {'pagesize': 1000}
+        response = NodesResource(request).collection_get()
+        node_ids = [node['_id'] for node in response['nodes']]
+        self.assertTrue(len(node_ids) > 1)
+
+        # 2 - Read them one by one with the cursor pagination
+        cursor_node_ids = []
+        data = {'pagesize': 1, 'after': ''}
+        while True:
+            request.GET = data
+            response = NodesResource(request).collection_get()
+            self.assertEqual(response['total'], len(node_ids))
+            cursor_node_ids += [node['_id'] for node in response['nodes']]
+            if response['after'] is None:
+                break
+            data = {'pagesize': 1, 'after': response['after']}
+
+        # (the ties of the sort fields are sorted by id in the cursor mode)
+        self.assertEqual(sorted(cursor_node_ids), sorted(node_ids))
+
+        # 3 - A token with query operators is rejected
+        token = encode_cursor([{'$ne': None}, {'$ne': None}], 1)
+        self.assertRaises(ValueError, decode_cursor, token)
+
 
 class AdvancedTests(BaseGecosTestCase):
 
@@ -2832,7 +2975,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_01_update_resources_user(self, get_chef_api_method,
@@ -2929,7 +3072,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_02_update_resources_workstation(self, get_chef_api_method,
@@ -3014,7 +3157,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_03_priority_ous_workstation(self, get_chef_api_method,
@@ -3156,7 +3299,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_04_priority_user_workstation(self, get_chef_api_method,
@@ -3290,7 +3433,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_05_priority_workstation_ous_groups(self, get_chef_api_method,
@@ -3385,7 +3528,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_06_priority_workstation_groups(self, get_chef_api_method,
@@ -3488,7 +3631,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_07_priority_workstation_groups_different_ou(self,
@@ -3591,7 +3734,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_08_priority_user_ous_groups(self, get_chef_api_method,
@@ -3699,7 +3842,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_09_priority_user_groups_same_ou(self, get_chef_api_method,
@@ -3816,7 +3959,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_10_priority_user_groups_different_ou(self, get_chef_api_method,
@@ -3933,7 +4076,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_11_move_workstation(self, get_chef_api_method,
@@ -4010,7 +4153,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_12_move_user(self, get_chef_api_method, get_cookbook_method,
@@ -4093,7 +4236,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')
     def test_13_group_visibility(self, get_chef_api_method, get_cookbook_method,
@@ -4157,7 +4300,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_14_printer_visibility(self, get_chef_api_method,
@@ -4233,7 +4376,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_15_shared_folder_visibility(self, get_chef_api_method, 
@@ -4320,7 +4463,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_16_repository_visibility(self, get_chef_api_method,
@@ -4422,7 +4565,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_17_delete_ou_with_workstation_and_user_in_domain(self,
@@ -4491,7 +4634,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_18_delete_ou_with_user_and_workstation_in_domain(self,
@@ -4577,7 +4720,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_19_delete_ou_with_group(self, get_chef_api_method,
@@ -4655,7 +4798,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_20_delete_group_with_workstation_and_user(self,
@@ -4734,7 +4877,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_21_delete_group_with_politic(self, get_chef_api_method,
@@ -4825,7 +4968,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_22_delete_group_in_domain_with_politic(self, get_chef_api_method,
@@ -4916,7 +5059,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_23_delete_group_in_domain_with_workstation_and_user(self,
@@ -4998,7 +5141,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_24_delete_OU_without_group_inside(self, get_chef_api_method,
@@ -5069,7 +5212,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_25_priority_grouped_ous_workstation(self, get_chef_api_method, 
@@ -5136,7 +5279,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_26_priority_user_and_group(self, get_chef_api_method, 
@@ -5240,7 +5383,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_28_repositories_are_mergeables(self, get_chef_api_method,
@@ -5307,7 +5450,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_29_cert_policy(self, get_chef_api_method, get_cookbook_method,
@@ -5386,7 +5529,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_30_recalc_command_cert_policy(self, get_chef_api_method,
@@ -5440,7 +5583,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_31_help_channel(self, get_chef_api_method,
@@ -5605,7 +5748,7 @@ class AdvancedTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_32_refresh_policies(self, get_chef_api_method,
@@ -5708,7 +5851,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_01_printers_movements(self, get_chef_api_method,
@@ -5794,7 +5937,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_02_shared_folder_movements(self, get_chef_api_method, 
@@ -5898,7 +6041,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_03_repository_movements(self, get_chef_api_method,
@@ -5978,7 +6121,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_04_groups_movements(self, get_chef_api_method, get_cookbook_method,
@@ -6059,7 +6202,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_05_groups_movements_domain(self, get_chef_api_method,
@@ -6124,7 +6267,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_06_OUs_movements(self, get_chef_api_method, get_cookbook_method,
@@ -6177,7 +6320,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_07_OUs_movements_domain(self, get_chef_api_method,
@@ -6232,7 +6375,7 @@ class MovementsTests(BaseGecosTestCase):
     @mock.patch('gecoscc.utils.isinstance')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_08_complete_policy(self, get_chef_api_method, get_cookbook_method,
@@ -7099,7 +7242,7 @@ class SuperadminTests(BaseGecosTestCase):
         # Check the response
         self.assertEqual(response['report_type'], 'html')
 
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.views.report_printers._')
     def test_12_resports_printers(self, gettext_method,
@@ -7133,7 +7276,7 @@ class SuperadminTests(BaseGecosTestCase):
     @mock.patch('gecoscc.tasks.Node')
     @mock.patch('chef.Node')
     @mock.patch('gecoscc.utils.ChefNode')
-    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.tasks.get_cached_cookbook')
     @mock.patch('gecoscc.utils.get_cookbook')
     @mock.patch('gecoscc.utils._get_chef_api')    
     def test_13_resports_status(self, get_chef_api_method, get_cookbook_method,
@@ -7237,3 +7380,63 @@ class SuperadminTests(BaseGecosTestCase):
 
         # Check the response
         self.assertEqual(response, [])
+
+
+    @mock.patch('gecoscc.views.report_computer._')
+    def test_17_reports_background(self, gettext_method):
+        '''
+        Test 17: Report files generated in background
+        '''
+        if DISABLE_TESTS: return
+
+        gettext_method.side_effect = gettext_mock
+
+        db = self.get_db()
+        domain_1 = db.nodes.find_one({'name': 'Domain 1'})
+        ou_id = str(domain_1['_id'])
+
+        # 1 - Generate the CSV computers report into a file
+        request = self.get_dummy_request()
+        request.GET = { 'ou_id': ou_id}
+        version = get_reports_data_version(db, 'computer', ou_id)
+        artifact = save_report_artifact(request, 'computer', 'csv', ou_id,
+                                        version)
+
+        # Check the file
+        self.assertTrue(os.path.isfile(artifact['path']))
+        self.assertEqual(get_report_artifact(db, 'computer', 'csv', ou_id,
+            request.locale_name)['_id'], artifact['_id'])
+
+        # 2 - Download the file
+        request = self.get_dummy_request()
+        request.matchdict['artifact_id'] = str(artifact['_id'])
+        context = LoggedFactory(request)
+        response = report_download(context, request)
+
+        # Check the response
+        self.assertEqual(response.content_type, 'text/csv')
+
+        # 3 - Change the data of other reports
+        invalidate_reports_cache(db, ('user', 'computer'), ['other'])
+        invalidate_reports_cache(db, ('user',))
+
+        # Check that the file is still used
+        self.assertEqual(get_report_artifact(db, 'computer', 'csv', ou_id,
+            request.locale_name)['_id'], artifact['_id'])
+
+        # 4 - Change the data of the report
+        invalidate_reports_cache(db, ('computer',), [ou_id])
+
+        # Check that the file is not used any more
+        self.assertEqual(get_report_artifact(db, 'computer', 'csv', ou_id,
+            request.locale_name), None)
+
+        # 5 - Generate the report again
+        request = self.get_dummy_request()
+        request.GET = { 'ou_id': ou_id}
+        new_artifact = save_report_artifact(request, 'computer', 'csv',
+            ou_id, get_reports_data_version(db, 'computer', ou_id))
+
+        # Check that the old file was removed
+        self.assertFalse(os.path.isfile(artifact['path']))
+        self.assertTrue(os.path.isfile(new_artifact['path']))
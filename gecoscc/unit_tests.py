@@ -59,6 +59,81 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(components['host_name'], 'www.google.es')
 
 
+    def test_get_ancestors(self):
+        from gecoscc.utils import get_ancestors, get_filter_nodes_belonging_ou
+
+        self.assertEqual(get_ancestors('root'), ['root'])
+        self.assertEqual(get_ancestors('root,1a,2b'), ['root', '1a', '2b'])
+        self.assertEqual(get_ancestors(''), [])
+        self.assertTrue(get_filter_nodes_belonging_ou('2b') in
+                        get_ancestors('root,1a,2b'))
+
+    def test_chef_api_cache(self):
+        import os
+        import tempfile
+        from Crypto.PublicKey import RSA
+        from chef.exceptions import ChefError
+        from gecoscc.utils import ChefAPICache
+
+        cache = ChefAPICache()
+        with tempfile.NamedTemporaryFile(suffix='.pem') as pem:
+            pem.write(RSA.generate(2048).exportKey('PEM'))
+            pem.flush()
+
+            api = cache.get('https://localhost/', 'admin', pem.name, '12.0.0')
+            self.assertTrue(cache.get('https://localhost/', 'admin',
+                                      pem.name, '12.0.0') is api)
+
+            # The key is parsed again when the PEM file changes
+            os.utime(pem.name, (0, 0))
+            self.assertFalse(cache.get('https://localhost/', 'admin',
+                                       pem.name, '12.0.0') is api)
+
+        self.assertRaises(ChefError, cache.get, 'https://localhost/',
+                          'admin', pem.name, '12.0.0')
+
+    def test_serializer(self):
+        import colander
+        import datetime as dt
+        from bson import ObjectId
+        from gecoscc.models import Computers, Jobs, Nodes
+        from gecoscc.serializers import get_schema_fields, get_serializer
+
+        nodes = [
+            {'_id': ObjectId(), 'path': 'root', 'type': 'ou', 'name': 'ou',
+             'source': 'gecos', 'policies': {'a': {'b': [1]}},
+             'node_order': 1},
+            {'_id': ObjectId(), 'path': 'root,1', 'type': 'computer',
+             'name': 'pc', 'lock': 'no', 'memberof': [ObjectId()],
+             'sudoers': ['admin'], 'inheritance': {'x': 1}},
+        ]
+        for schema in (Nodes, Computers):
+            self.assertEqual(get_serializer(schema)(nodes),
+                             schema().serialize(nodes))
+        self.assertFalse('node_order' in get_schema_fields(Nodes))
+
+        jobs = [
+            {'_id': ObjectId(), 'userid': ObjectId(), 'objid': ObjectId(),
+             'computerid': None, 'parent': None, 'childs': 2,
+             'status': 'finished', 'type': 'ou', 'op': 'changed',
+             'created': dt.datetime(2021, 1, 1), 'archived': True,
+             'last_update': dt.datetime(2021, 1, 2, 10, 30)},
+        ]
+        self.assertEqual(get_serializer(Jobs)(jobs), Jobs().serialize(jobs))
+
+        # The lists of nodes can leave out some fields
+        fields = get_schema_fields(Nodes, exclude=('policies', 'inheritance'))
+        serialized = get_serializer(Nodes, fields)(nodes)
+        self.assertEqual(serialized[0]['name'], 'ou')
+        self.assertFalse('policies' in serialized[0])
+        self.assertFalse('inheritance' in serialized[1])
+        self.assertTrue('policies' in get_serializer(Nodes)(nodes)[0])
+
+        # The invalid values are still rejected by colander
+        self.assertRaises(colander.Invalid, get_serializer(Nodes),
+                          [{'_id': 'invalid'}])
+
+
 
         
 class TestFilters(unittest.TestCase):
@@ -108,3 +183,20 @@ class TestFilters(unittest.TestCase):
 
 
 
+
+
+class TestRenderers(unittest.TestCase):
+
+    def test_csv_renderer(self):
+        from gecoscc.views.reports import CSVRenderer
+
+        renderer = CSVRenderer(None)
+        renderer.chunk_size = 2
+        rows = ((u'name%d' % i, i) for i in range(5))
+        chunks = list(renderer({'headers': (u'Name', u'Id'), 'rows': rows},
+                               {}))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b''.join(chunks),
+            b'Name,Id\r\nname0,0\r\nname1,1\r\nname2,2\r\nname3,3\r\n'
+            b'name4,4\r\n')
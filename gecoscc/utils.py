@@ -25,6 +25,7 @@ import pkg_resources
 import logging
 import subprocess
 import traceback
+import zlib
 
 from gettext import gettext as _
 from bson import ObjectId, json_util
@@ -38,8 +39,11 @@ from chef.node import NodeAttributes
 from pyramid.threadlocal import get_current_registry
 
 from collections import defaultdict
+from distutils.version import LooseVersion
+from jsonschema.validators import validator_for
 from pymongo.collation import Collation, CollationStrength
 
+import gridfs
 import requests
 import urllib3
 import pymongo
@@ -54,6 +58,13 @@ POLICY_EMITTER_SUBFIX = '_can_view'
 USER_MGMT = 'users_mgmt'
 SOURCE_DEFAULT = MASTER_DEFAULT = 'gecos'
 USE_NODE = 'use_node'
+# GridFS collection of the log files uploaded by the computers
+COMPUTER_LOGS_COLLECTION = 'computer_logs'
+# Ohai attributes of the computers saved in MongoDB (see save_ohai_snapshot)
+OHAI_SNAPSHOT_ATTRIBUTES = ('cpu', 'dmi', 'memory', 'lsb', 'kernel',
+                            'filesystem', 'uptime', 'ipaddress', 'ohai_time',
+                            'chef_client')
+DEBUG_MODE_ENABLE_ATTR_PATH = 'gecos_ws_mgmt.single_node.debug_mode_res.enable_debug'
 
 # Updates patterns
 BASE_UPDATE_PATTERN = '^update-(\w+)\.zip$'
@@ -74,11 +85,233 @@ AUDIT_ACTIONS = [ 'login','logout','expire' ]
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Seconds after which a pending chef status sync is considered lost
+# and a new one is queued for the node (longer than the retries of a sync
+# waiting for a slot)
+CHEF_STATUS_QUEUE_TIMEOUT = 600
+# Times a chef status sync waits for a free slot before it is dropped
+CHEF_STATUS_SYNC_MAX_RETRIES = 60
+# Seconds after which a chef status sync slot of a dead worker is reused
+CHEF_STATUS_SLOT_TIMEOUT = 600
+
+# Number of inheritance fields written in each bulk operation
+INHERITANCE_BULK_SIZE = 1000
+# Number of computers and users of the emitters index written in each bulk
+# operation
+EMITTERS_INDEX_BULK_SIZE = 1000
+
+# Seconds between two checks of the policies version in MongoDB
+POLICIES_CACHE_CHECK_INTERVAL = 10
+
+# Keep-alive connections to the Chef server kept by each process
+CHEF_HTTP_POOL_SIZE = 10
+
+
+class PoliciesCache(object):
+    '''
+    Process-local cache of the policies collection, indexed by id and slug.
+
+    Policies are only written by the "import_policies" command, which changes
+    the policies version stored in the "data_versions" collection. Each
+    process checks that version every POLICIES_CACHE_CHECK_INTERVAL seconds
+    and reloads all the policies when it has changed.
+
+    The cached policies are shared, so they must not be modified.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.database_name = None
+        self.version = None
+        self.last_check = 0
+        self.by_id = {}
+        self.by_slug = {}
+
+    def check(self, db):
+        now = time.time()
+        if (self.database_name == db.name and
+                now - self.last_check < POLICIES_CACHE_CHECK_INTERVAL):
+            return
+        version = db.data_versions.find_one({'_id': 'policies'})
+        version = version and version['version']
+        if self.database_name != db.name or self.version != version:
+            logger.debug("utils.py ::: PoliciesCache - Loading policies"
+                         " (version = {0})".format(version))
+            by_id = {}
+            by_slug = {}
+            for policy in db.policies.find():
+                by_id[policy['_id']] = policy
+                by_slug[policy['slug']] = policy
+            self.by_id = by_id
+            self.by_slug = by_slug
+            self.version = version
+            self.database_name = db.name
+        self.last_check = now
+
+    def get(self, db, policy_id):
+        self.check(db)
+        policy_id = ObjectId(text_type(policy_id))
+        policy = self.by_id.get(policy_id)
+        if policy is None:
+            policy = db.policies.find_one({'_id': policy_id})
+            if policy is not None:
+                self.by_id[policy_id] = policy
+        return policy
+
+    def get_by_slug(self, db, slug):
+        self.check(db)
+        policy = self.by_slug.get(slug)
+        if policy is None:
+            policy = db.policies.find_one({'slug': slug})
+            if policy is not None:
+                self.by_slug[slug] = policy
+        return policy
+
+
+policies_cache = PoliciesCache()
+
+
+def get_policy(db, policy_id):
+    '''
+    Get a policy by id (ObjectId or string) from the policies cache.
+    The returned policy must not be modified.
+    '''
+    return policies_cache.get(db, policy_id)
+
+
+def get_policy_by_slug(db, slug):
+    '''
+    Get a policy by slug from the policies cache.
+    The returned policy must not be modified.
+    '''
+    return policies_cache.get_by_slug(db, slug)
+
+
+def invalidate_policies_cache(db):
+    '''
+    Change the policies version, so all the processes reload their cache
+    '''
+    db.data_versions.update_one({'_id': 'policies'},
+                                {'$set': {'version': text_type(ObjectId())}},
+                                upsert=True)
+    policies_cache.clear()
+
+
+# Report types that read each type of node in the OUs of the report
+REPORTS_OF_NODE_TYPES = {
+    'ou': ('user', 'computer', 'printers', 'storages', 'no_user_computers',
+           'no_computer_users'),
+    'user': ('user', 'no_user_computers', 'no_computer_users'),
+    'computer': ('computer', 'no_user_computers'),
+    'printer': ('printers',),
+    'storage': ('storages',),
+}
+
+# Report types that read the nodes related with their printers and storages,
+# which can be in any OU
+RELATED_REPORTS_OF_NODE_TYPES = {
+    'ou': ('printers', 'storages'),
+    'group': ('printers', 'storages'),
+    'user': ('printers', 'storages'),
+    'computer': ('printers',),
+}
+
+# Fields of the nodes that change their relation with printers and storages
+RELATED_REPORTS_FIELDS = ('name', 'path', 'policies', 'memberof', 'members',
+                          'computers', 'sudoers')
+
+# Fields of the nodes that are not shown by the reports of their OUs
+NOT_REPORTED_FIELDS = ('policies', 'inheritance')
+
+
+def get_reports_data_version(db, report_type, ou_id=None):
+    '''
+    Get the version of the data shown in a report of an OU (or of every OU).
+    The report files generated with another version are not used. None is
+    returned for the reports that can not be cached.
+    '''
+    if report_type == 'status':
+        # The status of the computers depends on the current time
+        return None
+    if report_type == 'audit':
+        # The audit log is only appended, so its last entry is the version
+        entry = db.auditlog.find_one({}, {'_id': True},
+                                     sort=[('_id', pymongo.DESCENDING)])
+        return text_type(entry['_id']) if entry else ''
+
+    projection = {'all': True}
+    if ou_id is not None:
+        projection['ous.' + text_type(ou_id)] = True
+    versions = db.data_versions.find_one(
+        {'_id': 'reports.' + report_type}, projection) or {}
+    return '{0}:{1}'.format(versions.get('all', ''),
+        versions.get('ous', {}).get(text_type(ou_id), ''))
+
+
+def invalidate_reports_cache(db, report_types, ou_ids=None):
+    '''
+    Change the version of the data shown in the reports of the OUs (or of
+    every OU if ou_ids is None), so the report files are generated again
+    '''
+    version = text_type(ObjectId())
+    if ou_ids is None:
+        versions = {'all': version}
+    else:
+        versions = dict(('ous.' + text_type(ou_id), version)
+                        for ou_id in ou_ids)
+    if not versions:
+        return
+    for report_type in report_types:
+        db.data_versions.update_one({'_id': 'reports.' + report_type},
+                                    {'$set': versions}, upsert=True)
+
+
+def invalidate_reports_of_node(db, obj, objold=None, deleted=False):
+    '''
+    Change the version of the reports that read a node which was created,
+    changed, moved or deleted. objold is the node before the change.
+    '''
+    if objold is not None and obj == objold:
+        return
+    node_type = obj.get('type')
+
+    def changed(fields):
+        return objold is None or any(obj.get(field) != objold.get(field)
+                                     for field in fields)
+
+    report_types = REPORTS_OF_NODE_TYPES.get(node_type, ())
+    if node_type == 'ou':
+        # Its nodes are only created, moved or deleted with the OU
+        is_changed = deleted or (objold is not None and changed(['path']))
+    else:
+        fields = set(obj)
+        if objold is not None:
+            fields.update(objold)
+        is_changed = changed(fields.difference(NOT_REPORTED_FIELDS))
+    if report_types and is_changed:
+        ou_ids = set(get_ancestors(obj.get('path')))
+        if objold is not None:
+            ou_ids.update(get_ancestors(objold.get('path')))
+        ou_ids.discard('root')
+        invalidate_reports_cache(db, report_types, ou_ids)
+
+    report_types = RELATED_REPORTS_OF_NODE_TYPES.get(node_type, ())
+    if report_types and changed(RELATED_REPORTS_FIELDS):
+        invalidate_reports_cache(db, report_types)
+
+    if node_type == 'ou' and (deleted or (objold is not None and
+                                          changed(['name', 'path']))):
+        # The permissions report shows the paths of the OUs
+        invalidate_reports_cache(db, ('permission',))
+
+
 def get_policy_emiter_id(collection, obj):
     '''
     Get the id from a emitter policy
     '''
-    return collection.policies.find_one({'slug': emiter_police_slug(obj['type'])})['_id']
+    return get_policy_by_slug(collection, emiter_police_slug(obj['type']))['_id']
 
 
 def get_object_related_list(collection, obj):
@@ -168,10 +401,31 @@ def get_filter_nodes_parents_ou(db, ou_id, item_id):
     return filters
 
 
+def get_ancestors(path):
+    '''
+    Get the "ancestors" field of a node: the list of the elements of its path
+    (including "root"). This field is indexed, so it must be updated every
+    time the path of a node is set.
+    '''
+    if not path:
+        return []
+    return path.split(',')
+
+
 def get_filter_nodes_belonging_ou(ou_id):
-    if ou_id == 'root':
-        return {'$regex': '%s.*' % ou_id}
-    return {'$regex': '.*,%s.*' % ou_id}
+    '''
+    Filter of the "ancestors" field to get the nodes that belongs to an OU
+    at any depth.
+    '''
+    return text_type(ou_id)
+
+
+def get_filter_nodes_belonging_ous(ou_ids):
+    '''
+    Filter of the "ancestors" field to get the nodes that belongs to any of
+    the OUs at any depth.
+    '''
+    return {'$in': [text_type(ou_id) for ou_id in ou_ids]}
 
 
 def get_filter_children_ou(ou_id, next_level=True):
@@ -222,15 +476,72 @@ def get_chef_api(settings, user):
     return api
 
 
+class PooledChefAPI(ChefAPI):
+    '''
+    ChefAPI that sends its requests through a HTTP session shared by all the
+    clients of the same Chef server, so the keep-alive connections are
+    reused instead of opening a new connection for each request.
+    '''
+
+    def _request(self, method, url, data, headers):
+        return chef_api_cache.get_session(self.url).request(
+            method, url, headers=headers, data=data, verify=self.ssl_verify)
+
+
+class ChefAPICache(object):
+    '''
+    Process-local cache of the Chef API clients, keyed by Chef server URL,
+    username and PEM file. The key of a client is parsed again when the
+    modification time of its PEM file changes.
+
+    The clients of the same Chef server share a HTTP session with a pool of
+    CHEF_HTTP_POOL_SIZE keep-alive connections.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        self.sessions = {}
+
+    def get_session(self, chef_url):
+        session = self.sessions.get(chef_url)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=CHEF_HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.sessions[chef_url] = session
+        return session
+
+    def get(self, chef_url, username, chef_pem, chef_version):
+        try:
+            mtime = os.stat(chef_pem).st_mtime
+        except OSError:
+            raise ChefError('User has no pem to access chef server')
+
+        key = (chef_url, username, chef_pem, chef_version)
+        entry = self.entries.get(key)
+        if entry is None or entry['mtime'] != mtime:
+            logger.debug("utils.py ::: ChefAPICache - Loading the key of"
+                         " {0}".format(username))
+            api = PooledChefAPI(chef_url, chef_pem, username, chef_version,
+                                ssl_verify=False)
+            entry = {'mtime': mtime, 'api': api}
+            self.entries[key] = entry
+        return entry['api']
+
+
+chef_api_cache = ChefAPICache()
+
+
 def _get_chef_api(chef_url, username, chef_pem, chef_ssl_verify, chef_version = '11.0.0'):
-    if not os.path.exists(chef_pem):
-        raise ChefError('User has no pem to access chef server')
     if chef_ssl_verify == 'False' or chef_ssl_verify == 'True':
         chef_ssl_verify = bool(chef_ssl_verify)
 
-    api = ChefAPI(chef_url, chef_pem, username, chef_version, ssl_verify = False)
-
-    return api
+    return chef_api_cache.get(chef_url, username, chef_pem, chef_version)
 
 
 def create_chef_admin_user(api, settings, usrname, password=None, email='nobody@nobody.es'):
@@ -344,7 +655,7 @@ def is_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc', attemp
     is_busy = True
     for _attempt in range(attempts):
         node, is_busy = _is_node_busy_and_reserve_it(node_id, api, controller_requestor)
-        if not is_busy:
+        if not is_busy or _attempt == attempts - 1:
             break
         settings = get_current_registry().settings
         seconds_sleep_is_busy = settings.get('chef.seconds_sleep_is_busy')
@@ -352,12 +663,81 @@ def is_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc', attemp
     return (node, is_busy)
 
 
+def is_lease_reservation_backend(settings=None):
+    '''
+    True when the chef nodes are reserved with a lease document in MongoDB
+    instead of the USE_NODE attribute of the node.
+    '''
+    if settings is None:
+        settings = get_current_registry().settings
+    return settings.get('chef.reservation_backend', 'chef') == 'mongodb'
+
+
+def reserve_node_lease(node_id, controller_requestor, seconds_block_is_busy,
+                       token=None):
+    '''
+    Take (or renew) the lease of the node in the node_leases collection.
+
+    The lease is taken in a single atomic operation: the update only matches
+    a lease of the same requestor or an expired one, and otherwise the upsert
+    fails with a duplicated key because another requestor holds the node.
+
+    The token, if any, is saved in the lease so only its holder frees it.
+    '''
+    db = get_current_registry().settings['mongodb'].get_database()
+    now = datetime.datetime.utcnow()
+    lease = {'control': controller_requestor,
+             'exp_date': now + datetime.timedelta(seconds=seconds_block_is_busy)}
+    if token is not None:
+        lease['token'] = token
+    try:
+        db.node_leases.find_one_and_update(
+            {'_id': node_id,
+             '$or': [{'control': controller_requestor},
+                     {'exp_date': {'$lte': now}}]},
+            {'$set': lease},
+            upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        return False
+    return True
+
+
+def free_node_lease(node_id, controller_requestor=None, token=None):
+    '''
+    Remove the lease of the node. If controller_requestor (or token) is set
+    the lease is only removed when it belongs to that requestor (or holder).
+    '''
+    db = get_current_registry().settings['mongodb'].get_database()
+    lease_filter = {'_id': node_id}
+    if controller_requestor is not None:
+        lease_filter['control'] = controller_requestor
+    if token is not None:
+        lease_filter['token'] = token
+    db.node_leases.delete_one(lease_filter)
+
+
+def _is_node_busy_and_reserve_it_lease(node_id, api, controller_requestor, seconds_block_is_busy):
+    '''
+    Reserve the node with a lease in MongoDB, so the node is only read
+    from the Chef server when the reservation succeeds.
+    '''
+    if not reserve_node_lease(node_id, controller_requestor, seconds_block_is_busy):
+        return (ChefNode(node_id, api), True)
+    node = ChefNode(node_id, api)
+    if not node.exists:
+        free_node_lease(node_id, controller_requestor)
+    return (node, False)
+
+
 def _is_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc'):
     '''
     Check if the node is busy, else try to get it and write in control and expiration date in the field USE_NODE.
     '''
     settings = get_current_registry().settings
     seconds_block_is_busy = int(settings.get('chef.seconds_block_is_busy'))
+    if is_lease_reservation_backend(settings):
+        return _is_node_busy_and_reserve_it_lease(node_id, api, controller_requestor,
+                                                  seconds_block_is_busy)
     time_to_exp = datetime.timedelta(seconds=seconds_block_is_busy)
 
     time_get = time.time()
@@ -398,6 +778,8 @@ def save_node_and_free(node, api=None, refresh=False):
         node = ChefNode(node.name, api)
     node.attributes.set_dotted(USE_NODE, {})
     node.save()
+    if is_lease_reservation_backend():
+        free_node_lease(node.name)
 
 
 class NodeBusyException(Exception):
@@ -407,6 +789,362 @@ class NodeBusyException(Exception):
 class NodeNotLinked(Exception):
     pass
 
+# Utils to coalesce the chef status syncs of the nodes
+
+def queue_chef_status_sync(db, node_id):
+    '''
+    Mark the node as pending of a chef status sync.
+
+    Returns False when a sync of the node is already pending, so the new
+    callback is coalesced with it and no new task must be sent.
+    '''
+    now = datetime.datetime.utcnow()
+    lost = now - datetime.timedelta(seconds=CHEF_STATUS_QUEUE_TIMEOUT)
+    try:
+        db.chef_status_queue.update_one({'_id': node_id, 'queued': {'$lt': lost}},
+                                        {'$set': {'queued': now}},
+                                        upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        return False
+    return True
+
+
+def dequeue_chef_status_sync(db, node_id):
+    '''
+    Called when the sync of the node starts: the next callbacks of the node
+    need a new sync.
+    '''
+    db.chef_status_queue.delete_one({'_id': node_id})
+
+
+def acquire_chef_status_slot(db, node_id, concurrency):
+    '''
+    Take one of the "concurrency" slots that limit the chef status syncs
+    running at the same time. Returns the slot id or None if all of them
+    are in use.
+    '''
+    now = datetime.datetime.utcnow()
+    slot_filter = {'_id': {'$lt': concurrency},
+                   'exp_date': {'$lte': now}}
+    slot_update = {'$set': {'node_id': node_id,
+                            'exp_date': now + datetime.timedelta(seconds=CHEF_STATUS_SLOT_TIMEOUT)}}
+    slot = db.chef_status_slots.find_one_and_update(slot_filter, slot_update)
+    if slot is None and db.chef_status_slots.count_documents({'_id': {'$lt': concurrency}}) < concurrency:
+        # Create the missing slots (the concurrency setting was increased)
+        for slot_id in range(concurrency):
+            db.chef_status_slots.update_one({'_id': slot_id},
+                                            {'$setOnInsert': {'exp_date': datetime.datetime(1970, 1, 1)}},
+                                            upsert=True)
+        slot = db.chef_status_slots.find_one_and_update(slot_filter, slot_update)
+    return slot['_id'] if slot else None
+
+
+def release_chef_status_slot(db, slot_id):
+    db.chef_status_slots.update_one({'_id': slot_id},
+                                    {'$set': {'exp_date': datetime.datetime(1970, 1, 1)},
+                                     '$unset': {'node_id': ''}})
+
+
+def get_chef_status_queue_depth(db):
+    '''
+    Returns the number of nodes pending of a chef status sync and the
+    number of syncs that are running limited by the slots.
+    '''
+    now = datetime.datetime.utcnow()
+    return {'pending': db.chef_status_queue.count_documents({}),
+            'running': db.chef_status_slots.count_documents({'exp_date': {'$gt': now}})}
+
+# Utils to index the nodes and computers related with the emitters
+#
+# The "emitters_index" collection keeps, for each printer, storage and
+# repository, the nodes whose policies reference it. The
+# "related_computers_index" collection keeps, for each computer and user,
+# the nodes whose policies reach it (the node itself, its OUs, its groups
+# and the OUs of its groups) and the computers they reach through it (the
+# computer itself or the computers of the user). The computers of an
+# emitter are the computers of the entries that contain any of its nodes.
+#
+# Both collections are updated from the changed node, so a change never
+# walks the nodes graph of the emitters.
+
+def is_emitters_index_built(db):
+    '''
+    The index is only read once the "update_emitters_index" command built it
+    '''
+    return db.data_versions.find_one({'_id': 'emitters_index'}) is not None
+
+
+def get_node_emitter_ids(node):
+    '''
+    Get the ids of the emitters referenced by the policies of a node
+    '''
+    emitter_ids = set()
+    for policy in node.get('policies', {}).values():
+        if not isinstance(policy, dict):
+            continue
+        emitter_ids.update([ObjectId(emitter_id)
+                            for emitter_id in policy.get('object_related_list', [])
+                            if ObjectId.is_valid(emitter_id)])
+    return emitter_ids
+
+
+def get_path_node_ids(node):
+    return [ObjectId(node_id) for node_id in get_ancestors(node.get('path', ''))
+            if ObjectId.is_valid(node_id)]
+
+
+def update_related_computers_index(db, node_ids, exclude=None):
+    '''
+    Calculate the entries of the related computers index of these computers
+    and users. The nodes in "exclude" are being deleted, so they are
+    ignored (and the entries of the deleted computers and users removed).
+    '''
+    exclude = set(exclude or [])
+    node_ids = list(set(node_ids) - exclude)
+    for start in range(0, len(node_ids), EMITTERS_INDEX_BULK_SIZE):
+        chunk = node_ids[start:start + EMITTERS_INDEX_BULK_SIZE]
+        nodes = list(db.nodes.find(
+            {'_id': {'$in': chunk}, 'type': {'$in': ['computer', 'user']}},
+            {'type': True, 'name': True, 'path': True, 'memberof': True,
+             'computers': True}))
+
+        # Groups of the nodes (and the groups of these groups)
+        groups = {}
+        pending = set(group_id for node in nodes
+                      for group_id in node.get('memberof', [])) - exclude
+        while pending:
+            found = list(db.nodes.find({'_id': {'$in': list(pending)},
+                                        'type': 'group'},
+                                       {'path': True, 'memberof': True}))
+            for group in found:
+                groups[group['_id']] = group
+            pending = set(group_id for group in found
+                          for group_id in group.get('memberof', [])
+                          if group_id not in groups) - exclude
+
+        # The computers of a user where the user is a sudoer are not reached
+        computer_ids = set(computer_id for node in nodes if node['type'] == 'user'
+                           for computer_id in node.get('computers', [])) - exclude
+        sudoers = {}
+        if computer_ids:
+            for computer in db.nodes.find({'_id': {'$in': list(computer_ids)},
+                                           'type': 'computer'},
+                                          {'sudoers': True}):
+                sudoers[computer['_id']] = computer.get('sudoers', [])
+
+        requests = []
+        for node in nodes:
+            reach = set([node['_id']] + get_path_node_ids(node))
+            member_of = list(node.get('memberof', []))
+            while member_of:
+                group = groups.get(member_of.pop())
+                if group is None or group['_id'] in reach:
+                    continue
+                reach.add(group['_id'])
+                reach.update(get_path_node_ids(group))
+                member_of.extend(group.get('memberof', []))
+
+            if node['type'] == 'computer':
+                computers = [node['_id']]
+            else:
+                computers = [computer_id for computer_id in node.get('computers', [])
+                             if computer_id in sudoers and
+                             node['name'] not in sudoers[computer_id]]
+            requests.append(pymongo.ReplaceOne({'_id': node['_id']},
+                                               {'nodes': list(reach),
+                                                'computers': computers},
+                                               upsert=True))
+
+        found_ids = set(node['_id'] for node in nodes)
+        deleted = [node_id for node_id in chunk if node_id not in found_ids]
+        if deleted:
+            requests.append(pymongo.DeleteMany({'_id': {'$in': deleted}}))
+        if requests:
+            db.related_computers_index.bulk_write(requests, ordered=False)
+
+    if exclude:
+        db.related_computers_index.delete_many({'_id': {'$in': list(exclude)}})
+
+
+def update_computer_users_index(db, computer_id, removed_user_ids=()):
+    '''
+    Update the related computers index after a change in the users of a
+    computer or in its sudoers. "removed_user_ids" are the users that no
+    longer have the computer.
+    '''
+    node_ids = set(removed_user_ids)
+    node_ids.update([user['_id'] for user in db.nodes.find(
+        {'type': 'user', 'computers': computer_id}, {'_id': True})])
+    update_related_computers_index(db, node_ids)
+
+
+def update_emitters_index_of_node(db, obj, objold=None, deleted=False):
+    '''
+    Update the emitters index after a change in a node: the emitters
+    referenced by its policies and, when the relations of the node changed
+    (its path, groups, members, computers or sudoers), the related computers
+    of the computers and users under it.
+    '''
+    node_id = obj['_id']
+    if obj['type'] in RESOURCES_EMITTERS_TYPES:
+        if deleted:
+            db.emitters_index.delete_one({'_id': node_id})
+        else:
+            db.emitters_index.update_one({'_id': node_id},
+                                         {'$setOnInsert': {'nodes': []}},
+                                         upsert=True)
+        return
+
+    # Emitters referenced by the node
+    if deleted:
+        db.emitters_index.update_many({'nodes': node_id},
+                                      {'$pull': {'nodes': node_id}})
+    else:
+        new_emitter_ids = get_node_emitter_ids(obj)
+        old_emitter_ids = get_node_emitter_ids(objold) if objold else set()
+        added = list(new_emitter_ids - old_emitter_ids)
+        removed = list(old_emitter_ids - new_emitter_ids)
+        if added:
+            db.emitters_index.update_many({'_id': {'$in': added}},
+                                          {'$addToSet': {'nodes': node_id}})
+        if removed:
+            db.emitters_index.update_many({'_id': {'$in': removed}},
+                                          {'$pull': {'nodes': node_id}})
+
+    # Computers and users under the node
+    relations = ('path', 'memberof', 'members', 'computers', 'sudoers')
+    if (objold is not None and not deleted and
+            all(obj.get(field) == objold.get(field) for field in relations)):
+        return
+    if obj['type'] == 'ou' and objold is None and not deleted:
+        # A new OU has no nodes under it
+        return
+
+    # The entries that contain the node (the node itself, the nodes under an
+    # OU or the members of a group)
+    node_ids = set([node_id])
+    node_ids.update([entry['_id'] for entry in db.related_computers_index.find(
+        {'nodes': node_id}, {'_id': True})])
+    if obj['type'] == 'computer':
+        # The sudoers of the computer change the computers of its users
+        node_ids.update([user['_id'] for user in db.nodes.find(
+            {'type': 'user', 'computers': node_id}, {'_id': True})])
+    elif obj['type'] == 'group':
+        members = set()
+        for node in (obj, objold):
+            if node:
+                members.update(node.get('members', []))
+        if members:
+            # The new members and the members of the member groups
+            node_ids.update(members)
+            node_ids.update([entry['_id'] for entry in db.related_computers_index.find(
+                {'nodes': {'$in': list(members)}}, {'_id': True})])
+
+    update_related_computers_index(db, node_ids,
+                                   exclude=[node_id] if deleted else None)
+
+
+def build_emitters_index(db):
+    '''
+    Calculate the whole emitters index
+    '''
+    emitters = 0
+    for emitter in db.nodes.find({'type': {'$in': list(RESOURCES_EMITTERS_TYPES)}},
+                                 {'type': True}):
+        nodes = [node['_id'] for node in get_object_related_list(db, emitter)]
+        db.emitters_index.replace_one({'_id': emitter['_id']}, {'nodes': nodes},
+                                      upsert=True)
+        emitters += 1
+
+    node_ids = [node['_id'] for node in db.nodes.find(
+        {'type': {'$in': ['computer', 'user']}}, {'_id': True})]
+    update_related_computers_index(db, node_ids)
+
+    db.data_versions.update_one({'_id': 'emitters_index'},
+                                {'$set': {'version': text_type(ObjectId())}},
+                                upsert=True)
+    return emitters
+
+
+def get_emitter_related_nodes(db, emitter):
+    '''
+    Get the ids of the nodes whose policies reference an emitter
+    '''
+    if is_emitters_index_built(db):
+        emitter_index = db.emitters_index.find_one({'_id': emitter['_id']})
+        if emitter_index is not None:
+            return emitter_index['nodes']
+    return [node['_id'] for node in get_object_related_list(db, emitter)]
+
+
+def get_emitter_related_computers(db, emitter):
+    '''
+    Get the ids of the computers reached by an emitter, or None if the
+    index is not built yet (the nodes graph must be walked)
+    '''
+    if not is_emitters_index_built(db):
+        return None
+    nodes = get_emitter_related_nodes(db, emitter)
+    if not nodes:
+        return []
+    return db.related_computers_index.distinct('computers',
+                                               {'nodes': {'$in': nodes}})
+
+# Utils to store the log files of the computers
+
+def get_computer_logs_fs(db):
+    return gridfs.GridFS(db, collection=COMPUTER_LOGS_COLLECTION)
+
+
+def save_computer_log_file(db, computer_id, filename, content):
+    '''
+    Store a log file of a computer compressed in GridFS.
+
+    Returns the reference to the file that is saved in the "logs.files"
+    list of the computer node instead of its content.
+    '''
+    size = len(content)
+    if not isinstance(content, text_type):
+        content = json.dumps(content)
+    file_id = get_computer_logs_fs(db).put(
+        zlib.compress(content.encode('utf-8')),
+        filename=filename,
+        computer_id=computer_id)
+    return {'filename': filename,
+            'size': size,
+            'file_id': file_id}
+
+
+def open_computer_log_file(db, filedata):
+    '''
+    Returns an iterator over the uncompressed content (bytes) of a log file.
+    The files of the nodes not migrated yet still have their content inline.
+    '''
+    if 'file_id' not in filedata:
+        content = filedata.get('content', '')
+        if not isinstance(content, text_type):
+            content = json.dumps(content)
+        return iter([content.encode('utf-8')])
+    return _uncompress_chunks(get_computer_logs_fs(db).get(filedata['file_id']))
+
+
+def _uncompress_chunks(grid_out):
+    decompressor = zlib.decompressobj()
+    for chunk in grid_out:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def delete_computer_log_files(db, files):
+    fs = get_computer_logs_fs(db)
+    for filedata in files:
+        if 'file_id' in filedata:
+            fs.delete(filedata['file_id'])
+
 # Utils to NodeAttributes chef class
 
 def recursive_defaultdict():
@@ -425,6 +1163,41 @@ def to_deep_dict(node_attr):
     return merged
 
 
+def save_ohai_snapshot(db, computer_id, computer_node, ohai=None):
+    '''
+    Save in the "ohai_snapshots" collection a trimmed copy of the Ohai
+    attributes of the Chef node of a computer, so the computer details are
+    shown without reading the whole Chef node. The snapshot is kept out of
+    the computer node, so the queries of the nodes do not load it.
+
+    The attributes are saved as JSON text, because some of their keys (i.e.
+    the mount points of the filesystems) are not valid MongoDB field names.
+    '''
+    if ohai is None:
+        ohai = to_deep_dict(computer_node.attributes)
+    snapshot_ohai = dict((attr, ohai[attr])
+                         for attr in OHAI_SNAPSHOT_ATTRIBUTES if attr in ohai)
+    snapshot_ohai['ohai_gecos'] = {
+        'users': ohai.get('ohai_gecos', {}).get('users', [])}
+
+    # debug_mode flag for logs tab
+    debug_mode = False
+    try:
+        debug_mode = computer_node.attributes.get_dotted(
+            DEBUG_MODE_ENABLE_ATTR_PATH)
+    except KeyError:
+        pass
+
+    snapshot = {
+        '_id': computer_id,
+        'ohai': json.dumps(snapshot_ohai),
+        'debug_mode': debug_mode,
+        'date': datetime.datetime.utcnow()
+    }
+    db.ohai_snapshots.replace_one({'_id': computer_id}, snapshot, upsert=True)
+    return snapshot
+
+
 def dict_merge(a, b):
     '''recursively merges dict's. not just simple a['key'] = b['key'], if
     both a and b have a key who's value is a dict then dict_merge is called
@@ -779,7 +1552,7 @@ def apply_policies_to_ou(nodes_collection, ou, auth_user, api=None, initialize=F
         object_changed = object_changed.delay
     children_path = ou['path'] + ',' + text_type(ou['_id'])
     ou_children_count = nodes_collection.count_documents(
-        {'path': {'$regex': '.*' + text_type(ou['_id']) + '.*'}})
+        {'ancestors': get_filter_nodes_belonging_ou(ou['_id'])})
 
     visibility_object_related(nodes_collection.database, ou)
 
@@ -794,8 +1567,8 @@ def apply_policies_to_ou(nodes_collection, ou, auth_user, api=None, initialize=F
     # an CursorNotFound exception being raised when attempting to iterate the
     # cursor.
     # OUs with a lot of depth levels
-    ou_children = nodes_collection.find({'path': 
-        {'$regex': '.*' + text_type(ou['_id']) + '.*'}}, no_cursor_timeout=True)
+    ou_children = nodes_collection.find({'ancestors':
+        get_filter_nodes_belonging_ou(ou['_id'])}, no_cursor_timeout=True)
 
     for child in ou_children:
         child_old = nodes_collection.find_one({'_id': child['_id']})
@@ -839,7 +1612,7 @@ def update_data_user(nodes_collection, obj, policy, api, auth_user):
     if isinstance(policy, list):
         policy_field_name = []
         for policy_id in policy:
-            policy = nodes_collection.database.policies.find_one({'_id': ObjectId(policy_id)})
+            policy = get_policy(nodes_collection.database, policy_id)
             policy_field_name.append(policy['path'].split('.')[2])
     else:
         policy_field_name = [policy['path'].split('.')[2]]
@@ -854,7 +1627,7 @@ def update_data_computer(nodes_collection, obj, policy, api, auth_user):
         if isinstance(policy, list):
             policy_field_name = []
             for policy_id in policy:
-                policy = nodes_collection.database.policies.find_one({'_id': ObjectId(policy_id)})
+                policy = get_policy(nodes_collection.database, policy_id)
                 policy_field_name.append(policy['path'].split('.')[:3])
         else:
             policy_field_name = [policy['path'].split('.')[:3]]
@@ -910,6 +1683,90 @@ def save_pem_for_username(settings, username, pem_name, pem_text):
 def get_cookbook(api, cookbook_name):
     return api['/cookbooks/%s/_latest/' % cookbook_name]
 
+
+# Seconds between two checks of the cookbook version in the Chef server
+COOKBOOK_CACHE_CHECK_INTERVAL = 60
+
+
+def get_schema_validator(schema):
+    '''
+    Build a JSON schema validator instance (checking the schema only once)
+    '''
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+class CookbookCache(object):
+    '''
+    Process-local cache of the cookbook metadata and its JSON schema
+    validator, keyed by Chef server URL, cookbook name and cookbook version.
+
+    The version of the cookbook is checked (a small request that does not
+    download the metadata) every COOKBOOK_CACHE_CHECK_INTERVAL seconds.
+
+    The cached cookbook is shared, so it must not be modified.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+
+    def get_version(self, api, cookbook_name):
+        data = api['/cookbooks/%s' % cookbook_name]
+        versions = [v['version'] for v in data[cookbook_name]['versions']]
+        return max(versions, key=LooseVersion)
+
+    def get(self, api, cookbook_name):
+        key = (api.url, cookbook_name)
+        entry = self.entries.get(key)
+        now = time.time()
+        if (entry is not None and
+                now - entry['last_check'] < COOKBOOK_CACHE_CHECK_INTERVAL):
+            return entry['cookbook']
+
+        version = self.get_version(api, cookbook_name)
+        if entry is None or entry['version'] != version:
+            logger.debug("utils.py ::: CookbookCache - Loading cookbook"
+                         " {0} {1}".format(cookbook_name, version))
+            cookbook = api['/cookbooks/%s/%s/' % (cookbook_name, version)]
+            entry = {'version': version,
+                     'cookbook': cookbook,
+                     'validator': None}
+            self.entries[key] = entry
+        entry['last_check'] = now
+        return entry['cookbook']
+
+    def get_validator(self, cookbook):
+        schema = cookbook['metadata']['attributes']['json_schema']['object']
+        for entry in list(self.entries.values()):
+            if entry['cookbook'] is cookbook:
+                if entry['validator'] is None:
+                    entry['validator'] = get_schema_validator(schema)
+                return entry['validator']
+        return get_schema_validator(schema)
+
+
+cookbook_cache = CookbookCache()
+
+
+def get_cached_cookbook(api, cookbook_name):
+    '''
+    Get the latest version of a cookbook from the cookbook cache.
+    The returned cookbook must not be modified.
+    '''
+    return cookbook_cache.get(api, cookbook_name)
+
+
+def get_cookbook_validator(cookbook):
+    '''
+    Get the JSON schema validator of a cookbook. The validator is built once
+    for each cookbook version in the cache.
+    '''
+    return cookbook_cache.get_validator(cookbook)
+
 class setPathAttrsToNodeException(Exception):
     pass
 
@@ -963,6 +1820,7 @@ def register_node(api, node_id, ou, collection_nodes):
                                              'source': ou.get('source', SOURCE_DEFAULT),
                                              'node_chef_id': node_id})
             del computer['_id']
+            computer['ancestors'] = get_ancestors(nodepath)
             if check_unique_node_name_by_type_at_domain(collection_nodes, computer):
                 if collection_nodes.find_one({'node_chef_id': node_id}):
                     ret = 'duplicated-node-id'
@@ -1000,6 +1858,7 @@ def update_node(api, node_id, ou, collection_nodes):
                                              'source': ou.get('source', SOURCE_DEFAULT),
                                              'node_chef_id': node_id})
             del computer['_id']
+            computer['ancestors'] = get_ancestors(nodepath)
             ret = collection_nodes.update_one({'node_chef_id': node_id},
                     {'$set': computer})
             ret = ret.acknowledged
@@ -1132,7 +1991,8 @@ def update_computers_of_user(db, user, api):
     from gecoscc.api.chef_status import USERS_OHAI
 
     logger.debug("utils ::: update_computers_of_user - user = %s" % str(user))
-    nodes = db.nodes.find({'path': {'$regex': '.*' + user['path'] +'.*'}, 'type':'computer'})
+    nodes = db.nodes.find({'ancestors': get_filter_nodes_belonging_ou(
+        user['path'].split(',')[-1]), 'type':'computer'})
 
     for node in nodes:
         chef_node = ChefNode(node['node_chef_id'], api)
@@ -1173,7 +2033,87 @@ def _nested_lookup(key, document):
                         yield result
 
 # ------------------------------------------------------------------------------------------------------
-def order_groups_by_depth(db, groups_ids):
+class NodesCache(object):
+    """Cache of the nodes read while the inheritance field of several nodes
+    is recalculated, so OUs and groups are read once with a single query
+    instead of once per node. It only keeps the fields used by the
+    inheritance functions.
+    """
+
+    projection = {'name': True, 'type': True, 'path': True}
+
+    def __init__(self, db):
+        self.db = db
+        self.nodes = {}
+
+    def fetch(self, node_ids):
+        missing = set([ObjectId(node_id) for node_id in node_ids]) - set(self.nodes)
+        if missing:
+            for node in self.db.nodes.find({'_id': {'$in': list(missing)}}, self.projection):
+                self.nodes[node['_id']] = node
+            for node_id in missing:
+                self.nodes.setdefault(node_id, None)
+
+    def prefetch(self, nodes):
+        """Read the ancestors, groups and inheritance tree nodes of the nodes
+        and then the OUs of those groups."""
+        node_ids = set()
+        for node in nodes:
+            node_ids.update(get_ancestors(node.get('path', '')))
+            node_ids.update([text_type(group_id) for group_id in node.get('memberof', [])])
+            if node.get('inheritance'):
+                node_ids.update(_get_inheritance_tree_ids(node['inheritance']))
+        node_ids.discard('root')
+        self.fetch(node_ids)
+
+        groups_ous = set()
+        for node in list(self.nodes.values()):
+            if node and node['type'] == 'group':
+                groups_ous.add(node['path'].split(',')[-1])
+        groups_ous.discard('root')
+        self.fetch(groups_ous)
+
+    def find_one(self, node_id):
+        self.fetch([node_id])
+        return self.nodes[ObjectId(node_id)]
+
+    def find(self, node_ids, node_type=None, sort=None):
+        # Same order as the $in queries on the _id index
+        node_ids = sorted(set([ObjectId(node_id) for node_id in node_ids]))
+        self.fetch(node_ids)
+        nodes = [self.nodes[node_id] for node_id in node_ids
+                 if self.nodes[node_id] and (node_type is None or self.nodes[node_id]['type'] == node_type)]
+        for field, direction in reversed(sort or []):
+            nodes.sort(key=lambda x: x[field], reverse=(direction == -1))
+        return nodes
+
+
+def _get_inheritance_tree_ids(inheritanceTree):
+    node_ids = [inheritanceTree['_id']]
+    for child in inheritanceTree.get('children', []):
+        node_ids.extend(_get_inheritance_tree_ids(child))
+    return node_ids
+
+
+def _find_node(db, node_id, nodes_cache=None):
+    if nodes_cache is None:
+        return db.nodes.find_one({'_id': ObjectId(node_id)})
+    return nodes_cache.find_one(node_id)
+
+
+def _find_nodes(db, node_ids, node_type=None, sort=None, nodes_cache=None):
+    if nodes_cache is not None:
+        return nodes_cache.find(node_ids, node_type, sort)
+    node_filter = {'_id': {'$in': [ObjectId(node_id) for node_id in node_ids]}}
+    if node_type is not None:
+        node_filter['type'] = node_type
+    cursor = db.nodes.find(node_filter)
+    if sort:
+        cursor = cursor.sort(sort)
+    return list(cursor)
+
+# ------------------------------------------------------------------------------------------------------
+def order_groups_by_depth(db, groups_ids, nodes_cache=None):
     """Function that orders a group list by depth.
         (when several groups have the same depth they will be ordered in alphabetic order).
 
@@ -1196,13 +2136,12 @@ def order_groups_by_depth(db, groups_ids):
     if not isinstance(groups_ids, list):
         raise ValueError('groups_ids is not a list')      
     
-    groups_ids = [ObjectId(groups_id) for groups_id in groups_ids]
-    groups = [group for group in db.nodes.find({'_id': {'$in': groups_ids}, 'type': 'group'}).sort([('name',-1)])]
+    groups = _find_nodes(db, groups_ids, 'group', [('name',-1)], nodes_cache)
     groups.sort(key=lambda x: x['path'].count(','), reverse=True)
     return [text_type(group['_id']) for group in groups]
 
 # ------------------------------------------------------------------------------------------------------
-def order_ou_by_depth(db, ou_ids):
+def order_ou_by_depth(db, ou_ids, nodes_cache=None):
     """Function that orders an ou list by depth.
 
     Args:
@@ -1224,13 +2163,12 @@ def order_ou_by_depth(db, ou_ids):
     if not isinstance(ou_ids, list):
         raise ValueError('ou_ids is not a list')          
     
-    ou_ids = [ObjectId(ou_id) for ou_id in ou_ids]
-    ous = [ou for ou in db.nodes.find({'_id': {'$in': ou_ids}, 'type': 'ou'})]
+    ous = _find_nodes(db, ou_ids, 'ou', nodes_cache=nodes_cache)
     ous.sort(key=lambda x: x['path'].count(','), reverse=True)
     return [text_type(ou['_id']) for ou in ous]
 
 # ------------------------------------------------------------------------------------------------------
-def get_priority_node(db, nodes_list):
+def get_priority_node(db, nodes_list, nodes_cache=None):
     """Function that the object with the top priority of the list.
 
     Args:
@@ -1254,26 +2192,25 @@ def get_priority_node(db, nodes_list):
     priority_node = None
 
     # Check if there is a computer in the list
-    nodes_ids = [ObjectId(node_id) for node_id in nodes_list]
-    computers = [computer for computer in db.nodes.find({'_id': {'$in': nodes_ids}, 'type': 'computer'})]
+    computers = _find_nodes(db, nodes_list, 'computer', nodes_cache=nodes_cache)
     if len(computers) > 0:
         priority_node = str(computers[0]['_id'])
     
     if priority_node is None:
         # Check if there is an user in the list
-        users = [user for user in db.nodes.find({'_id': {'$in': nodes_ids}, 'type': 'user'})]
+        users = _find_nodes(db, nodes_list, 'user', nodes_cache=nodes_cache)
         if len(users) > 0:
             priority_node = str(users[0]['_id'])
         
     if priority_node is None:
         # Check if there is an group in the list
-        groups = order_groups_by_depth(db, nodes_list)
+        groups = order_groups_by_depth(db, nodes_list, nodes_cache)
         if len(groups) > 0:
             priority_node = groups[0]
         
     if priority_node is None:
         # Check if there is an OU in the list
-        ous = order_ou_by_depth(db, nodes_list)
+        ous = order_ou_by_depth(db, nodes_list, nodes_cache)
         if len(ous) > 0:
             priority_node = ous[0]
             
@@ -1462,7 +2399,7 @@ def recalculate_path_values(logger, inheritanceTree, path_value, main_ou_list):
         recalculate_path_values(logger, child, pv, main_ou_list)
 
 # ------------------------------------------------------------------------------------------------------
-def move_in_inheritance(logger, db, obj, inheritanceTree):
+def move_in_inheritance(logger, db, obj, inheritanceTree, nodes_cache=None):
     """Move an object to another position in the inheritance Tree.
 
     Args:
@@ -1470,6 +2407,7 @@ def move_in_inheritance(logger, db, obj, inheritanceTree):
         db (object): Mongo DB access object.
         obj (object): Node (computer, user, OU or group) that received the change.
         inheritanceTree (object): Tree of inheritance objects
+        nodes_cache (NodesCache): Optional cache used to read the OUs.
 
     Returns:
         nodes_added: The return value. A list of nodes added to the inheritance tree.
@@ -1521,12 +2459,12 @@ def move_in_inheritance(logger, db, obj, inheritanceTree):
                 while 'parent' in root_node:
                     root_node = root_node['parent']
                 
-                real_base_node = db.nodes.find_one({'_id': ObjectId(base_node['_id'])})
+                real_base_node = _find_node(db, base_node['_id'], nodes_cache)
                 if not real_base_node:
                     logger.error("utils.py ::: move_in_inheritance - real base node not found %s" % str(base_node['_id']))
                     return False                
                 
-                result = move_in_inheritance(logger, db, real_base_node, root_node)
+                result = move_in_inheritance(logger, db, real_base_node, root_node, nodes_cache)
                 if result:
                     nodes_added.extend(result)
                     
@@ -1549,7 +2487,7 @@ def move_in_inheritance(logger, db, obj, inheritanceTree):
                         
                     # Get ou from mongoDB
                     logger.debug("utils.py ::: move_in_inheritance - final ou_id=%s" %(ou_id))
-                    ou = db.nodes.find_one({'_id': ObjectId(ou_id)})
+                    ou = _find_node(db, ou_id, nodes_cache)
                     if not ou:
                         logger.error("utils.py ::: move_in_inheritance - OU not found %s" % str(ou_id))
                         return False
@@ -1586,7 +2524,7 @@ def move_in_inheritance(logger, db, obj, inheritanceTree):
             key_exists = ('parent' in child)
             
             child['parent'] = inheritanceTree
-            result = move_in_inheritance(logger, db, obj, child)
+            result = move_in_inheritance(logger, db, obj, child, nodes_cache)
             if result:
                 # Result may be False in case of error
                 nodes_added.extend(result)
@@ -1644,7 +2582,7 @@ def recalculate_policies_for_computers(logger, db, srcobj, computers):
         
         # Recalculate policies for the source node
         for policy_id in srcobj['policies']:
-            policydata = db.policies.find_one({'_id': ObjectId(policy_id)})
+            policydata = get_policy(db, policy_id)
             if not policydata:
                 logger.error("recalculate_policies_for_computers - Policy not found %s" % str(policy_id))
                 return False             
@@ -1708,7 +2646,7 @@ def move_in_inheritance_and_recalculate_policies(logger, db, srcobj, obj):
             return False                
             
         for policy_id in newnode['policies']:
-            policydata = db.policies.find_one({'_id': ObjectId(policy_id)})
+            policydata = get_policy(db, policy_id)
             if not policydata:
                 logger.error("move_in_inheritance_and_recalculate_policies - Policy not found %s" % str(policy_id))
                 return False             
@@ -1726,7 +2664,7 @@ def move_in_inheritance_and_recalculate_policies(logger, db, srcobj, obj):
             return False                
             
         for policy_id in  ou['policies']:
-            policydata = db.policies.find_one({'_id': ObjectId(policy_id)})
+            policydata = get_policy(db, policy_id)
             if not policydata:
                 logger.error("move_in_inheritance_and_recalculate_policies - Policy not found %s" % str(policy_id))
                 return False             
@@ -1748,7 +2686,7 @@ def move_in_inheritance_and_recalculate_policies(logger, db, srcobj, obj):
             
             if 'policies' in group:
                 for policy_id in group['policies'].keys():
-                    policy = db.policies.find_one({"_id": ObjectId(policy_id)})
+                    policy = get_policy(db, policy_id)
                     recalculate_inheritance_for_node(logger, db, 'changed', group, policy, obj)            
             
         # Recalculate path values
@@ -1775,7 +2713,7 @@ def move_in_inheritance_and_recalculate_policies(logger, db, srcobj, obj):
             
             if 'policies' in obj:
                 for policy_id in obj['policies'].keys():
-                    policy = db.policies.find_one({"_id": ObjectId(policy_id)})
+                    policy = get_policy(db, policy_id)
                     recalculate_inheritance_for_node(logger, db, 'changed', obj, policy, member)            
             
             # Update node in mongo db
@@ -2134,13 +3072,14 @@ def apply_change_in_inheritance(logger, db, action, obj, policy, node, inheritan
     return found
 
 # ------------------------------------------------------------------------------------------------------
-def calculate_initial_inheritance_for_node(logger, db, node):
+def calculate_initial_inheritance_for_node(logger, db, node, nodes_cache=None):
     """Function that calculates the initial "inheritance" field of a node.
 
     Args:
         logger (object): Logger.
         db (object): Mongo DB access object.
         node (object): Node whose inheritance field must be recalculated.
+        nodes_cache (NodesCache): Optional cache used to read the OUs and groups.
 
     Returns:
         bool: The return value. True for success, False otherwise.
@@ -2184,7 +3123,7 @@ def calculate_initial_inheritance_for_node(logger, db, node):
             for ou_id in node.get('path').split(','):
                 if ou_id != 'root':
                     # Get ou from mongoDB
-                    ou = db.nodes.find_one({'_id': ObjectId(ou_id)})
+                    ou = _find_node(db, ou_id, nodes_cache)
                     if not ou:
                         logger.error("utils.py ::: calculate_initial_inheritance_for_node - OU not found %s" % str(ou_id))
                         return False
@@ -2215,15 +3154,14 @@ def calculate_initial_inheritance_for_node(logger, db, node):
         
             if 'memberof' in node:
                 # Add the groups in order (depth and aphabetic)
-                groups_ids = [ObjectId(group_id) for group_id in node['memberof']]
-                groups = [group for group in db.nodes.find({'_id': {'$in': groups_ids}}).sort([('name',1)])]
+                groups = _find_nodes(db, node['memberof'], sort=[('name',1)], nodes_cache=nodes_cache)
                 groups.sort(key=lambda x: x['path'].count(','), reverse=False)
                 
                 for group in groups:
                     group_ou_id = group['path'].split(',')[-1]
                     if previousOU['_id'] != group_ou_id:
                         # Get ou from mongoDB
-                        ou = db.nodes.find_one({'_id': ObjectId(group_ou_id)})
+                        ou = _find_node(db, group_ou_id, nodes_cache)
                         if not ou:
                             logger.error("utils.py ::: calculate_initial_inheritance_for_node - OU not found %s" % str(group_ou_id))
                             return False
@@ -2324,7 +3262,7 @@ def recalculate_inherited_field(logger, db, obj_id):
     
     
 # ------------------------------------------------------------------------------------------------------
-def recalculate_inheritance_for_node(logger, db, action, obj, policy, node):
+def recalculate_inheritance_for_node(logger, db, action, obj, policy, node, nodes_cache=None, updates=None):
     """Function that recalculate the "inheritance" field of a node by changing or deleting a policy in
     a related node.
 
@@ -2335,6 +3273,9 @@ def recalculate_inheritance_for_node(logger, db, action, obj, policy, node):
         obj (object): Node (computer, user, OU or group) that received the change.
         policy (object): Policy that is changed or deleted.
         node (object): Node whose inheritance field must be recalculated.
+        nodes_cache (NodesCache): Optional cache used to read the related nodes.
+        updates (list): Optional list where the update of the node is added
+                        instead of being written to mongo db.
 
     Returns:
         bool: The return value. True for success, False otherwise.
@@ -2376,12 +3317,12 @@ def recalculate_inheritance_for_node(logger, db, action, obj, policy, node):
         return False
     
     # Calculate inheritance tree for the first time when neccessary
-    if not calculate_initial_inheritance_for_node(logger, db, node):
+    if not calculate_initial_inheritance_for_node(logger, db, node, nodes_cache):
         return False
         
     if action == 'created':
         # The object is being moved to a new position in the nodes tree
-        move_in_inheritance(logger, db, obj, node['inheritance'])
+        move_in_inheritance(logger, db, obj, node['inheritance'], nodes_cache)
         
         
         
@@ -2395,14 +3336,17 @@ def recalculate_inheritance_for_node(logger, db, action, obj, policy, node):
             logger.debug("utils.py ::: recalculate_inheritance_for_node - policy_id: {0}".format(str(policy['_id'])))
             node_list = get_inheritance_tree_node_list(node['inheritance'], str(policy['_id']))
             logger.debug("utils.py ::: recalculate_inheritance_for_node - node_list: {0}".format(node_list))
-            priority_node = get_priority_node(db, node_list)
+            priority_node = get_priority_node(db, node_list, nodes_cache)
                 
             logger.debug("utils.py ::: recalculate_inheritance_for_node - priority object: %s" % str(priority_node))
             logger.debug("utils.py ::: recalculate_inheritance_for_node - inheritance: {0}".format(node['inheritance']))
             set_inherited_field(logger, node['inheritance'], str(policy['_id']), node_list, str(priority_node))
     
         # Update node in mongo db
-        db.nodes.update_one({'_id': node['_id']}, {'$set':{'inheritance': node['inheritance']}})
+        if updates is None:
+            db.nodes.update_one({'_id': node['_id']}, {'$set':{'inheritance': node['inheritance']}})
+        else:
+            updates.append(pymongo.UpdateOne({'_id': node['_id']}, {'$set':{'inheritance': node['inheritance']}}))
     
     return success
                         
@@ -2463,10 +3407,9 @@ def trace_inheritance(logger, db, action, obj, policy):
     if obj['type'] == 'ou':
         # If a policy is changed in an OU this change will affect other OUs, users and computers
         # but not groups (and to itself)
-        targets = policy['targets']
-        targets.remove('group')
+        targets = [target for target in policy['targets'] if target != 'group']
         logger.info("utils.py ::: trace_inheritance - obj is OU = {0}".format(obj['name']))
-        affected_nodes = list(db.nodes.find({'path': {'$regex': '.*' + text_type(obj['_id']) + '.*'}, 
+        affected_nodes = list(db.nodes.find({'ancestors': get_filter_nodes_belonging_ou(obj['_id']),
                                     'type':{'$in': targets}}))
         affected_nodes.append(obj)
              
@@ -2491,11 +3434,24 @@ def trace_inheritance(logger, db, action, obj, policy):
         logger.error("utils.py ::: trace_inheritance - Bad node type = {0} for node = {1}".format(obj['type'], obj['_id']))
         return False
 
+    # The related OUs and groups of all the affected nodes are read at once
+    # and the new inheritance trees are written in bulk
+    nodes_cache = NodesCache(db)
+    nodes_cache.prefetch(affected_nodes + [obj])
+    updates = []
+
     success = True
     for node in affected_nodes:
         logger.debug("utils.py ::: trace_inheritance - affected_node = {0} - {1}".format(node['name'], node['type']))
-        success = (success and recalculate_inheritance_for_node(logger, db, action, obj, policy, node))
+        success = (success and recalculate_inheritance_for_node(logger, db, action, obj, policy, node,
+                                                                nodes_cache, updates))
         logger.debug("utils.py ::: trace_inheritance - success = {0}".format(success))
+        if len(updates) >= INHERITANCE_BULK_SIZE:
+            db.nodes.bulk_write(updates, ordered=False)
+            updates = []
+
+    if updates:
+        db.nodes.bulk_write(updates, ordered=False)
 
     return success
 
@@ -2594,6 +3550,8 @@ def mongodb_restore(path=None, collection=None):
 
         exitstatus = mongodb.restore(path, collection)
         logger.info("mongodb restored from backup.")
+        if collection is None or collection == 'policies':
+            invalidate_policies_cache(mongodb.get_database())
 
     except AssertionError as msg:
         logger.warning(msg)
@@ -2635,6 +3593,7 @@ def upload_cookbook(user=None,cookbook_path=None):
         upload_output = subprocess.check_output(command, shell=True)
         logger.info(upload_output)
         logger.info("Uploaded cookbook.")
+        cookbook_cache.clear()
         
     except AssertionError as msg:
         logger.warning(msg)
@@ -29,9 +29,9 @@ from gecoscc.models import (AdminUser, AdminUserVariables, Maintenance, UpdateMo
     AdminUserOUPerm, Permissions)
 from gecoscc.pagination import create_pagination_mongo_collection
 from gecoscc.utils import delete_chef_admin_user, get_chef_api, toChefUsername, getNextUpdateSeq, get_filter_nodes_belonging_ou,\
-    SERIALIZED_UPDATE_PATTERN
+    invalidate_reports_cache, SERIALIZED_UPDATE_PATTERN
 from gecoscc.tasks import script_runner
-from gecoscc.views.reports import get_complete_path
+from gecoscc.views.reports import CompletePathResolver
 
 import os
 import pymongo
@@ -300,6 +300,7 @@ def admin_delete(context, request):
     if not success_remove_chef:
         messages.created_msg(request, _('User deleted unsuccessfully from chef'), 'danger')
     request.userdb.delete_user({'username': username})
+    invalidate_reports_cache(request.db, ('permission',))
     messages.created_msg(request, _('User deleted successfully'), 'success')
     return {'ok': 'ok'}
 
@@ -550,9 +551,12 @@ def statistics(context, request):
             {"_id": { "$in": list(map(ObjectId, oids)) }},
             {"_id": 1, "name": 1, "path": 1}
         )
-    for ou in ous_visibles:
-        path = ou['path'] + ',' + str(ou['_id'])
-        ous.update({str(ou['_id']): get_complete_path(request.db, path)})
+    paths = dict((str(ou['_id']), ou['path'] + ',' + str(ou['_id']))
+                 for ou in ous_visibles)
+    resolver = CompletePathResolver(request.db)
+    resolver.prefetch(list(paths.values()))
+    for oid, path in paths.items():
+        ous.update({oid: resolver.get_complete_path(path)})
 
     sorted_ous = collections.OrderedDict(sorted(list(ous.items()), key=lambda kv: len(kv[1])))
     logger.debug("admins.py ::: statistics - sorted_ous = {}".format(sorted_ous))
@@ -563,20 +567,36 @@ def statistics(context, request):
 
     logger.debug("admins.py ::: statistics - ou_id = {}".format(ou_id))
 
-    # Objects
-    object_counters = request.db.nodes.aggregate([
-        {"$match" : { "path": get_filter_nodes_belonging_ou(ou_id)}},
-        {"$group" : { "_id" : "$type", "count": {"$sum":1}}}
-    ], cursor={})
+    # Objects and policies counted with a single aggregation
+    # (the OU itself is only counted in the policies)
+    ou_filter = get_filter_nodes_belonging_ou(ou_id)
+    counters = next(request.db.nodes.aggregate([
+        {"$match": {"$or": [{"ancestors": ou_filter}, {"_id": ObjectId(ou_id)}]}},
+        {"$project": {"type": 1, "ancestors": 1, "policies": 1}},
+        {"$facet": {
+            "objects": [
+                {"$match": {"ancestors": ou_filter}},
+                {"$group": {"_id": "$type", "count": {"$sum": 1}}}
+            ],
+            "policies": [
+                {"$project": {"policies": {"$cond": [
+                    {"$eq": [{"$type": "$policies"}, "object"]},
+                    {"$objectToArray": "$policies"},
+                    []
+                ]}}},
+                {"$unwind": "$policies"},
+                {"$group": {"_id": "$policies.k", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]))
+    object_counters = counters['objects']
 
     logger.debug("admins.py ::: statistics - object_counters = {}".format(object_counters))
 
     # Policies
-    for pol in request.db.policies.find().sort("name"):
-        c = request.db.nodes.count_documents({
-            "$or": [{"path": get_filter_nodes_belonging_ou(ou_id)}, {"_id":ObjectId(ou_id)}],
-            "policies." + str(pol['_id']): {'$exists': True}
-        })
+    policy_uses = dict((counter['_id'], counter['count']) for counter in counters['policies'])
+    for pol in request.db.policies.find({}, {"name": 1, policyname: 1}).sort("name"):
+        c = policy_uses.get(str(pol['_id']), 0)
         try:
             policy_counters.append([pol[policyname],c])
         except KeyError:
@@ -14,6 +14,9 @@ from builtins import object
 from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest
 from pyramid.view import view_config
 from bson import ObjectId
+from gridfs.errors import NoFile
+
+from gecoscc.utils import open_computer_log_file, delete_computer_log_files
 
 import logging
 logger = logging.getLogger(__name__)
@@ -33,8 +36,10 @@ class TXTRenderer(object):
             response = request.response
             response.content_type = 'text/plain'
             response.content_encoding = value.get('encoding', '')
-            response.content_length = len(value.get('data', ''))
+            if isinstance(value.get('data', ''), (str, bytes)):
+                response.content_length = len(value.get('data', ''))
 
+        # An iterator is streamed as the application iterator of the response
         return value.get('data', '')
 
 
@@ -75,23 +80,25 @@ def get_log_file(context, request):
         logging.error('/computer/logs: computer not found with node_id=%s'%(node_id))
         raise HTTPNotFound()
 
-    data = ''    
+    fdata = None
     if ('logs' in computer and 
         'files' in computer['logs'] and 
         len(computer['logs']['files'])>0):
-        
-        fdata = None
         for filedata in computer['logs']['files']:
             if filedata['filename'] == filename:
                 fdata = filedata
                 break
-        
-        data = fdata['content']
-        
-    else:
+
+    if fdata is None:
         logging.error('/computer/logs: log file not found: %s'%(filename))
         raise HTTPNotFound()
-        
+
+    try:
+        data = open_computer_log_file(request.db, fdata)
+    except NoFile:
+        logging.error('/computer/logs: log file content not found: %s'%(filename))
+        raise HTTPNotFound()
+
     return {'encoding': 'utf-8',
             'data': data}
 
@@ -130,6 +137,7 @@ def delete_log_file(context, request):
         
         if fdata is not None:
             computer['logs']['files'].remove(fdata)
+            delete_computer_log_files(request.db, [fdata])
             
         if len(computer['logs']['files']) > 0:
             # Remove only a log
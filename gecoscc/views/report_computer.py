@@ -12,7 +12,9 @@
 import logging
 import datetime
 
-from gecoscc.views.reports import (treatment_string_to_csv,
+from pymongo import ASCENDING
+
+from gecoscc.views.reports import (REPORT_COLLATION, treatment_string_to_csv,
     treatment_string_to_pdf, get_html_node_link, check_visibility_of_ou)
 from gecoscc.utils import get_filter_nodes_belonging_ou
 
@@ -73,7 +75,10 @@ def report_computer(context, request, file_ext):
 
     # Get user data
     query = request.db.nodes.find(
-            {'type': 'computer', 'path': get_filter_nodes_belonging_ou(ou_id)})
+            {'type': 'computer', 'ancestors': get_filter_nodes_belonging_ou(ou_id)})
+
+    # The rows of every format are sorted by MongoDB
+    query = query.sort('name', ASCENDING).collation(REPORT_COLLATION)
 
     if file_ext == 'pdf':
         rows = [(treatment_string_to_pdf(item, 'name', 20),
@@ -83,13 +88,13 @@ def report_computer(context, request, file_ext):
                  #treatment_string_to_pdf(item, 'node_chef_id', 25),
                  item['_id']) for item in query]
     else:
-        rows = [(treatment_string_to_csv(item, 'name') if file_ext == 'csv' \
+        rows = ((treatment_string_to_csv(item, 'name') if file_ext == 'csv' \
                     else get_html_node_link(item),
                  treatment_string_to_csv(item, 'family'),
                  treatment_string_to_csv(item, 'registry'),
                  treatment_string_to_csv(item, 'serial'),
                  #treatment_string_to_csv(item, 'node_chef_id'),
-                 item['_id']) for item in query]
+                 item['_id']) for item in query)
     
     header = (_(u'Name'),
               _(u'Type'),
@@ -103,11 +108,6 @@ def report_computer(context, request, file_ext):
     title =  _(u'Computers report')
     now = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
         
-    # Sort rows
-    # TODO: Use MongoDB Collations to do a "ignore_case" sorting
-    # (MongoDB 2.6 does not support "ignore case" sorting)   
-    rows = sorted(rows, key = lambda i: (i[0].lower()))
-        
     return {'headers': header,
             'rows': rows,
             'widths': widths,
@@ -0,0 +1,218 @@
+#
+# Copyright 2021, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+import datetime
+import logging
+import os
+
+from bson import ObjectId
+from pyramid.httpexceptions import (HTTPBadRequest, HTTPForbidden,
+    HTTPNotFound)
+from pyramid.renderers import render
+from pyramid.response import FileResponse
+from pyramid.threadlocal import get_current_registry
+from pyramid.view import view_config
+
+from gecoscc.views.reports import (CSVRenderer, PDFRenderer,
+    check_visibility_of_ou, is_ou_visible)
+from gecoscc.views.report_audit import report_audit
+from gecoscc.views.report_computer import report_computer
+from gecoscc.views.report_no_computer_users import report_no_computer_users
+from gecoscc.views.report_no_user_computers import report_no_user_computers
+from gecoscc.views.report_permission import report_permission
+from gecoscc.views.report_printers import report_printers
+from gecoscc.views.report_status import report_status
+from gecoscc.views.report_storages import report_storages
+from gecoscc.views.report_user import report_user
+from gecoscc.tasks import generate_report
+from gecoscc.utils import get_reports_data_version
+
+from gecoscc.i18n import gettext as _
+
+logger = logging.getLogger(__name__)
+
+# Report types: (report function, title, only for superusers)
+# The reports only for superusers are not restricted to an OU
+REPORTS = {
+    'user': (report_user, u'Users report', False),
+    'computer': (report_computer, u'Computers report', False),
+    'printers': (report_printers,
+                 u'Printers and related computers report', False),
+    'storages': (report_storages, u'Storages and related users report',
+                 False),
+    'no_user_computers': (report_no_user_computers, u'No-user computers',
+                          False),
+    'no_computer_users': (report_no_computer_users,
+                          u'No-computer users report', False),
+    'status': (report_status, u'Computer with anomalies', False),
+    'permission': (report_permission, u'Permissions report', True),
+    'audit': (report_audit, u'Audit report', True),
+}
+
+REPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'pdf': 'application/pdf',
+    'html': 'text/html',
+}
+
+
+def get_report_artifact(db, report_type, file_ext, ou_id, locale):
+    '''
+    Get the cached file of a report if it was generated with the current
+    version of its data.
+    '''
+    version = get_reports_data_version(db, report_type, ou_id)
+    if version is None:
+        return None
+    return db.report_artifacts.find_one({
+        'report_type': report_type,
+        'format': file_ext,
+        'ou_id': ou_id,
+        'locale': locale,
+        'version': version
+    })
+
+
+def render_report(request, report_type, file_ext):
+    '''
+    Generate a report and return an iterator of its encoded content.
+    '''
+    value = REPORTS[report_type][0](None, request, file_ext)
+    if file_ext == 'csv':
+        return CSVRenderer(None)(value, {})
+    if file_ext == 'pdf':
+        return [PDFRenderer(None)(value, {})]
+    return [render('gecoscc:templates/report.jinja2', value,
+                   request=request).encode('utf-8')]
+
+
+def save_report_artifact(request, report_type, file_ext, ou_id, version):
+    '''
+    Generate a report into a file of the reports directory and save it in the
+    "report_artifacts" collection. The older files of the same report are
+    removed.
+
+    The data version must be read before the report is generated, so a
+    change of the data while it is generated is not hidden by the cache.
+    '''
+    db = request.db
+    settings = get_current_registry().settings
+    reports_dir = settings.get('reports.dir')
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+
+    artifact_id = ObjectId()
+    path = os.path.join(reports_dir, '{0}.{1}'.format(artifact_id, file_ext))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        for chunk in render_report(request, report_type, file_ext):
+            fout.write(chunk)
+    os.rename(tmp_path, path)
+
+    artifact = {
+        '_id': artifact_id,
+        'report_type': report_type,
+        'format': file_ext,
+        'ou_id': ou_id,
+        'locale': request.locale_name,
+        'version': version,
+        'path': path,
+        'created': datetime.datetime.utcnow()
+    }
+    db.report_artifacts.insert_one(artifact)
+
+    old_artifacts = db.report_artifacts.find({
+        '_id': {'$ne': artifact_id},
+        'report_type': report_type,
+        'format': file_ext,
+        'ou_id': ou_id,
+        'locale': artifact['locale']
+    })
+    for old_artifact in old_artifacts:
+        if os.path.isfile(old_artifact['path']):
+            os.remove(old_artifact['path'])
+        db.report_artifacts.delete_one({'_id': old_artifact['_id']})
+
+    return artifact
+
+
+@view_config(route_name='report_job', renderer='json', permission='edit')
+def report_job(context, request):
+    '''
+    Generate a report in background. If the report was already generated
+    with the current data the URL of its file is returned, otherwise a job is
+    created and the download link is shown in the job when it finishes.
+    '''
+    report_type = request.GET.get('type')
+    file_ext = request.GET.get('format')
+    if report_type not in REPORTS or file_ext not in REPORT_CONTENT_TYPES:
+        raise HTTPBadRequest()
+
+    title, superuser_only = REPORTS[report_type][1:]
+    if superuser_only:
+        if not request.user.get('is_superuser', False):
+            raise HTTPForbidden()
+        ou_id = None
+        obj = {'_id': request.user['_id'],
+               'name': request.user['username'],
+               'path': 'root',
+               'type': 'user'}
+    else:
+        ou_id = check_visibility_of_ou(request)
+        if ou_id is None:
+            raise HTTPBadRequest()
+        obj = request.db.nodes.find_one({'_id': ObjectId(ou_id)})
+
+    artifact = get_report_artifact(request.db, report_type, file_ext, ou_id,
+                                   request.locale_name)
+    if artifact is not None:
+        return {'url': request.route_url('report_download',
+                                         artifact_id=str(artifact['_id']))}
+
+    macrojob_id = request.jobs.create(
+        obj=obj,
+        op='report',
+        status='processing',
+        policy={'name': _(title)},
+        administrator_username=request.user['username'],
+        message=_('Generating report'))
+    generate_report.delay(request.user, report_type, file_ext, ou_id,
+                          request.locale_name, macrojob_id)
+
+    return {'jobid': str(macrojob_id),
+            'message': _('The report is being generated. A download link '
+                         'will be shown in the actions panel when it is '
+                         'done.')}
+
+
+@view_config(route_name='report_download', permission='edit')
+def report_download(context, request):
+    artifact_id = request.matchdict['artifact_id']
+    if not ObjectId.is_valid(artifact_id):
+        raise HTTPNotFound()
+    artifact = request.db.report_artifacts.find_one(
+        {'_id': ObjectId(artifact_id)})
+    if artifact is None or not os.path.isfile(artifact['path']):
+        raise HTTPNotFound()
+
+    if artifact['ou_id'] is None:
+        is_visible = request.user.get('is_superuser', False)
+    else:
+        is_visible = is_ou_visible(request, artifact['ou_id'])
+    if not is_visible:
+        raise HTTPForbidden()
+
+    response = FileResponse(
+        artifact['path'],
+        request=request,
+        content_type=REPORT_CONTENT_TYPES[artifact['format']]
+    )
+    if artifact['format'] != 'html':
+        response.content_disposition = 'attachment;filename=report_{0}.{1}'\
+            .format(artifact['report_type'], artifact['format'])
+    return response
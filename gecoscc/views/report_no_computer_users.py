@@ -12,7 +12,9 @@
 import logging
 import datetime
 
-from gecoscc.views.reports import (treatment_string_to_csv,
+from pymongo import ASCENDING
+
+from gecoscc.views.reports import (REPORT_COLLATION, treatment_string_to_csv,
     treatment_string_to_pdf, get_html_node_link, check_visibility_of_ou)
 from gecoscc.utils import get_filter_nodes_belonging_ou
 
@@ -72,9 +74,12 @@ def report_no_computer_users(context, request, file_ext):
 
     # Get user data
     query = request.db.nodes.find(
-        {'type': 'user', 'path': get_filter_nodes_belonging_ou(ou_id),
+        {'type': 'user', 'ancestors': get_filter_nodes_belonging_ou(ou_id),
          'computers': []})
 
+    # The rows of every format are sorted by MongoDB
+    query = query.sort('name', ASCENDING).collation(REPORT_COLLATION)
+
     rows = []
     
     if file_ext == 'pdf':
@@ -85,14 +90,14 @@ def report_no_computer_users(context, request, file_ext):
                 treatment_string_to_pdf(item, 'address', 35),
                 item['_id']) for item in query]
     else:
-        rows = [(treatment_string_to_csv(item, 'name') if file_ext == 'csv' \
+        rows = ((treatment_string_to_csv(item, 'name') if file_ext == 'csv' \
                     else get_html_node_link(item),
                 treatment_string_to_csv(item, 'first_name'),
                 treatment_string_to_csv(item, 'last_name'),
                 treatment_string_to_csv(item, 'email'),
                 treatment_string_to_csv(item, 'phone'),
                 treatment_string_to_csv(item, 'address'),
-                item['_id']) for item in query]
+                item['_id']) for item in query)
                       
                 
     
@@ -114,11 +119,6 @@ def report_no_computer_users(context, request, file_ext):
     title =  _(u'No-computer users report')
     now = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
         
-    # Sort rows
-    # TODO: Use MongoDB Collations to do a "ignore_case" sorting    
-    # (MongoDB 2.6 does not support "ignore case" sorting)   
-    rows = sorted(rows, key = lambda i: (i[0].lower()))    
-        
     return {'headers': header,
             'rows': rows,
             'default_order': [[ 0, 'asc' ]],
@@ -12,7 +12,9 @@
 import logging
 import datetime
 
-from gecoscc.views.reports import (treatment_string_to_csv,
+from pymongo import ASCENDING
+
+from gecoscc.views.reports import (REPORT_COLLATION, treatment_string_to_csv,
     treatment_string_to_pdf, get_html_node_link, check_visibility_of_ou)
 from gecoscc.utils import get_filter_nodes_belonging_ou
 from gecoscc.tasks import ChefTask
@@ -74,25 +76,28 @@ def report_no_user_computers(context, request, file_ext):
 
     task = ChefTask()
     related_computers = []
-    related_objects = []
+    related_objects = set()
     
-    filters = ({'type': 'user','path': get_filter_nodes_belonging_ou(ou_id)})
+    filters = ({'type': 'user','ancestors': get_filter_nodes_belonging_ou(ou_id)})
 
     logger.info("report_no_user_computers: filters = {}".format(filters))
 
     users = request.db.nodes.find(filters)
     for user in users:
-        related_computers = task.get_related_computers_of_user(
+        related_computers = task.get_related_computers(
             user, related_computers, related_objects)
 
     references = [c['_id'] for c in related_computers]
     logger.info("report_no_user_computers: references = {}".format(references))
-    filters2 = ({'type': 'computer','path': get_filter_nodes_belonging_ou(
+    filters2 = ({'type': 'computer','ancestors': get_filter_nodes_belonging_ou(
         ou_id)})
     filters2.update({'_id': {'$nin': [c['_id'] for c in related_computers]}})
     logger.info("report_no_user_computers: filters2 = {}".format(filters2))
     computers = request.db.nodes.find(filters2)
 
+    # The rows of every format are sorted by MongoDB
+    computers = computers.sort('name', ASCENDING).collation(REPORT_COLLATION)
+
     rows = []
     
     if file_ext == 'pdf':
@@ -103,13 +108,13 @@ def report_no_user_computers(context, request, file_ext):
                  item['node_chef_id'],
                  item['_id']) for item in computers]
     else:
-        rows = [(treatment_string_to_csv(item, 'name') if file_ext == 'csv' \
+        rows = ((treatment_string_to_csv(item, 'name') if file_ext == 'csv' \
                     else get_html_node_link(item),
                  treatment_string_to_csv(item, 'family'),
                  treatment_string_to_csv(item, 'registry'),
                  treatment_string_to_csv(item, 'serial'),
                  treatment_string_to_csv(item, 'node_chef_id'),
-                 item['_id']) for item in computers]
+                 item['_id']) for item in computers)
 
     header = (_(u'Name'),
               _(u'Type'),
@@ -123,11 +128,6 @@ def report_no_user_computers(context, request, file_ext):
     title =  _(u'No-user computers')
     now = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
         
-    # Sort rows
-    # TODO: Use MongoDB Collations to do a "ignore_case" sorting    
-    # (MongoDB 2.6 does not support "ignore case" sorting)   
-    rows = sorted(rows, key = lambda i: (i[0].lower()))     
-        
     return {'headers': header,
             'rows': rows,
             'default_order': [[ 0, 'asc' ]],
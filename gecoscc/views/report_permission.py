@@ -15,7 +15,7 @@ import datetime
 
 from gecoscc.views.reports import treatment_string_to_csv
 from gecoscc.views.reports import treatment_string_to_pdf
-from gecoscc.views.reports import get_complete_path
+from gecoscc.views.reports import CompletePathResolver
 
 from pyramid.view import view_config
 
@@ -110,9 +110,11 @@ def report_permission(context, request, file_ext):
     result = request.db.nodes.find({'_id': {'$in': ids}},{'_id':1, 'path':1})
     ou_paths = {}
 
-    for r in result:
-        path = r['path']+','+str(r['_id'])
-        ou_paths.update({str(r['_id']): get_complete_path(request.db, path)})
+    paths = dict((str(r['_id']), r['path']+','+str(r['_id'])) for r in result)
+    resolver = CompletePathResolver(request.db)
+    resolver.prefetch(list(paths.values()))
+    for oid, path in paths.items():
+        ou_paths.update({oid: resolver.get_complete_path(path)})
 
     logger.debug("report_permission: ou_paths = {}".format(ou_paths))
 
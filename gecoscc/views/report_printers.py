@@ -14,9 +14,10 @@ import logging
 import datetime
 
 from gecoscc.views.reports import (treatment_string_to_csv,
-    treatment_string_to_pdf, get_complete_path, get_html_node_link,
+    treatment_string_to_pdf, CompletePathResolver, get_html_node_link,
     check_visibility_of_ou)
-from gecoscc.utils import get_filter_nodes_belonging_ou
+from gecoscc.utils import (get_filter_nodes_belonging_ou, get_policy_by_slug,
+                           get_emitter_related_computers)
 from gecoscc.tasks import ChefTask
 
 from pyramid.view import view_config
@@ -50,6 +51,39 @@ def report_printers_html(context, request):
     return report_printers(context, request, 'html')
 
 
+def get_printer_computers(request, task, property_name, printer):
+    '''
+    Get the computers related with a printer.
+
+    The emitters index is used when it is built, otherwise the nodes
+    related with the printer are walked.
+    '''
+    computer_ids = get_emitter_related_computers(request.db, printer)
+    if computer_ids is not None:
+        return list(request.db.nodes.find(
+            {'_id': {'$in': computer_ids}, 'type': 'computer'},
+            {'name': True, 'path': True, 'type': True}))
+
+    # Get all nodes related with this printer
+    nodes_query = request.db.nodes.find(
+        {property_name: str(printer['_id'])})
+    related_computers = []
+    related_objects = set()
+    for node in nodes_query:
+        related_computers = task.get_related_computers(
+            node, related_computers, related_objects)
+
+    # Remove duplicated computers
+    computer_paths = []
+    computers = []
+    for computer in related_computers:
+        full_path = computer['path'] + '.' + computer['name']
+        if not full_path in computer_paths:
+            computer_paths.append(full_path)
+            computers.append(computer)
+    return computers
+
+
 def report_printers(context, request, file_ext):
     '''
     Generate a report with all the printers and its related computers.
@@ -73,12 +107,12 @@ def report_printers(context, request, file_ext):
         raise HTTPBadRequest()
 
     # Get printers policy
-    policy = request.db.policies.find_one({'slug': 'printer_can_view'})
+    policy = get_policy_by_slug(request.db, 'printer_can_view')
     property_name = 'policies.' + str(policy['_id']) + '.object_related_list'
     
     # Get all printers
     query = request.db.nodes.find(
-        {'type': 'printer', 'path': get_filter_nodes_belonging_ou(ou_id)})
+        {'type': 'printer', 'ancestors': get_filter_nodes_belonging_ou(ou_id)})
 
     task = ChefTask()
 
@@ -94,24 +128,9 @@ def report_printers(context, request, file_ext):
             row.append(treatment_string_to_pdf(item, 'serial', 15))
             row.append(treatment_string_to_pdf(item, 'registry', 15))
 
-            # Get all nodes related with this printer
-            nodes_query = request.db.nodes.find(
-                {property_name: str(item['_id'])})
-            related_computers = []
-            related_objects = []
-            for node in nodes_query:
-                related_computers = task.get_related_computers(
-                    node, related_computers, related_objects)
-            
-            # Remove duplicated computers
-            computer_paths = []
-            computers = []
-            for computer in related_computers:
-                full_path = computer['path'] + '.' + computer['name']
-                if not full_path in computer_paths:
-                    computer_paths.append(full_path)
-                    computers.append(computer)
-            
+            computers = get_printer_computers(request, task, property_name,
+                                              item)
+
             if len(computers) == 0:
                 row.append('--')
                 rows.append(row)
@@ -125,9 +144,13 @@ def report_printers(context, request, file_ext):
 
             
     else:
-        for item in query:
+        # The names of the OUs of all the paths are read at once
+        items = list(query)
+        resolver = CompletePathResolver(request.db)
+        resolver.prefetch([item['path'] for item in items])
+        for item in items:
             row = []
-            item['complete_path'] = get_complete_path(request.db, item['path'])
+            item['complete_path'] = resolver.get_complete_path(item['path'])
             row.append(treatment_string_to_csv(item, 'complete_path'))
             row.append(treatment_string_to_csv(item, 'name') \
                 if file_ext == 'csv' else get_html_node_link(item))
@@ -136,25 +159,9 @@ def report_printers(context, request, file_ext):
             row.append(treatment_string_to_csv(item, 'serial'))
             row.append(treatment_string_to_csv(item, 'registry'))
 
-            # Get all nodes related with this printer
-            nodes_query = request.db.nodes.find(
-                {property_name: str(item['_id'])})
-            related_computers = []
-            related_objects = []
-            for node in nodes_query:
-                related_computers = task.get_related_computers(
-                    node, related_computers, related_objects)
-
-            # Remove duplicated computers
-            computer_paths = []
-            computers = []
-            for computer in related_computers:
-                full_path = computer['path'] + '.' + computer['name']
-                if not full_path in computer_paths:
-                    computer_paths.append(full_path)
-                    computers.append(computer)
-
-                
+            computers = get_printer_computers(request, task, property_name,
+                                              item)
+
             if len(computers) == 0:
                 row.append('--')
                 rows.append(row)
@@ -165,8 +172,6 @@ def report_printers(context, request, file_ext):
                         computer, 'name') \
                             if file_ext == 'csv' \
                             else get_html_node_link(computer))
-                    computer['complete_path'] = get_complete_path(
-                        request.db, item['path'])
                     rows.append(computer_row)
         
     
@@ -84,7 +84,7 @@ def report_status(context, request, file_ext):
     
     # Get user data
     query = request.db.nodes.find(
-        {'type': 'computer','path': get_filter_nodes_belonging_ou(ou_id)}
+        {'type': 'computer','ancestors': get_filter_nodes_belonging_ou(ou_id)}
         ).sort(
         [('error_last_chef_client', pymongo.DESCENDING),
          ('last_agent_run_time', pymongo.DESCENDING),
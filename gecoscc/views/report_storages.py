@@ -14,9 +14,10 @@ import logging
 import datetime
 
 from gecoscc.views.reports import (treatment_string_to_csv,
-    get_complete_path, get_html_node_link,
+    CompletePathResolver, get_html_node_link,
     check_visibility_of_ou)
-from gecoscc.utils import get_filter_nodes_belonging_ou
+from gecoscc.utils import (get_filter_nodes_belonging_ou, get_policy_by_slug,
+                           is_emitters_index_built)
 
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPBadRequest
@@ -49,6 +50,23 @@ def report_storages_html(context, request):
     return report_storages(context, request, 'html')
 
 
+def get_storage_related_nodes(request, property_name, storage):
+    '''
+    Get the nodes related with a storage.
+
+    The emitters index is used when it is built, otherwise the nodes are
+    searched by the storage policy.
+    '''
+    if is_emitters_index_built(request.db):
+        emitter_index = request.db.emitters_index.find_one(
+            {'_id': storage['_id']}, {'nodes': True})
+        if emitter_index is not None:
+            return request.db.nodes.find(
+                {'_id': {'$in': emitter_index['nodes']}})
+
+    return request.db.nodes.find({property_name: str(storage['_id'])})
+
+
 def report_storages(context, request, file_ext):
     '''
     Generate a report with all the storages and its related users.
@@ -72,12 +90,12 @@ def report_storages(context, request, file_ext):
         raise HTTPBadRequest()
  
     # Get storages policy
-    policy = request.db.policies.find_one({'slug': 'storage_can_view'})
+    policy = get_policy_by_slug(request.db, 'storage_can_view')
     property_name = 'policies.' + str(policy['_id']) + '.object_related_list'
     
     # Get all storages
     query = request.db.nodes.find(
-        {'type': 'storage','path': get_filter_nodes_belonging_ou(ou_id)})
+        {'type': 'storage','ancestors': get_filter_nodes_belonging_ou(ou_id)})
 
     rows = []
     if file_ext == 'pdf':
@@ -90,14 +108,14 @@ def report_storages(context, request, file_ext):
             row.append(item['_id'])
             
             # Get all nodes related with this storage
-            nodes_query = request.db.nodes.find(
-                {property_name: str(item['_id'])})
+            nodes_query = get_storage_related_nodes(request, property_name,
+                                                    item)
             # Targets: ou, group or user
             users = []
             for node in nodes_query:
                 if node['type'] == 'ou':
                     users = list(request.db.nodes.find(
-                                    {'path': get_filter_nodes_belonging_ou(
+                                    {'ancestors': get_filter_nodes_belonging_ou(
                                         node['_id']),
                                     'type': 'user'}))
                 elif node['type'] == 'group':
@@ -121,9 +139,13 @@ def report_storages(context, request, file_ext):
 
             
     else:
-        for item in query:
+        # The names of the OUs of all the paths are read at once
+        items = list(query)
+        resolver = CompletePathResolver(request.db)
+        resolver.prefetch([item['path'] for item in items])
+        for item in items:
             row = []
-            item['complete_path'] = get_complete_path(request.db, item['path'])
+            item['complete_path'] = resolver.get_complete_path(item['path'])
             row.append(treatment_string_to_csv(item, 'complete_path'))
             if file_ext == 'csv':
                 row.append(treatment_string_to_csv(item, 'name'))
@@ -132,15 +154,15 @@ def report_storages(context, request, file_ext):
             row.append(treatment_string_to_csv(item, 'uri'))
             row.append(item['_id'])
             
-            # Get all nodes related with this printer
-            nodes_query = request.db.nodes.find(
-                {property_name: str(item['_id'])})
+            # Get all nodes related with this storage
+            nodes_query = get_storage_related_nodes(request, property_name,
+                                                    item)
             # Targets: ou, group or user
             users = []
             for node in nodes_query:
                 if node['type'] == 'ou':
                     users = list(request.db.nodes.find(
-                                    {'path': get_filter_nodes_belonging_ou(
+                                    {'ancestors': get_filter_nodes_belonging_ou(
                                         node['_id']),
                                     'type': 'user'}))
                 elif node['type'] == 'group':
@@ -160,8 +182,6 @@ def report_storages(context, request, file_ext):
                         user_row.append(treatment_string_to_csv(user, 'name'))
                     else: # html links
                         user_row.append(get_html_node_link(user))
-                    user['complete_path'] = get_complete_path(
-                        request.db, item['path'])
                     rows.append(user_row)
         
     
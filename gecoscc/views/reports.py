@@ -22,6 +22,7 @@ from xhtml2pdf import pisa
 from pyramid_jinja2 import IJinja2Environment
 from pyramid.threadlocal import get_current_registry
 from bson import ObjectId
+from pymongo.collation import Collation, CollationStrength
 import csv
 import os
 import gecoscc
@@ -33,30 +34,51 @@ from pyramid.view import view_config
 
 logger = logging.getLogger(__name__)
 
+# Case insensitive order of the report rows sorted by MongoDB (the same
+# collation of an index of the node names, see gecoscc.db)
+REPORT_COLLATION = Collation('en_US', caseLevel=True,
+                             strength=CollationStrength.PRIMARY)
+
 
 class CSVRenderer(object):
 
+    # Number of rows encoded in each chunk of the response
+    chunk_size = 500
+
     def __init__(self, info):
         pass
 
     def __call__(self, value, system):
-        """ Returns a plain CSV-encoded string with content-type
-        ``text/csv``. The content-type may be overridden by
+        """ Returns an iterator of CSV-encoded chunks with content-type
+        ``text/csv``, so the response is streamed to the client. The rows
+        may be a generator (i.e. a MongoDB cursor) that is consumed while
+        the response is sent. The content-type may be overridden by
         setting ``request.response.content_type``."""
 
+        charset = 'utf-8'
         request = system.get('request')
         if request is not None:
             response = request.response
             ct = response.content_type
             if ct == response.default_content_type:
                 response.content_type = 'text/csv'
+            charset = response.charset or charset
 
+        return self.iter_chunks(value.get('headers', []),
+                                value.get('rows', []), charset)
+
+    def iter_chunks(self, headers, rows, charset):
         fout = io.StringIO()
         writer = csv.writer(fout, delimiter=',', quotechar='"',
             quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(value.get('headers', []))
-        writer.writerows(value.get('rows', []))
-        return fout.getvalue()
+        writer.writerow(headers)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % self.chunk_size == 0:
+                yield fout.getvalue().encode(charset)
+                fout.seek(0)
+                fout.truncate()
+        yield fout.getvalue().encode(charset)
 
 
 def link_callback(uri, rel):
@@ -148,9 +170,12 @@ def reports(context, request):
             {'type': 'ou'}, 
             {'_id':1, 'name':1, 'path':1})
 
-    for ou in ou_visibles:
-        path = ou['path'] + ',' + str(ou['_id'])
-        ous.update({str(ou['_id']): get_complete_path(request.db, path)})
+    paths = dict((str(ou['_id']), ou['path'] + ',' + str(ou['_id']))
+                 for ou in ou_visibles)
+    resolver = CompletePathResolver(request.db)
+    resolver.prefetch(list(paths.values()))
+    for ou_id, path in paths.items():
+        ous.update({ou_id: resolver.get_complete_path(path)})
 
     sorted_ous = collections.OrderedDict(
         sorted(list(ous.items()), key=lambda kv: kv[1].lower()))
@@ -158,6 +183,55 @@ def reports(context, request):
 
     return {'ou_managed': sorted_ous, 'is_superuser': is_superuser}
 
+class CompletePathResolver(object):
+    '''
+    Calculate the paths with names instead of IDs of the nodes of a report.
+
+    The names of the nodes in the paths are read with a single query for all
+    the paths given to prefetch (or for all the missing ones of a path) and
+    memoized for the rest of the request.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.names = {}
+
+    def prefetch(self, paths):
+        missing = set()
+        for path in paths:
+            for element in path.split(','):
+                if element != 'root' and element not in self.names:
+                    missing.add(element)
+        if missing:
+            for node in self.db.nodes.find(
+                    {'_id': {'$in': [ObjectId(x) for x in missing]}},
+                    {'name': 1}):
+                self.names[str(node['_id'])] = node['name']
+            for element in missing:
+                self.names.setdefault(element, None)
+
+    def get_complete_path(self, path):
+        self.prefetch([path])
+        complete_path = ''
+        
+        lpath = path.split(',')
+        for idx, element in enumerate(lpath):
+            if element == 'root':
+                continue
+            else:
+                name = self.names[element]
+                if name is None:
+                    complete_path = 'Error path'
+                    break
+
+                if idx == len(lpath)-1:
+                    complete_path += name
+                else:
+                    complete_path += name + ' > '
+             
+        return complete_path
+
+
 def get_complete_path(db, path):
     '''
     Calculate the path with names instead of IDs.
@@ -171,24 +245,7 @@ def get_complete_path(db, path):
         compete_path (string) : Path width names instead of IDs
     '''
     
-    complete_path = ''
-    
-    lpath = path.split(',')
-    for idx, element in enumerate(lpath):
-        if element == 'root':
-            continue
-        else:
-            node = db.nodes.find_one({'_id': ObjectId(element)})
-            if node is None:
-                complete_path = 'Error path'
-                break
-
-            if idx == len(lpath)-1:
-                complete_path += node['name'] 
-            else:
-                complete_path += node['name'] + ' > '
-         
-    return complete_path
+    return CompletePathResolver(db).get_complete_path(path)
 
 def get_html_node_link(node, previous_window=None):
     '''
@@ -269,19 +326,24 @@ def truncate_string_at_char(string, new_line_at, new_line_char="<br/>"):
 
     return new_line_char.join(data)
 
-def check_visibility_of_ou(request):
+def is_ou_visible(request, oid):
 
     is_superuser = request.user.get('is_superuser', False)
-    oid = request.GET.get('ou_id', None)
 
-    if oid is not None:
-        if not is_superuser: # Administrator: checks if ou is visible
-            is_visible = oid in request.user.get('ou_managed', []) or \
-                         oid in request.user.get('ou_readonly', [])
-        else: # Superuser: only checks if exists
-            is_visible = request.db.nodes.find_one({'_id': ObjectId(oid)})
+    if not is_superuser: # Administrator: checks if ou is visible
+        is_visible = oid in request.user.get('ou_managed', []) or \
+                     oid in request.user.get('ou_readonly', [])
+    else: # Superuser: only checks if exists
+        is_visible = request.db.nodes.find_one({'_id': ObjectId(oid)})
+
+    return bool(is_visible)
+
+
+def check_visibility_of_ou(request):
+
+    oid = request.GET.get('ou_id', None)
 
-        if not is_visible:
-            oid = None
+    if oid is not None and not is_ou_visible(request, oid):
+        oid = None
 
     return oid